@@ -1,6 +1,26 @@
 """
 Audio transcription interface for the application.
 """
+import os
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+TRANSCRIPTION_WORKERS = int(os.getenv('TRANSCRIPTION_WORKERS', "4"))
+TRANSCRIPT_CACHE_SIZE = int(os.getenv('TRANSCRIPT_CACHE_SIZE', "256"))
+
+# Shared by all sessions, so the blocking transcription calls are bounded per process
+_TRANSCRIPTION_POOL = ThreadPoolExecutor(max_workers=TRANSCRIPTION_WORKERS,
+    thread_name_prefix="transcription")
+_TRANSCRIPTS = OrderedDict() # sha256 of the audio: transcript, least recently used first
+_IN_FLIGHT = {} # sha256 of the audio: future of the transcription running for it
+
+
+def audio_digest(audio_data) -> str:
+    '''Content hash of the audio. Reads bytes or a memoryview in place'''
+    return hashlib.sha256(audio_data).hexdigest()
+
 
 class AudioTranscriptionInterface:
     '''Interface for audio transcription technology and its use'''
@@ -12,3 +32,24 @@ class AudioTranscriptionInterface:
     def transcribe_audio(self, audio_data) -> str:
         '''Generate transcription for the audio data'''
         return
+
+    async def atranscribe_audio(self, audio_data) -> str:
+        '''Transcription without blocking the event loop. Runs transcribe_audio on a bounded
+        worker pool. A clip already transcribed, or being transcribed, is not sent again'''
+        digest = audio_digest(audio_data)
+        if digest in _TRANSCRIPTS:
+            _TRANSCRIPTS.move_to_end(digest)
+            return _TRANSCRIPTS[digest]
+        if digest in _IN_FLIGHT:
+            return await asyncio.shield(_IN_FLIGHT[digest])
+        future = asyncio.get_running_loop().run_in_executor(_TRANSCRIPTION_POOL,
+            self.transcribe_audio, audio_data)
+        _IN_FLIGHT[digest] = future
+        try:
+            text = await asyncio.shield(future)
+        finally:
+            _IN_FLIGHT.pop(digest, None)
+        _TRANSCRIPTS[digest] = text
+        while len(_TRANSCRIPTS) > TRANSCRIPT_CACHE_SIZE:
+            _TRANSCRIPTS.popitem(last=False)
+        return text
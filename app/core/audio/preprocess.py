@@ -0,0 +1,144 @@
+'''Prepares recorded audio for transcription, to cut the bytes uploaded to the API.
+Leading and trailing silence is trimmed by frame energy, the audio is downmixed to mono,
+resampled to 16 kHz and optionally compressed. Clips with no speech are not sent at all'''
+import io
+import os
+import wave
+from typing import Optional, Tuple
+
+import numpy as np
+
+from log_configs import log
+
+TARGET_SAMPLE_RATE = 16000 # what Whisper works at internally
+SILENCE_THRESHOLD_DB = float(os.getenv('AUDIO_SILENCE_THRESHOLD_DB', "-40")) # dBFS
+SILENCE_PADDING_SECONDS = 0.2 # kept around the speech, so word edges are not clipped
+VAD_FRAME_SECONDS = 0.03
+# "wav", or "flac"/"ogg" when the soundfile package is installed
+AUDIO_CODEC = os.getenv('AUDIO_CODEC', "wav")
+
+
+class BufferFile(io.RawIOBase):
+    '''A read only file over bytes, a memoryview or any other buffer, sharing its memory.
+    io.BytesIO copies anything but a bytes object'''
+    def __init__(self, data, name:str = "recorded_audio.wav") -> None:
+        super().__init__()
+        self.view = memoryview(data).cast("B")
+        self.position = 0
+        self.name = name
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int: #pylint: disable=arguments-renamed
+        size = max(0, min(len(buffer), len(self.view) - self.position))
+        memoryview(buffer).cast("B")[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def seek(self, offset:int, whence:int = io.SEEK_SET) -> int:
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: len(self.view)}
+        self.position = max(0, start[whence] + offset)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+
+def decode_wav(data:bytes) -> Optional[Tuple[np.ndarray, int]]:
+    '''Samples as float32 in [-1, 1], shaped (frames, channels), and the sample rate.
+    None if the data is not a PCM WAV, like the webm some browsers record'''
+    try:
+        with wave.open(BufferFile(data), "rb") as wav:
+            channels = wav.getnchannels()
+            width = wav.getsampwidth()
+            sample_rate = wav.getframerate()
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    if width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        samples = np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768
+    elif width == 4:
+        samples = np.frombuffer(frames, dtype="<i4").astype(np.float32) / 2147483648
+    else:
+        return None
+    return samples.reshape(-1, channels), sample_rate
+
+
+def downmix(samples:np.ndarray) -> np.ndarray:
+    '''Mono, as the mean of the channels'''
+    return samples.mean(axis=1) if samples.ndim == 2 else samples
+
+
+def resample(samples:np.ndarray, sample_rate:int,
+    target_rate:int = TARGET_SAMPLE_RATE) -> np.ndarray:
+    '''Mono samples at target_rate, by linear interpolation. Good enough for speech'''
+    if sample_rate == target_rate or len(samples) == 0:
+        return samples
+    duration = len(samples) / sample_rate
+    target_times = np.arange(int(duration * target_rate)) / target_rate
+    source_times = np.arange(len(samples)) / sample_rate
+    return np.interp(target_times, source_times, samples).astype(np.float32)
+
+
+def trim_silence(samples:np.ndarray, sample_rate:int,
+    threshold_db:float = SILENCE_THRESHOLD_DB,
+    padding:float = SILENCE_PADDING_SECONDS) -> Optional[np.ndarray]:
+    '''Mono samples without the leading and trailing frames quieter than threshold_db.
+    None if no frame is loud enough to be speech'''
+    frame = max(1, int(VAD_FRAME_SECONDS * sample_rate))
+    count = len(samples) // frame
+    if count == 0:
+        return None
+    rms = np.sqrt(np.square(samples[:count * frame]).reshape(count, frame).mean(axis=1))
+    voiced = np.flatnonzero(20 * np.log10(np.maximum(rms, 1e-10)) > threshold_db)
+    if len(voiced) == 0:
+        return None
+    pad = int(padding * sample_rate)
+    start = max(0, voiced[0] * frame - pad)
+    end = min(len(samples), (voiced[-1] + 1) * frame + pad)
+    return samples[start:end]
+
+
+def encode(samples:np.ndarray, sample_rate:int, codec:str = AUDIO_CODEC) -> Tuple[bytes, str]:
+    '''Mono samples as an audio file, with a file name telling the API its format'''
+    if codec != "wav":
+        try:
+            import soundfile #pylint: disable=import-outside-toplevel
+            buffer = io.BytesIO()
+            soundfile.write(buffer, samples, sample_rate, format=codec.upper())
+            return buffer.getvalue(), f"recorded_audio.{codec}"
+        except ImportError:
+            log.warning("soundfile not installed. Sending %s audio as wav", codec)
+        except Exception as exe: #pylint: disable=broad-exception-caught
+            log.warning("Could not encode audio as %s, sending wav: %s", codec, exe)
+    pcm = (np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes()
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        #pylint: disable=no-member
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buffer.getvalue(), "recorded_audio.wav"
+
+
+def preprocess_audio(data:bytes, codec:str = AUDIO_CODEC) -> Optional[Tuple[bytes, str]]:
+    '''(audio file bytes, file name) to upload for transcription, or None for a clip with
+    only silence. Audio that is not a PCM WAV is passed through as it is'''
+    decoded = decode_wav(data)
+    if decoded is None:
+        return data, "recorded_audio.wav"
+    samples, sample_rate = decoded
+    samples = resample(downmix(samples), sample_rate)
+    samples = trim_silence(samples, TARGET_SAMPLE_RATE)
+    if samples is None:
+        return None
+    output = encode(samples, TARGET_SAMPLE_RATE, codec)
+    log.debug("Audio preprocessed from %s to %s bytes", len(data), len(output[0]))
+    return output
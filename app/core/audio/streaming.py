@@ -0,0 +1,123 @@
+'''Incremental transcription of audio streamed in while the user speaks.
+The client sends 16 bit PCM in chunks. Every few seconds of it is cut, at the quietest moment
+near the boundary so words are not split, wrapped as a WAV and transcribed in the background.
+The transcript so far is reported as each segment finishes'''
+import io
+import os
+import wave
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+from core.audio import AudioTranscriptionInterface
+from log_configs import log
+
+AUDIO_SEGMENT_SECONDS = float(os.getenv('AUDIO_SEGMENT_SECONDS', "5"))
+CUT_SEARCH_SECONDS = 1.0 # how far back from the segment boundary to look for a quiet moment
+MIN_SEGMENT_SECONDS = 0.3 # shorter leftovers at the end are not worth a transcription call
+ENERGY_WINDOW_SECONDS = 0.02
+SAMPLE_WIDTH = 2 # bytes, 16 bit PCM
+
+
+def pcm_to_wav(pcm:bytes, sample_rate:int, channels:int) -> bytes:
+    '''16 bit little endian PCM wrapped in a WAV header'''
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        #pylint: disable=no-member
+        wav.setnchannels(channels)
+        wav.setsampwidth(SAMPLE_WIDTH)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+
+class IncrementalTranscriber: #pylint: disable=too-many-instance-attributes
+    '''Collects PCM chunks with feed() and transcribes them segment by segment.
+    on_partial is awaited with the transcript so far, in order, as segments finish.
+    finish() transcribes what is left and returns the complete transcript'''
+    def __init__(self, #pylint: disable=too-many-arguments
+                transcriber:AudioTranscriptionInterface,
+                sample_rate:int = 16000,
+                channels:int = 1,
+                segment_seconds:float = AUDIO_SEGMENT_SECONDS,
+                on_partial:Optional[Callable[[str], Awaitable[None]]] = None) -> None:
+        self.transcriber = transcriber
+        self.sample_rate = int(sample_rate)
+        self.channels = int(channels)
+        self.frame_bytes = SAMPLE_WIDTH * self.channels
+        self.bytes_per_second = self.sample_rate * self.frame_bytes
+        self.segment_bytes = int(segment_seconds * self.sample_rate) * self.frame_bytes
+        assert self.segment_bytes > 0, "An audio segment should be at least one sample long"
+        self.on_partial = on_partial
+        self.buffer = bytearray()
+        self.tasks:List[asyncio.Task] = []
+        self.texts:Dict[int, str] = {}
+        self.reported = ""
+
+    def _cut_point(self) -> int:
+        '''Byte offset, at most segment_bytes in, of the quietest window in the last
+        CUT_SEARCH_SECONDS before the segment boundary'''
+        window = max(1, int(ENERGY_WINDOW_SECONDS * self.sample_rate))
+        search = int(CUT_SEARCH_SECONDS * self.sample_rate)
+        end = self.segment_bytes // self.frame_bytes
+        start = max(0, end - search)
+        samples = np.frombuffer(self.buffer, dtype="<i2",
+            count=(end - start) * self.channels, offset=start * self.frame_bytes)
+        samples = samples.reshape(-1, self.channels).astype(np.float32)
+        windows = len(samples) // window
+        if windows < 2:
+            return self.segment_bytes
+        energy = np.square(samples[:windows * window]).reshape(windows, -1).mean(axis=1)
+        return (start + int(np.argmin(energy)) * window) * self.frame_bytes or self.segment_bytes
+
+    def feed(self, pcm) -> None:
+        '''Adds a chunk of PCM, starting the transcription of each full segment'''
+        self.buffer.extend(pcm)
+        while len(self.buffer) >= self.segment_bytes:
+            cut = self._cut_point()
+            segment = bytes(self.buffer[:cut])
+            del self.buffer[:cut]
+            self._start(segment)
+
+    def _start(self, segment:bytes) -> None:
+        index = len(self.tasks)
+        self.tasks.append(asyncio.create_task(self._transcribe(index, segment)))
+
+    async def _transcribe(self, index:int, segment:bytes) -> None:
+        try:
+            text = await self.transcriber.atranscribe_audio(
+                pcm_to_wav(segment, self.sample_rate, self.channels))
+        except Exception as exe: #pylint: disable=broad-exception-caught
+            log.exception(exe)
+            text = ""
+        self.texts[index] = (text or "").strip()
+        await self._report()
+
+    def transcript(self) -> str:
+        '''The transcript of the finished segments, up to the first unfinished one'''
+        parts = []
+        for index in range(len(self.tasks)):
+            if index not in self.texts:
+                break
+            parts.append(self.texts[index])
+        return " ".join(part for part in parts if part)
+
+    async def _report(self) -> None:
+        text = self.transcript()
+        if self.on_partial is not None and text and text != self.reported:
+            self.reported = text
+            await self.on_partial(text)
+
+    async def finish(self) -> str:
+        '''Transcribes the rest of the audio and returns the complete transcript'''
+        if len(self.buffer) >= MIN_SEGMENT_SECONDS * self.bytes_per_second:
+            self._start(bytes(self.buffer))
+        self.buffer.clear()
+        await asyncio.gather(*self.tasks)
+        return self.transcript()
+
+    def cancel(self) -> None:
+        '''Drops the pending transcriptions, when the user disconnects midway'''
+        for task in self.tasks:
+            task.cancel()
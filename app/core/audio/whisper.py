@@ -3,17 +3,21 @@ This module contains the WhisperAudioTranscription class which is used to
 transcribe audio using OpenAI's Whisper API.
 """
 
-import io
 import os
 import openai
 
 from core.audio import AudioTranscriptionInterface
+from core.rate_limiter import openai_scheduler, EndpointType, Priority
+from core.openai_client import OpenAIHttpClient, openai_http
+from core.audio.preprocess import preprocess_audio, BufferFile
 from custom_exceptions import AccessException
 
 class WhisperAudioTranscription(AudioTranscriptionInterface):
     '''Interface for audio transcription technology and its use'''
     def __init__(self, #pylint: disable=super-init-not-called
                 key:str=os.getenv("OPENAI_API_KEY"),
+                http_client:OpenAIHttpClient = openai_http,
+                preprocess:bool = True,
                 ) -> None:
         '''Sets the API key and initializes the audio file object'''
         if key is None:
@@ -23,15 +27,29 @@ class WhisperAudioTranscription(AudioTranscriptionInterface):
         self.api_object = openai
         self.api_object.api_key = key
         self.model = "whisper-1"
-        self.audio_file = None
+        self.http_client = http_client
+        self.http_client.install()
+        self.preprocess = preprocess
 
 
-    def transcribe_audio(self, audio_data: bytes) -> str:
-        '''Generate transcription for the audio data'''
-        self.audio_file = io.BytesIO()
-        self.audio_file.write(audio_data)
-        self.audio_file.seek(0)
-        self.audio_file.name = 'recorded_audio.wav'
-        transcript = openai.Audio.transcribe(self.model, self.audio_file)
+    def transcribe_audio(self, audio_data) -> str:
+        '''Generate transcription for the audio data, bytes or a memoryview'''
+        file_name = 'recorded_audio.wav'
+        if self.preprocess:
+            prepared = preprocess_audio(audio_data)
+            if prepared is None:
+                return "" # only silence, nothing worth sending
+            audio_data, file_name = prepared
+        # A file per call, as segments of a streamed recording are transcribed concurrently.
+        # It reads from the memory of the audio data, not a copy of it
+        audio_file = BufferFile(audio_data, file_name)
+
+        def transcribe():
+            audio_file.seek(0) # rewound for retries after a 429
+            # request_timeout is not passed, transcribe() would send it as a form field
+            return openai.Audio.transcribe(self.model, audio_file,
+                api_base=self.http_client.api_base)
+        transcript = openai_scheduler.call(EndpointType.AUDIO, transcribe,
+            priority=Priority.TRANSCRIPTION)
 
         return transcript['text']
@@ -0,0 +1,129 @@
+'''Compact forms of documents for the ingestion hot path. schema.Document stays the API's
+model. Inside, loaders yield DocumentRows, plain tuples that skip validation, and the
+embedding and DB stages work on DocumentBatches, a column per field, with the embeddings of
+the batch in one float32 matrix instead of a list of Python floats per document'''
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+
+import schema
+
+
+class DocumentRow(NamedTuple):
+    '''One document, with the field names of schema.Document.
+    links and media are strings, as validated at the API, or as made by loaders'''
+    docId: str
+    text: str
+    label: str = "open-access"
+    links: Sequence[str] = ()
+    media: Sequence[str] = ()
+    metadata: dict = {}
+    embedding: Optional[Sequence[float]] = None
+
+    @classmethod
+    def from_document(cls, doc:schema.Document) -> "DocumentRow":
+        '''The row of a validated document'''
+        return cls(doc.docId, doc.text, doc.label, [str(link) for link in doc.links],
+            [str(link) for link in doc.media], doc.metadata, doc.embedding)
+
+    @classmethod
+    def from_dict(cls, doc:dict) -> "DocumentRow":
+        '''The row of a document dict, as of schema.Document.dict(), already validated'''
+        return cls(doc['docId'], doc['text'], doc.get('label') or "open-access",
+            [str(link) for link in doc.get('links') or []],
+            [str(link) for link in doc.get('media') or []],
+            doc.get('metadata') or {}, doc.get('embedding'))
+
+    def to_document(self) -> schema.Document:
+        '''Back to the API model'''
+        return schema.Document(docId=self.docId, text=self.text, label=self.label,
+            links=list(self.links), media=list(self.media), metadata=dict(self.metadata),
+            embedding=None if self.embedding is None else list(self.embedding))
+
+
+class DocumentBatch: #pylint: disable=too-many-instance-attributes
+    '''Documents as columns. embeddings is an (n, dim) float32 matrix, allocated when
+    the first embedding is set, with `embedded` marking the rows that have one'''
+    __slots__ = ("ids", "texts", "labels", "links", "media", "metadata",
+        "embeddings", "embedded")
+
+    def __init__(self, #pylint: disable=too-many-arguments
+                ids:List[str],
+                texts:List[str],
+                labels:List[str],
+                links:List[Sequence[str]],
+                media:List[Sequence[str]],
+                metadata:List[dict],
+                embeddings:Optional[np.ndarray] = None,
+                embedded:Optional[np.ndarray] = None) -> None:
+        self.ids = ids
+        self.texts = texts
+        self.labels = labels
+        self.links = links
+        self.media = media
+        self.metadata = metadata
+        self.embeddings = embeddings
+        self.embedded = embedded
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_rows(cls, rows:Iterable[Union[DocumentRow, schema.Document]]) -> "DocumentBatch":
+        '''A batch of the rows. schema.Documents are taken too, for the callers
+        on the other side of the API boundary'''
+        rows = [row if isinstance(row, DocumentRow) else DocumentRow.from_document(row)
+                for row in rows]
+        batch = cls([row.docId for row in rows], [row.text for row in rows],
+            [row.label for row in rows], [row.links for row in rows],
+            [row.media for row in rows], [row.metadata for row in rows])
+        given = [i for i, row in enumerate(rows) if row.embedding is not None]
+        if given:
+            batch.set_embeddings(given, [rows[i].embedding for i in given])
+        return batch
+
+    def set_embeddings(self, indices:Sequence[int], vectors) -> None:
+        '''Sets the embeddings of the rows at the indices, from a matrix or list of vectors'''
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.embeddings is None:
+            self.embeddings = np.zeros((len(self), vectors.shape[1]), dtype=np.float32)
+            self.embedded = np.zeros(len(self), dtype=bool)
+        self.embeddings[list(indices)] = vectors
+        self.embedded[list(indices)] = True
+
+    def missing_embeddings(self) -> List[int]:
+        '''Indices of the rows with no embedding yet'''
+        if self.embedded is None:
+            return list(range(len(self)))
+        return np.flatnonzero(np.logical_not(self.embedded)).tolist()
+
+    def given_embeddings(self) -> List[int]:
+        '''Indices of the rows that have their embedding'''
+        if self.embedded is None:
+            return []
+        return np.flatnonzero(self.embedded).tolist()
+
+    def all_embedded(self) -> bool:
+        '''Whether every row has its embedding'''
+        return self.embedded is not None and bool(self.embedded.all())
+
+    def rows(self) -> Iterator[DocumentRow]:
+        '''The rows again, with embeddings as float32 vectors (views of the matrix)'''
+        for i in range(len(self)):
+            embedding = None
+            if self.embedded is not None and self.embedded[i]:
+                embedding = self.embeddings[i]
+            yield DocumentRow(self.ids[i], self.texts[i], self.labels[i], self.links[i],
+                self.media[i], self.metadata[i], embedding)
+
+    def to_documents(self) -> List[schema.Document]:
+        '''The API model of each row'''
+        return [row.to_document() for row in self.rows()]
+
+
+def as_batch(docs:Union[DocumentBatch, Iterable[Union[DocumentRow, schema.Document]]]
+    ) -> DocumentBatch:
+    '''The docs as a DocumentBatch, for the methods that also take lists of documents'''
+    if isinstance(docs, DocumentBatch):
+        return docs
+    return DocumentBatch.from_rows(docs)
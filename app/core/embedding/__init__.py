@@ -2,7 +2,10 @@
 import os
 from typing import List
 
+import numpy as np
+
 import schema
+from core.document_batch import DocumentBatch
 
 #pylint: disable=too-few-public-methods, unused-argument
 
@@ -13,6 +16,20 @@ class EmbeddingInterface:
     def __init__(self, key:str, **kwargs) -> None:
         '''Sets the API key and initializes library objects if any'''
         self.api_key = key
-    def get_embeddings(self, doc_list: List[schema.Document]) -> None:
+    def get_embeddings(self, doc_list: List[schema.Document], **kwargs) -> None:
         '''Generate embedding for the .text values and sets them to .embedding field of i/p items'''
         return
+
+    def embed_texts(self, texts: List[str], **kwargs) -> np.ndarray:
+        '''Embeddings of the texts, as an (n, dim) float32 matrix.
+        Implementations should override this, the default goes through get_embeddings()'''
+        docs = [schema.Document(docId=str(i), text=text) for i, text in enumerate(texts)]
+        self.get_embeddings(docs, **kwargs)
+        return np.asarray([doc.embedding for doc in docs], dtype=np.float32)
+
+    def embed_batch(self, batch: DocumentBatch, **kwargs) -> None:
+        '''Sets the embeddings of the documents in the batch that have none'''
+        missing = batch.missing_embeddings()
+        if missing:
+            batch.set_embeddings(missing,
+                self.embed_texts([batch.texts[i] for i in missing], **kwargs))
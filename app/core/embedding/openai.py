@@ -1,12 +1,18 @@
 '''Implemetations for embedding interface'''
 import os
 from typing import List, Optional
+import numpy as np
 import openai
 
 import schema
 from core.embedding import EmbeddingInterface
+from core.rate_limiter import openai_scheduler, EndpointType, Priority
+from core.openai_client import OpenAIHttpClient, openai_http
+from core.llm_framework.context_packer import count_tokens
 from custom_exceptions import AccessException, OpenAIException
 
+EMBEDDING_BATCH_SIZE = int(os.getenv('OPENAI_EMBEDDING_BATCH_SIZE', "100"))
+
 
 #pylint: disable=too-few-public-methods
 
@@ -18,7 +24,8 @@ class OpenAIEmbedding(EmbeddingInterface):
     def __init__(self, #pylint: disable=super-init-not-called
                 key:str=os.getenv("OPENAI_API_KEY"),
                 api_key: Optional[str] = os.getenv("OPENAI_API_KEY"), # the set_embedding method uses api_key, so it's accepted here for cross-compatibility
-                model:str = 'text-embedding-ada-002') -> None:
+                model:str = 'text-embedding-ada-002',
+                http_client:OpenAIHttpClient = openai_http) -> None:
         '''Sets the API key and initializes library objects if any'''            
         self.api_key = key if key is not None else api_key
         if self.api_key is None:
@@ -27,14 +34,37 @@ class OpenAIEmbedding(EmbeddingInterface):
         self.api_object = openai
         self.api_object.api_key = key
         self.model = model
+        self.http_client = http_client
+        self.http_client.install()
+
+    def get_embeddings(self, doc_list: List[schema.Document],
+        priority:Priority = Priority.BULK, **kwargs) -> None:
+        '''Generate embedding for the .text values and sets them to .embedding field of i/p items.
+        Sends the texts in batches, when the shared rate scheduler allows'''
+        vectors = self.embed_texts([doc.text for doc in doc_list], priority=priority)
+        for doc, vector in zip(doc_list, vectors):
+            doc.embedding = vector.tolist()
 
-    def get_embeddings(self, doc_list: List[schema.Document]) -> None:
-        '''Generate embedding for the .text values and sets them to .embedding field of i/p items'''
-        for doc in doc_list:
-            input_text = doc.text.replace("\n", " ")
-            response = openai.Embedding.create(
-                        input = input_text,
-                        model=self.model)
+    def embed_texts(self, texts: List[str],
+        priority:Priority = Priority.BULK, **kwargs) -> np.ndarray:
+        '''Embeddings of the texts, as an (n, dim) float32 matrix, filled in from each
+        response as it comes'''
+        matrix = None
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            input_texts = [text.replace("\n", " ")
+                for text in texts[start:start+EMBEDDING_BATCH_SIZE]]
+            response = openai_scheduler.call(EndpointType.EMBEDDING, openai.Embedding.create,
+                        input = input_texts,
+                        model=self.model,
+                        tokens=sum(count_tokens(text) for text in input_texts),
+                        priority=priority,
+                        **self.http_client.request_args())
             if "data" not in response:
                 raise OpenAIException(str(response))
-            doc.embedding = response['data'][0]['embedding']
+            for item in response['data']:
+                if matrix is None:
+                    matrix = np.empty((len(texts), len(item['embedding'])), dtype=np.float32)
+                matrix[start + item['index']] = item['embedding']
+        if matrix is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return matrix
@@ -1,5 +1,7 @@
 '''Implemetations for embedding interface'''
+from functools import lru_cache
 from typing import List
+import numpy as np
 from log_configs import log
 
 import schema
@@ -21,7 +23,21 @@ class SentenceTransformerEmbedding(EmbeddingInterface):
         from sentence_transformers import SentenceTransformer
         self.model = SentenceTransformer(model)
 
-    def get_embeddings(self, doc_list: List[schema.Document]) -> None:
+    def get_embeddings(self, doc_list: List[schema.Document], **kwargs) -> None:
         '''Generates embeddings for the .text values and sets them to .embedding field of i/p items'''
-        for doc in doc_list:
-            doc.embedding = self.model.encode([doc.text.strip()])[0]
\ No newline at end of file
+        vectors = self.embed_texts([doc.text for doc in doc_list])
+        for doc, vector in zip(doc_list, vectors):
+            doc.embedding = vector
+
+    def embed_texts(self, texts: List[str], **kwargs) -> np.ndarray:
+        '''Embeddings of the texts, as an (n, dim) float32 matrix'''
+        return np.asarray(self.model.encode([text.strip() for text in texts]),
+            dtype=np.float32)
+
+
+@lru_cache(maxsize=None)
+def shared_embedding(model:str=SentenceTransformerEmbedding.default_model
+    ) -> SentenceTransformerEmbedding:
+    '''One instance per model for the whole app, loaded on first use,
+    for the components that need a local embedding and are not given one'''
+    return SentenceTransformerEmbedding(model)
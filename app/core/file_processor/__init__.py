@@ -1,34 +1,84 @@
 '''Interface definition and common implemetations for file processing classes'''
+import os
 from io import TextIOWrapper
-from typing import List
+from typing import Iterator, List
 import csv
 
+from pydantic import AnyUrl, parse_obj_as
+
 import schema
+from core.document_batch import DocumentRow
+from core.file_processor.bible import (iter_usfm_verses, iter_usx_verses,
+    group_pericopes, verse_reference, pericope_reference)
+from custom_exceptions import GenericException
 
 #pylint: disable=too-few-public-methods, unused-argument
 
+def default_name(file:str) -> str:
+    '''Name for the documents of a file, when none is given'''
+    return os.path.splitext(os.path.basename(str(file)))[0]
+
+
 class FileProcessorInterface:
     '''Interface for file handling techniques'''
-    def process_file(self,
+    def iter_documents(self,
                  file: str,
                  label:str=None,
                  file_type:str=schema.FileType.TEXT,
-                 **kwargs) -> List[schema.Document]:
-        '''Converts the file contents to Document type, as per the format and its implementation.
+                 **kwargs) -> Iterator[DocumentRow]:
+        '''Yields the file contents as DocumentRows, as per the format and its implementation,
+        reading the file as it goes. So large files can be ingested with memory
+        proportional to the batch being processed, not the file.
         file_type can be more content specific like "paratext manual" or "usfm bible"
         with custom handling for its format and contents.
         Implementations should try to fill as much additional information like links, media etc.
-        label, when provided, should apply to all documents in the o/p list'''
+        label, when provided, should apply to all documents yielded'''
+        if file_type in [schema.FileType.TEXT, schema.FileType.MD]:
+            yield from self.iter_file_text(
+                file = file,
+                label = label,
+                name = kwargs.get("name", None),
+                metadata = kwargs.get("metadata", {}))
+        elif file_type == schema.FileType.CSV:
+            args = {}
+            col_delimiter = kwargs.get('col_delimiter')
+            if col_delimiter is not None:
+                args['col_delimiter'] = col_delimiter
+            yield from self.iter_file_csv(file=file, **args)
+        elif file_type in [schema.FileType.USFM, schema.FileType.USX]:
+            yield from self.iter_file_bible(
+                file = file,
+                label = label,
+                file_type = file_type,
+                name = kwargs.get("name", None),
+                metadata = kwargs.get("metadata", {}),
+                unit = kwargs.get("bible_unit", schema.BibleDocumentUnit.VERSE))
+        else:
+            raise GenericException("This file type is not supported (yet)!")
 
-        return []
+    def process_file(self,
+                 file: str,
+                 label:str=None,
+                 file_type:str=schema.FileType.TEXT,
+                 **kwargs) -> List[schema.Document]:
+        '''Converts the file contents to Document type, as a list. See iter_documents()'''
+        return [row.to_document() for row in
+            self.iter_documents(file, label=label, file_type=file_type, **kwargs)]
 
-    def process_file_csv(self,
+    def iter_file_text(self,
+                 file: TextIOWrapper,
+                 label:str,
+                 name: str = None,
+                 metadata: dict = None) -> Iterator[DocumentRow]:
+        '''Splits text contents into documents, as they are read'''
+        return iter([])
+
+    def iter_file_csv(self,
             file: str,
-            col_delimiter:str=",") -> List[schema.Document]:
-        '''Converts CSV files with format, (id, text, label, links, medialinks)
-        label, links and media links must be comma separated values in the same field.
-        into document objects'''
-        output_list = []
+            col_delimiter:str=",") -> Iterator[DocumentRow]:
+        '''Yields documents from a CSV file with format, (id, text, label, links, medialinks),
+        a row at a time. label, links and media links must be comma separated values
+        in the same field. The links are validated as URLs here, as the API would'''
         with open(file, 'r', encoding="utf-8") as csvfile:
             reader = csv.DictReader(csvfile, delimiter=col_delimiter)
             for row in reader:
@@ -40,11 +90,64 @@ class FileProcessorInterface:
                     media = []
                 else:
                     media = [ med.strip() for med in row['medialinks'].split(',')]
-                doc = schema.Document(
+                yield DocumentRow(
                     docId = row['id'].strip(),
                     text = row['text'],
-                    label = row['label'],
-                    links = links,
-                    media = media)
-                output_list.append(doc)
-            return output_list
+                    label = row['label'] or "open-access",
+                    links = [str(link) for link in parse_obj_as(List[AnyUrl], links)],
+                    media = [str(link) for link in parse_obj_as(List[AnyUrl], media)])
+
+    def iter_file_bible(self, #pylint: disable=too-many-arguments
+            file: str,
+            label:str,
+            file_type:schema.FileType=schema.FileType.USFM,
+            name: str = None,
+            metadata: dict = None,
+            unit:schema.BibleDocumentUnit=schema.BibleDocumentUnit.VERSE
+            ) -> Iterator[DocumentRow]:
+        '''Yields a document per verse, or per pericope, of a USFM or USX book,
+        parsed as it is read. docIds are the name (or else the label) and the reference,
+        as in "ESV-Bible GEN 1:1", so re-uploads replace the same documents'''
+        if not label:
+            label = "open-access"
+        if name is None or name.strip() == "":
+            name = label
+        meta = {"source": str(file)}
+        meta.update(metadata or {})
+
+        with open(file, 'rb' if file_type == schema.FileType.USX else 'r',
+                encoding=None if file_type == schema.FileType.USX else "utf-8-sig") as bible_file:
+            if file_type == schema.FileType.USX:
+                verses = iter_usx_verses(bible_file)
+            else:
+                verses = iter_usfm_verses(bible_file)
+            if unit == schema.BibleDocumentUnit.PERICOPE:
+                for group in group_pericopes(verses):
+                    first, last = group[0], group[-1]
+                    text = " ".join(verse.text for verse in group)
+                    if first.heading:
+                        text = f"{first.heading}\n{text}"
+                    yield DocumentRow(
+                        docId = f"{name} {pericope_reference(group)}",
+                        text = text,
+                        label = label,
+                        metadata = {**meta, "book": first.book,
+                            "chapter": first.chapter, "verse": first.verse,
+                            "end_chapter": last.chapter, "end_verse": last.verse,
+                            "heading": first.heading or ""})
+            else:
+                for verse in verses:
+                    yield DocumentRow(
+                        docId = f"{name} {verse_reference(verse.book, verse.chapter, verse.verse)}",
+                        text = verse.text,
+                        label = label,
+                        metadata = {**meta, "book": verse.book,
+                            "chapter": verse.chapter, "verse": verse.verse})
+
+    def process_file_csv(self,
+            file: str,
+            col_delimiter:str=",") -> List[schema.Document]:
+        '''Converts CSV files with format, (id, text, label, links, medialinks)
+        label, links and media links must be comma separated values in the same field.
+        into document objects'''
+        return [row.to_document() for row in self.iter_file_csv(file, col_delimiter)]
@@ -0,0 +1,231 @@
+'''Streaming parsers for Bible books in USFM and USX, yielding one verse at a time.
+USFM is read line by line through a small state machine, USX with iterparse, one top level
+element at a time, cleared once read. So a whole Bible takes memory for a paragraph,
+not a book. Verses can be grouped into pericopes, the sections under each heading'''
+import re
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Union
+from xml.etree.ElementTree import iterparse
+
+PERICOPE_MAX_VERSES = 40 # books without section headings are cut into pericopes of this size
+
+# USFM markers, other than \v and \c, whose line is not verse text
+USFM_HEADINGS = re.compile(r"(s\d?|ms\d?|d|sp|qa)$")
+USFM_SKIPPED = re.compile(r"(id|ide|h\d?|toc\d?|toca\d?|mt\d?|mte\d?|rem|sts|usfm|cl|cp|ca|va|vp"
+    r"|periph|i[a-z]*\d?|lit|restore|r|mr|sr)$")
+USFM_MARKER = re.compile(r"\\([a-z]+\d*)(\s+|$)")
+USFM_VERSE = re.compile(r"\\v\s+(\S+)\s?")
+USFM_NOTE = re.compile(r"\\(f|fe|ef|x|ex)\s.*?\\\1\*", re.S)
+USFM_ATTRIBUTES = re.compile(r"\|[^\\|]*(?=\\\+?[a-z]+\d*\*)") # as in \w grace|lemma="..."\w*
+USFM_CHAR_MARKER = re.compile(r"\\\+?[a-z]+\d*(\*|\s?)") # closing, or opening with its space
+
+# USX paragraph styles that are headings, or not verse text
+USX_HEADINGS = USFM_HEADINGS
+USX_SKIPPED = USFM_SKIPPED
+USX_NOTES = {"note", "figure", "sidebar", "ref"}
+
+
+class Verse(NamedTuple):
+    '''A verse and, when it starts a section, the heading of that section'''
+    book: str
+    chapter: Union[int, str]
+    verse: str
+    text: str
+    heading: Optional[str]
+
+
+def _number(value:str) -> Union[int, str]:
+    return int(value) if value.isdigit() else value
+
+
+def clean_usfm(text:str) -> str:
+    '''Verse text without footnotes, cross references, word attributes and markers'''
+    text = USFM_NOTE.sub(" ", text)
+    text = USFM_ATTRIBUTES.sub("", text)
+    text = USFM_CHAR_MARKER.sub("", text)
+    text = text.replace("~", " ").replace("//", " ")
+    return " ".join(text.split())
+
+
+class VerseCollector: #pylint: disable=too-many-instance-attributes
+    '''What the parsers report, as they read, turned into Verses.
+    Finished verses are kept in `ready`, for the parser to hand out'''
+    def __init__(self, clean=None) -> None:
+        self.clean = clean or (lambda text: " ".join(text.split()))
+        self.book = ""
+        self.chapter:Union[int, str] = 0
+        self.verse:Optional[str] = None
+        self.parts:List[str] = []
+        self.heading:Optional[str] = None
+        self.verse_heading:Optional[str] = None
+        self.ready:List[Verse] = []
+
+    def set_book(self, code:str) -> None:
+        '''A new book, from \\id or <book code>'''
+        self.end_verse()
+        self.book = code.upper()
+
+    def set_chapter(self, number:str) -> None:
+        '''A new chapter'''
+        self.end_verse()
+        self.chapter = _number(number)
+
+    def add_heading(self, text:str) -> None:
+        '''A section heading, for the verse that comes next'''
+        self.end_verse()
+        text = self.clean(text)
+        if text:
+            self.heading = text if self.heading is None else f"{self.heading} {text}"
+
+    def start_verse(self, number:str) -> None:
+        '''A new verse begins'''
+        self.end_verse()
+        self.verse = number
+        self.verse_heading, self.heading = self.heading, None
+
+    def add_text(self, text:str) -> None:
+        '''Text of the current verse. Text outside any verse is dropped'''
+        if self.verse is not None and text:
+            self.parts.append(text)
+
+    def end_verse(self) -> None:
+        '''Finishes the current verse, if there is one'''
+        if self.verse is None:
+            return
+        text = self.clean(" ".join(self.parts))
+        if text:
+            self.ready.append(Verse(self.book, self.chapter, self.verse, text,
+                self.verse_heading))
+        self.verse = None
+        self.parts = []
+        self.verse_heading = None
+
+    def drain(self) -> Iterator[Verse]:
+        '''Hands out the finished verses'''
+        ready, self.ready = self.ready, []
+        return iter(ready)
+
+
+def iter_usfm_verses(lines:Iterable[str]) -> Iterator[Verse]:
+    '''The verses of USFM text, read a line at a time'''
+    collector = VerseCollector(clean=clean_usfm)
+    for line in lines:
+        line = line.strip()
+        match = USFM_MARKER.match(line)
+        if match is not None:
+            marker, rest = match.group(1), line[match.end():]
+            if marker == "id":
+                collector.set_book(rest.split()[0] if rest.split() else "")
+                continue
+            if marker == "c":
+                collector.set_chapter(rest.split()[0] if rest.split() else "")
+                continue
+            if USFM_HEADINGS.match(marker):
+                collector.add_heading(rest)
+                continue
+            if USFM_SKIPPED.match(marker):
+                continue
+        # paragraph and poetry markers, \p \m \q1 \li ... carry on the verse.
+        # They are removed with the other markers, when the verse is cleaned
+        start = 0
+        for verse in USFM_VERSE.finditer(line):
+            collector.add_text(line[start:verse.start()])
+            collector.start_verse(verse.group(1))
+            start = verse.end()
+        collector.add_text(line[start:])
+        yield from collector.drain()
+    collector.end_verse()
+    yield from collector.drain()
+
+
+def _local(tag:str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _walk_usx(elem, collector:VerseCollector) -> None:
+    '''Reports the text and verse milestones inside a paragraph, in document order'''
+    tag = _local(elem.tag)
+    if tag == "verse":
+        if elem.get("number") is not None:
+            collector.start_verse(elem.get("number"))
+        elif elem.get("eid") is not None:
+            collector.end_verse()
+    elif tag not in USX_NOTES:
+        collector.add_text(elem.text or "")
+        for child in elem:
+            _walk_usx(child, collector)
+    collector.add_text(elem.tail or "")
+
+
+def _usx_text(elem) -> str:
+    '''All the text inside, except notes'''
+    parts = [elem.text or ""]
+    for child in elem:
+        if _local(child.tag) not in USX_NOTES:
+            parts.append(_usx_text(child))
+        parts.append(child.tail or "")
+    return "".join(parts)
+
+
+def iter_usx_verses(source) -> Iterator[Verse]:
+    '''The verses of a USX file (path or binary file object), parsed incrementally.
+    Each child of the root is handled when it ends and then dropped'''
+    collector = VerseCollector()
+    depth = 0
+    root = None
+    for event, elem in iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        tag = _local(elem.tag)
+        style = elem.get("style", "")
+        if tag == "book":
+            collector.set_book(elem.get("code", ""))
+        elif tag == "chapter":
+            if elem.get("number") is not None:
+                collector.set_chapter(elem.get("number"))
+        elif tag == "para" and USX_HEADINGS.match(style):
+            collector.add_heading(_usx_text(elem))
+        elif tag == "para" and USX_SKIPPED.match(style):
+            pass
+        elif tag not in USX_NOTES:
+            # paragraphs, tables, and verse milestones outside them
+            _walk_usx(elem, collector)
+        root.clear()
+        yield from collector.drain()
+    collector.end_verse()
+    yield from collector.drain()
+
+
+def verse_reference(book:str, chapter, verse:str) -> str:
+    '''As in GEN 1:1'''
+    return f"{book} {chapter}:{verse}"
+
+
+def group_pericopes(verses:Iterable[Verse],
+    max_verses:int = PERICOPE_MAX_VERSES) -> Iterator[List[Verse]]:
+    '''Groups the verses into sections, each starting at a heading or a new book,
+    and at most max_verses long'''
+    group:List[Verse] = []
+    for verse in verses:
+        if group and (verse.heading is not None or verse.book != group[0].book
+                or len(group) >= max_verses):
+            yield group
+            group = []
+        group.append(verse)
+    if group:
+        yield group
+
+
+def pericope_reference(group:List[Verse]) -> str:
+    '''As in GEN 1:1-2:3, or GEN 1:1-5 within a chapter'''
+    first, last = group[0], group[-1]
+    if len(group) == 1:
+        return verse_reference(first.book, first.chapter, first.verse)
+    if first.chapter == last.chapter:
+        return f"{verse_reference(first.book, first.chapter, first.verse)}-{last.verse}"
+    return f"{verse_reference(first.book, first.chapter, first.verse)}-{last.chapter}:{last.verse}"
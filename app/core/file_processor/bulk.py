@@ -0,0 +1,198 @@
+'''Ingestion of many files at once, from a directory or a zip/tar archive.
+The files are parsed and chunked in a pool of processes, and their documents merged into
+a single stream, for the batched embedding and DB writes of the ingestion pipeline'''
+import os
+import tarfile
+import zipfile
+import multiprocessing
+from functools import partial
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import IO, Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+import schema
+from core.document_batch import DocumentBatch, DocumentRow
+from core.file_processor import FileProcessorInterface
+from custom_exceptions import UnprocessableException, PayloadTooLargeException
+from log_configs import log
+
+BULK_PARSE_WORKERS = int(os.getenv('BULK_PARSE_WORKERS', str(os.cpu_count() or 2)))
+FILES_IN_FLIGHT_PER_WORKER = 2 # parsed files waiting to be consumed are held in memory
+# limits on what an archive extracts to, against zip bombs
+MAX_ARCHIVE_BYTES = int(os.getenv('MAX_ARCHIVE_BYTES', str(4 * 1024 * 1024 * 1024)))
+MAX_ARCHIVE_MEMBERS = int(os.getenv('MAX_ARCHIVE_MEMBERS', "100000"))
+
+# file types by extension. Files of other extensions are skipped
+FILE_TYPES = {
+    ".md": schema.FileType.MD,
+    ".markdown": schema.FileType.MD,
+    ".txt": schema.FileType.TEXT,
+    ".csv": schema.FileType.CSV,
+    ".tsv": schema.FileType.CSV,
+    ".usfm": schema.FileType.USFM,
+    ".sfm": schema.FileType.USFM,
+    ".usx": schema.FileType.USX,
+}
+COL_DELIMITERS = {".csv": ",", ".tsv": "\t"}
+
+
+class ParsedFile(NamedTuple):
+    '''Documents of one file, or why there are none. As columns, to be light to pickle
+    back from the pool'''
+    file: str
+    documents: DocumentBatch
+    error: Optional[str]
+
+
+def is_archive(path:str) -> bool:
+    '''Whether the file is a zip or tar archive (compressed or not)'''
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+
+def _safe_member_path(dest:str, name:str) -> Optional[str]:
+    '''Where an archive member goes under dest. None for names that would land outside it'''
+    target = os.path.realpath(os.path.join(dest, name))
+    if os.path.commonpath([os.path.realpath(dest), target]) != os.path.realpath(dest):
+        return None
+    return target
+
+
+def _regular_members(archive:str) -> Iterator[Tuple[str, Callable[[], IO[bytes]]]]:
+    '''Names of the regular files of a zip or tar archive, with a function opening each'''
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zipped:
+            for member in zipped.infolist():
+                if not member.is_dir():
+                    yield member.filename, partial(zipped.open, member)
+    elif tarfile.is_tarfile(archive):
+        with tarfile.open(archive) as tarred:
+            for member in tarred:
+                if member.isfile():
+                    yield member.name, partial(tarred.extractfile, member)
+    else:
+        raise UnprocessableException("Upload is not a zip or tar archive")
+
+
+def extract_archive(archive:str, dest:str,
+    max_bytes:int = MAX_ARCHIVE_BYTES,
+    max_members:int = MAX_ARCHIVE_MEMBERS) -> None:
+    '''Extracts the regular files of a zip or tar archive into dest. Links, devices and
+    members with absolute or ../ paths are skipped. Stops with PayloadTooLargeException
+    past max_members files or max_bytes extracted, counted as written, not as declared'''
+    members, extracted = 0, 0
+    for name, open_member in _regular_members(archive):
+        target = _safe_member_path(dest, name)
+        if target is None:
+            log.warning("Skipping archive member %s outside the archive", name)
+            continue
+        members += 1
+        if members > max_members:
+            raise PayloadTooLargeException(f"Archive has more than {max_members} files")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open_member() as src, open(target, "wb") as out:
+            while chunk := src.read(1024 * 1024):
+                extracted += len(chunk)
+                if extracted > max_bytes:
+                    raise PayloadTooLargeException(
+                        f"Archive extracts to more than the limit of {max_bytes} bytes")
+                out.write(chunk)
+
+
+def list_files(directory:str) -> Tuple[List[str], List[str]]:
+    '''Paths, relative to the directory, of the files that can be ingested and of those
+    skipped for their extension. Hidden files and directories are left out'''
+    files, skipped = [], []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+        for name in sorted(names):
+            if name.startswith("."):
+                continue
+            path = os.path.relpath(os.path.join(root, name), directory)
+            if os.path.splitext(name)[1].lower() in FILE_TYPES:
+                files.append(path)
+            else:
+                skipped.append(path)
+    return files, skipped
+
+
+def parse_file(processor:FileProcessorInterface, #pylint: disable=too-many-arguments
+    directory:str, file:str, label:Optional[str], source_prefix:str,
+    process_args:dict) -> ParsedFile:
+    '''Runs in the pool. The documents of one file, or the error that stopped it'''
+    extension = os.path.splitext(file)[1].lower()
+    args = dict(process_args)
+    if FILE_TYPES[extension] == schema.FileType.CSV:
+        args['col_delimiter'] = COL_DELIMITERS[extension]
+    elif FILE_TYPES[extension] in [schema.FileType.USFM, schema.FileType.USX]:
+        # docIds of verses are named by the label and the reference, not the file
+        args['metadata'] = {"source": f"{source_prefix}{file}"}
+    else:
+        # the relative path keeps names apart, for files of the same name in different folders
+        args['name'] = os.path.splitext(file)[0].replace(os.sep, "/")
+        args['metadata'] = {"source": f"{source_prefix}{file}"}
+    try:
+        docs = DocumentBatch.from_rows(processor.iter_documents(os.path.join(directory, file),
+            label=label, file_type=FILE_TYPES[extension], **args))
+    except Exception as exe: #pylint: disable=broad-exception-caught
+        return ParsedFile(file, DocumentBatch.from_rows([]),
+            f"{getattr(exe, 'name', type(exe).__name__)}: {getattr(exe, 'detail', exe)}")
+    return ParsedFile(file, docs, None)
+
+
+class BulkParse:
+    '''Parses the files of a directory in a process pool, as a context manager.
+    documents() yields their documents in the order the files finish, keeping a few
+    files per worker parsed ahead. Failed files are recorded and do not stop the rest.
+    process_args go to the file processor, for every file'''
+    def __init__(self, #pylint: disable=too-many-arguments
+                directory:str,
+                processor:FileProcessorInterface,
+                label:Optional[str] = None,
+                workers:int = BULK_PARSE_WORKERS,
+                source_prefix:str = "",
+                process_args:Optional[dict] = None) -> None:
+        # parses one file, by its path relative to the directory
+        self.parse = partial(parse_file, processor, directory, label=label,
+            source_prefix=source_prefix, process_args=process_args or {})
+        self.workers = max(1, workers)
+        self.files, self.skipped = list_files(directory)
+        self.parsed = 0
+        self.errors:List[dict] = []
+        self.executor = None
+
+    def __enter__(self) -> "BulkParse":
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"))
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def documents(self) -> Iterator[DocumentRow]:
+        '''The documents of all the files, as they are parsed'''
+        files = iter(self.files)
+        pending = set()
+        while True:
+            while len(pending) < self.workers * FILES_IN_FLIGHT_PER_WORKER:
+                file = next(files, None)
+                if file is None:
+                    break
+                pending.add(self.executor.submit(self.parse, file))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                parsed = future.result()
+                self.parsed += 1
+                if parsed.error is not None:
+                    log.warning("Could not ingest %s: %s", parsed.file, parsed.error)
+                    self.errors.append({"file": parsed.file, "error": parsed.error})
+                yield from parsed.documents.rows()
+
+    def report(self) -> dict:
+        '''Counts of the files, with the failed and skipped ones'''
+        return {
+            "files": len(self.files),
+            "files_parsed": self.parsed,
+            "failed_files": self.errors,
+            "skipped_files": self.skipped,
+        }
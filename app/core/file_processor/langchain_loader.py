@@ -1,72 +1,71 @@
 '''Langchain based implementation for file handling'''
 from io import TextIOWrapper
-from typing import List
+from typing import Iterator, List
 from langchain.text_splitter import CharacterTextSplitter
-from langchain.document_loaders import TextLoader
 
-from core.file_processor import FileProcessorInterface
+from core.file_processor import FileProcessorInterface, default_name
+from core.document_batch import DocumentRow
 import schema
-from custom_exceptions import GenericException
 
 
 #pylint: disable=too-few-public-methods, unused-argument
 
+SPLIT_WINDOW_CHARS = 64 * 1024 # text read before splitting, ending at a paragraph break
+PARAGRAPH_SEPARATOR = "\n\n" # what CharacterTextSplitter splits on by default
+
 class LangchainLoader(FileProcessorInterface):
     '''Langchain based implementation for file handling'''
-    def process_file(self,
-                 file: str,
-                 label:str="open-access",
-                 file_type:str=schema.FileType.TEXT,
-                 **kwargs) -> List[schema.Document]:
-        '''Converts the file contents to Document type, as per the format and its implementation.
-        file_type can be more content specific like "paratext manual" or "usfm bible"
-        with custom handling for its format and contents.
-        Implementations should try to fill as much additional information like links, media etc.
-        label, when provided, should apply to all documents in the o/p list'''
-        if file_type in [schema.FileType.TEXT, schema.FileType.MD]:
-            name = kwargs.get("name", None)
-            metadata = kwargs.get("metadata", {})
-            output_list = self.process_file_text(
-                file = file,
-                label = label,
-                name = name,
-                metadata = metadata)
-        elif file_type == schema.FileType.CSV:
-            args = {}
-            col_delimiter = kwargs.get('col_delimiter')
-            if col_delimiter is not None:
-                args['col_delimiter'] = col_delimiter
-            output_list = self.process_file_csv(file=file, **args)
-        else:
-            raise GenericException("This file type is not supported (yet)!")
-        return output_list
-
-    def process_file_text(self,
+    def iter_file_text(self,
                  file: TextIOWrapper,
                  label:str,
                  name: str = None,
-                 metadata: dict = None) -> List[schema.Document]:
-        '''Uses langchain's CharacterTextSplitter to convert text contents into document format'''
-        output_list = []
-        loader = TextLoader(file)
-        texts = loader.load()
+                 metadata: dict = None) -> Iterator[DocumentRow]:
+        '''Uses langchain's CharacterTextSplitter to convert text contents into documents.
+        The file is read a window of paragraphs at a time, the last chunk of each window
+        carried over to be merged with the next paragraphs as a whole-file split would'''
         text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-        text_splits = text_splitter.split_documents(texts)
 
         if not label:
             label = "open-access"
         if name is None or name.strip() == "":
-            name = file.name
+            name = default_name(file)
         if metadata is None:
             metadata = {}
-        for i, split in enumerate(text_splits):
-            meta = {}
-            meta.update(split.metadata)
-            meta.update(metadata)
-            doc = schema.Document(
-                docId = f"{name}-{i}",
-                text = split.page_content,
-                label = label,
-                metadata = meta)
-            output_list.append(doc)
-        return output_list
+        meta = {"source": str(file)} # as langchain's TextLoader sets it
+        meta.update(metadata)
+
+        def windows():
+            lines = []
+            size = 0
+            with open(file, 'r', encoding="utf-8") as text_file:
+                for line in text_file:
+                    lines.append(line)
+                    size += len(line)
+                    if size >= SPLIT_WINDOW_CHARS and line.strip() == "":
+                        yield "".join(lines), False
+                        lines = []
+                        size = 0
+            yield "".join(lines), True
+
+        i = 0
+        carry = ""
+        for text, last in windows():
+            chunks = text_splitter.split_text(carry + text)
+            carry = ""
+            if not last and chunks:
+                carry = chunks.pop() + PARAGRAPH_SEPARATOR
+            for chunk in chunks:
+                yield DocumentRow(
+                    docId = f"{name}-{i}",
+                    text = chunk,
+                    label = label,
+                    metadata = dict(meta))
+                i += 1
+
+    def process_file_text(self,
+                 file: TextIOWrapper,
+                 label:str,
+                 name: str = None,
+                 metadata: dict = None) -> List[schema.Document]:
+        '''Uses langchain's CharacterTextSplitter to convert text contents into document format'''
+        return [row.to_document() for row in self.iter_file_text(file, label, name, metadata)]
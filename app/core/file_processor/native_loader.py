@@ -0,0 +1,204 @@
+'''Native implementation for file handling, with a splitter that sizes chunks in tokens
+(or characters), with overlap, cutting at headings, paragraphs and sentences in that order'''
+import os
+import re
+from io import TextIOWrapper
+from typing import Iterable, Iterator, List, Tuple
+
+from core.file_processor import FileProcessorInterface, default_name
+from core.llm_framework.context_packer import count_tokens
+from core.document_batch import DocumentRow
+import schema
+
+
+#pylint: disable=too-few-public-methods, unused-argument
+
+NATIVE_CHUNK_SIZE = int(os.getenv('NATIVE_CHUNK_SIZE', "256"))
+NATIVE_CHUNK_OVERLAP = int(os.getenv('NATIVE_CHUNK_OVERLAP', "32"))
+NATIVE_CHUNK_UNIT = os.getenv('NATIVE_CHUNK_UNIT', "tokens") # or "chars"
+
+HEADING = re.compile(r"#{1,6}(\s|$)") # markdown ATX heading line
+SENTENCE_END = re.compile(r"[.!?]+[\"'”’)\]]*\s+")
+WORD = re.compile(r"\S+\s*|\s+")
+
+# how good a place to cut, the boundary after a piece is. Never right after a heading
+NO_CUT, SENTENCE, PARAGRAPH, SECTION = -1, 0, 1, 2
+
+
+class TextSplitter:
+    '''Splits text into chunks of up to chunk_size tokens (or characters), in one pass.
+    Text is broken into sentences, which are added to the chunk till the next one would not fit.
+    The chunk is then cut before its last heading, or else at its last paragraph end, if that
+    keeps at least half of it, else after the last sentence, but never inside or right after a
+    heading. Up to chunk_overlap of the sentences before the cut start the next chunk, except
+    before a heading.
+    Sentences longer than a chunk are cut between words. Pieces are slices of the paragraph,
+    joined once when the chunk is emitted. Sizes in tokens are summed per sentence, so can be
+    off by a token or so from a count of the whole chunk'''
+    def __init__(self,
+                chunk_size:int = NATIVE_CHUNK_SIZE,
+                chunk_overlap:int = NATIVE_CHUNK_OVERLAP,
+                unit:str = NATIVE_CHUNK_UNIT) -> None:
+        if unit not in ("tokens", "chars"):
+            raise ValueError(f"Chunk unit should be tokens or chars, not {unit}")
+        if not 0 <= chunk_overlap < chunk_size:
+            raise ValueError("Chunk overlap should be less than the chunk size")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.unit = unit
+
+    def length(self, text:str) -> int:
+        '''Size of the text, in the unit of the splitter'''
+        if self.unit == "chars":
+            return len(text)
+        return count_tokens(text)
+
+    def split_text(self, text:str) -> List[str]:
+        '''The chunks of a string'''
+        return [chunk for chunk, _ in self.split_lines(text.splitlines(keepends=True))]
+
+    def split_lines(self, lines:Iterable[str]) -> Iterator[Tuple[str, int]]:
+        '''Yields (chunk, size) for the text of the lines, read as they are needed'''
+        pieces:List[list] = [] # [text, size, boundary after it]
+        total = 0
+        for block, heading in self._blocks(lines):
+            if heading and pieces and pieces[-1][2] != NO_CUT:
+                pieces[-1][2] = SECTION
+            for text, size in self._pieces(block):
+                while total + size > self.chunk_size and pieces:
+                    chunk, pieces = self._cut(pieces, size)
+                    yield chunk
+                    total = sum(piece[1] for piece in pieces)
+                pieces.append([text, size, NO_CUT if heading else SENTENCE])
+                total += size
+            if pieces and not heading:
+                pieces[-1][2] = max(pieces[-1][2], PARAGRAPH)
+        if pieces:
+            yield self._join(pieces)
+
+    def _join(self, pieces:List[list]) -> Tuple[str, int]:
+        return "".join(piece[0] for piece in pieces).strip(), sum(piece[1] for piece in pieces)
+
+    def _cut(self, pieces:List[list], incoming:int) -> Tuple[Tuple[str, int], List[list]]:
+        '''Emits the chunk up to the best boundary. Returns it with the pieces that start
+        the next chunk: the overlap and what was after the boundary'''
+        # after the last piece that is not a heading, unless there are only headings
+        cut = next((index + 1 for index in range(len(pieces) - 1, -1, -1)
+                    if pieces[index][2] != NO_CUT), len(pieces))
+        for level, least in ((SECTION, 0), (PARAGRAPH, self.chunk_size / 2)):
+            size = 0
+            best = None
+            for index, piece in enumerate(pieces[:-1]):
+                size += piece[1]
+                if piece[2] >= level and size >= least:
+                    best = index + 1
+            if best is not None:
+                cut = best
+                break
+        chunk = self._join(pieces[:cut])
+        rest = pieces[cut:]
+        overlap = []
+        if pieces[cut - 1][2] < SECTION:
+            room = min(self.chunk_overlap,
+                self.chunk_size - incoming - sum(piece[1] for piece in rest))
+            size = 0
+            for piece in reversed(pieces[:cut]):
+                if size + piece[1] > room:
+                    break
+                size += piece[1]
+                overlap.append(piece)
+            overlap.reverse()
+        return chunk, overlap + rest
+
+    def _blocks(self, lines:Iterable[str]) -> Iterator[Tuple[str, bool]]:
+        '''Paragraphs, and heading lines on their own, with whether it is a heading'''
+        para:List[str] = []
+        for line in lines:
+            if HEADING.match(line):
+                if para:
+                    yield "".join(para), False
+                    para = []
+                yield line, True
+            elif line.strip() == "":
+                para.append(line)
+                if len(para) > 1:
+                    yield "".join(para), False
+                para = []
+            else:
+                para.append(line)
+        if para:
+            yield "".join(para), False
+
+    def _pieces(self, block:str) -> Iterator[Tuple[str, int]]:
+        '''The sentences of a paragraph with their sizes, those over a chunk cut smaller'''
+        start = 0
+        for match in SENTENCE_END.finditer(block):
+            yield from self._fit(block[start:match.end()])
+            start = match.end()
+        if start < len(block):
+            yield from self._fit(block[start:])
+
+    def _fit(self, text:str) -> Iterator[Tuple[str, int]]:
+        '''The sentence, or if it is over a chunk, its words, so the chunk can be filled up and
+        cut between them'''
+        size = self.length(text)
+        if size <= self.chunk_size:
+            yield text, size
+            return
+        for match in WORD.finditer(text):
+            word = match.group()
+            word_size = self.length(word)
+            if word_size <= self.chunk_size:
+                yield word, word_size
+                continue
+            # no spaces to cut at, as in long URLs or tables. A token is at least a
+            # character, so chunk_size characters fit in either unit
+            for i in range(0, len(word), self.chunk_size):
+                part = word[i:i + self.chunk_size]
+                yield part, self.length(part)
+
+
+class NativeLoader(FileProcessorInterface):
+    '''File handling with the native TextSplitter, reading the file line by line'''
+    def __init__(self,
+                chunk_size:int = NATIVE_CHUNK_SIZE,
+                chunk_overlap:int = NATIVE_CHUNK_OVERLAP,
+                unit:str = NATIVE_CHUNK_UNIT) -> None:
+        self.splitter = TextSplitter(chunk_size, chunk_overlap, unit)
+
+    def iter_file_text(self,
+                 file: TextIOWrapper,
+                 label:str,
+                 name: str = None,
+                 metadata: dict = None) -> Iterator[DocumentRow]:
+        '''Splits text contents into documents of up to chunk_size tokens (or characters).
+        Token counts are kept in the metadata, so they are not counted again by the DB'''
+        if not label:
+            label = "open-access"
+        if name is None or name.strip() == "":
+            name = default_name(file)
+        meta = {"source": str(file)}
+        meta.update(metadata or {})
+
+        with open(file, 'r', encoding="utf-8") as text_file:
+            i = 0
+            for chunk, size in self.splitter.split_lines(text_file):
+                if not chunk:
+                    continue
+                doc_meta = dict(meta)
+                if self.splitter.unit == "tokens":
+                    doc_meta['token_count'] = size
+                yield DocumentRow(
+                    docId=f"{name}-{i}",
+                    text=chunk,
+                    label=label,
+                    metadata=doc_meta)
+                i += 1
+
+    def process_file_text(self,
+                 file: TextIOWrapper,
+                 label:str,
+                 name: str = None,
+                 metadata: dict = None) -> List[schema.Document]:
+        '''Uses the native TextSplitter to convert text contents into document format'''
+        return [row.to_document() for row in self.iter_file_text(file, label, name, metadata)]
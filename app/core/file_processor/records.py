@@ -0,0 +1,149 @@
+'''Documents from a stream of records, NDJSON lines or Arrow IPC record batches, validated
+one record at a time as the ingestion pipeline asks for them. So a load of a million documents
+is never held, or validated, as one request body.
+Precomputed embeddings can come packed: base64 of little endian float32 in NDJSON,
+a binary or fixed size list of float32 column in Arrow'''
+import json
+import base64
+import importlib.util
+from typing import Iterator, List, Optional
+
+import numpy as np
+from pydantic import ValidationError
+
+import schema
+from core.document_batch import DocumentRow
+from custom_exceptions import UnprocessableException
+from log_configs import log
+
+MAX_INVALID_REPORTED = 100 # invalid records listed in the report. All are counted
+
+CONTENT_TYPES = {
+    "application/x-ndjson": schema.RecordFormat.NDJSON,
+    "application/jsonl": schema.RecordFormat.NDJSON,
+}
+# Arrow streams only if pyarrow is installed, else they are refused as an unsupported type
+if importlib.util.find_spec("pyarrow") is not None:
+    CONTENT_TYPES["application/vnd.apache.arrow.stream"] = schema.RecordFormat.ARROW
+
+
+def unpack_embedding(value) -> Optional[np.ndarray]:
+    '''An embedding given as a list of floats, or as packed float32 bytes (or their base64),
+    as a float32 vector'''
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = base64.b64decode(value)
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype="<f4")
+    vector = np.asarray(value, dtype=np.float32)
+    if vector.ndim != 1:
+        raise ValueError("embedding should be a list of numbers")
+    return vector
+
+
+class RecordReader:
+    '''Reads the records of a spooled upload as DocumentRows, each validated as a
+    schema.Document. A record that is not a valid document is skipped and reported, the rest
+    still go in, as is one with an embedding of other dimensions than the first.
+    label is for the records that have none'''
+    def __init__(self,
+                path:str,
+                record_format:schema.RecordFormat,
+                label:Optional[str] = None) -> None:
+        self.path = path
+        self.record_format = schema.RecordFormat(record_format)
+        self.label = label
+        self.records = 0
+        self.invalid = 0
+        self.errors:List[dict] = []
+        self.dimension:Optional[int] = None
+
+    def documents(self) -> Iterator[DocumentRow]:
+        '''The valid documents, in the order of the records'''
+        if self.record_format == schema.RecordFormat.ARROW:
+            records = self._arrow_records()
+        else:
+            records = self._ndjson_records()
+        for record in records:
+            self.records += 1
+            if isinstance(record, Exception):
+                self._invalid(record)
+                continue
+            try:
+                if self.label and not record.get('label'):
+                    record['label'] = self.label
+                # the embedding is checked as a vector, not as a list of floats by pydantic
+                embedding = unpack_embedding(record.pop('embedding', None))
+                doc = schema.Document(**record)
+                self._check_dimension(embedding)
+                yield DocumentRow.from_document(doc)._replace(embedding=embedding)
+            except (ValidationError, ValueError, TypeError) as exe:
+                self._invalid(exe)
+
+    def _check_dimension(self, embedding:Optional[np.ndarray]) -> None:
+        '''The embeddings should all be as long as the first one'''
+        if embedding is None:
+            return
+        if self.dimension is None:
+            self.dimension = len(embedding)
+        elif len(embedding) != self.dimension:
+            raise ValueError(f"embedding has {len(embedding)} dimensions, "
+                f"not {self.dimension} as the first one")
+
+    def _invalid(self, exe:Exception) -> None:
+        self.invalid += 1
+        if len(self.errors) < MAX_INVALID_REPORTED:
+            self.errors.append({"record": self.records, "error": str(exe)})
+        if self.invalid == 1:
+            log.warning("Skipping invalid record %s: %s", self.records, exe)
+
+    def _ndjson_records(self) -> Iterator:
+        with open(self.path, 'rb') as infile:
+            for line in infile:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as exe:
+                    yield exe
+                    continue
+                yield record if isinstance(record, dict) else \
+                    TypeError("Each line should be a JSON object")
+
+    def _arrow_records(self) -> Iterator[dict]:
+        try:
+            import pyarrow.ipc #pylint: disable=import-outside-toplevel
+        except ImportError as exe:
+            raise UnprocessableException(
+                "Arrow uploads need the pyarrow package installed on the server") from exe
+        with pyarrow.OSFile(self.path, 'rb') as infile:
+            try:
+                reader = pyarrow.ipc.open_stream(infile)
+            except pyarrow.ArrowInvalid as exe:
+                raise UnprocessableException(f"Not an Arrow IPC stream: {exe}") from exe
+            for batch in reader:
+                names = [name for name in batch.schema.names if name != 'embedding']
+                columns = [batch.column(name).to_pylist() for name in names]
+                rows = [dict(zip(names, values)) for values in zip(*columns)] if names \
+                    else [{} for _ in range(batch.num_rows)]
+                if 'embedding' in batch.schema.names:
+                    vectors = self._arrow_embeddings(pyarrow, batch.column('embedding'))
+                    for row, vector in zip(rows, vectors):
+                        row['embedding'] = vector
+                yield from rows
+
+    @staticmethod
+    def _arrow_embeddings(pyarrow, column) -> Iterator:
+        '''A fixed size list of float32 column is read as one matrix, without going
+        through Python floats a value at a time'''
+        if pyarrow.types.is_fixed_size_list(column.type) and column.null_count == 0:
+            matrix = column.flatten().to_numpy(zero_copy_only=False).reshape(
+                len(column), column.type.list_size)
+            return iter(matrix.astype(np.float32, copy=False))
+        return iter(column.to_pylist())
+
+    def report(self) -> dict:
+        '''Counts of the records read and the invalid ones, with the first errors'''
+        return {"records": self.records, "invalid_records": self.invalid,
+            "invalid_record_errors": self.errors}
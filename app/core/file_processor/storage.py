@@ -0,0 +1,95 @@
+'''Streams uploaded files to disk in fixed size chunks, with bounded memory.
+Files are stored under the sha256 of their contents, so a re-uploaded file is found
+without comparing anything, and the client supplied name never becomes a path'''
+import os
+import codecs
+import asyncio
+import hashlib
+import tempfile
+from typing import AsyncIterator, NamedTuple
+
+from fastapi import UploadFile
+
+from custom_exceptions import UnprocessableException, PayloadTooLargeException
+from log_configs import log
+
+UPLOAD_PATH = "./uploaded-files/"
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', str(1024 * 1024 * 1024)))
+
+
+class StoredUpload(NamedTuple):
+    '''Where an upload was saved, and whether the same contents were there already'''
+    path: str
+    sha256: str
+    size: int
+    duplicate: bool
+
+
+async def save_upload(file_obj:UploadFile,
+    upload_path:str = UPLOAD_PATH,
+    text:bool = True,
+    max_bytes:int = MAX_UPLOAD_BYTES,
+    chunk_size:int = UPLOAD_CHUNK_BYTES) -> StoredUpload:
+    '''Copies the upload to `upload_path`/<sha256><extension>, a chunk at a time.
+    Text uploads are checked to be UTF-8 as they stream, with an incremental decoder,
+    so a chunk boundary inside a character is fine'''
+    async def chunks():
+        while True:
+            chunk = await file_obj.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    stored = await save_stream(chunks(), os.path.splitext(file_obj.filename or "")[1].lower(),
+        upload_path, text=text, max_bytes=max_bytes)
+    if stored.duplicate:
+        log.info("Upload %s has the same contents as %s", file_obj.filename, stored.path)
+    return stored
+
+
+async def save_stream(chunks:AsyncIterator[bytes],
+    extension:str = "",
+    upload_path:str = UPLOAD_PATH,
+    text:bool = True,
+    max_bytes:int = MAX_UPLOAD_BYTES) -> StoredUpload:
+    '''Writes the chunks, as of a raw request body, to `upload_path`/<sha256><extension>.
+    Same checks as save_upload()'''
+    os.makedirs(upload_path, exist_ok=True)
+    sha = hashlib.sha256()
+    decoder = codecs.getincrementaldecoder("utf-8")() if text else None
+    size = 0
+    chunk = b""
+    with tempfile.NamedTemporaryFile(dir=upload_path, suffix=".part", delete=False) as tmp:
+        def store(chunk:bytes) -> None:
+            # Checked, hashed and written off the event loop, a chunk being a megabyte
+            if decoder is not None:
+                decoder.decode(chunk)
+            sha.update(chunk)
+            tmp.write(chunk)
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise PayloadTooLargeException(
+                        f"Upload is larger than the limit of {max_bytes} bytes")
+                await asyncio.to_thread(store, chunk)
+            if decoder is not None:
+                decoder.decode(b"", final=True)
+        except UnicodeDecodeError as exe:
+            tmp.close()
+            os.remove(tmp.name)
+            raise UnprocessableException(
+                f"Uploaded file is not valid UTF-8, at byte {size - len(chunk) + exe.start}"
+                ) from exe
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    digest = sha.hexdigest()
+    path = os.path.join(upload_path, digest + extension)
+    duplicate = os.path.exists(path)
+    if duplicate:
+        os.remove(tmp.name)
+    else:
+        os.replace(tmp.name, path)
+    return StoredUpload(path=path, sha256=digest, size=size, duplicate=duplicate)
@@ -0,0 +1,162 @@
+'''Persistent queue of background jobs, kept in SQLite so they survive app restarts.
+The app enqueues jobs and reads their status, worker processes claim and run them'''
+import os
+import json
+import time
+import sqlite3
+from contextlib import contextmanager
+from typing import Optional
+
+import schema
+
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', "./jobs.sqlite3")
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress TEXT,
+    output TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    worker_pid INTEGER,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL)'''
+
+
+class JobCancelled(Exception):
+    '''Raised inside a job to stop it, when its cancellation was asked for'''
+
+
+def pid_alive(pid:int) -> bool:
+    '''Whether a process with the pid is running on this host'''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    '''The jobs table. Every method uses its own connection, so it can be shared
+    across threads and used from any process'''
+    def __init__(self, path:str = JOB_DB_PATH) -> None:
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, kind:str, params:dict) -> int:
+        '''Adds a job and returns its id'''
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (kind, params, status, created) VALUES (?, ?, ?, ?)",
+                (kind, json.dumps(params, sort_keys=True), schema.JobStatus.QUEUED.value,
+                    time.time()))
+            return cursor.lastrowid
+
+    def find_same(self, kind:str, params:dict) -> Optional[dict]:
+        '''The latest job of the kind, with the same params, that is queued, running or
+        finished. None if there is none, or they all failed or were cancelled'''
+        with self._connect() as conn:
+            row = conn.execute("SELECT id FROM jobs WHERE kind = ? AND params = ?"
+                " AND status IN (?, ?, ?) ORDER BY id DESC LIMIT 1",
+                (kind, json.dumps(params, sort_keys=True), schema.JobStatus.QUEUED.value,
+                    schema.JobStatus.STARTED.value, schema.JobStatus.FINISHED.value)
+                ).fetchone()
+        return None if row is None else self.get(row['id'])
+
+    def claim(self) -> Optional[sqlite3.Row]:
+        '''Marks the oldest queued job as started by this process, and returns it'''
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM jobs WHERE status = ? ORDER BY id LIMIT 1",
+                (schema.JobStatus.QUEUED.value,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE jobs SET status = ?, worker_pid = ?, started = ? WHERE id = ?",
+                (schema.JobStatus.STARTED.value, os.getpid(), time.time(), row['id']))
+            conn.execute("COMMIT")
+            return row
+
+    def update_progress(self, job_id:int, progress:dict) -> bool:
+        '''Saves the progress. Returns whether cancellation of the job was asked for'''
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET progress = ? WHERE id = ?",
+                (json.dumps(progress), job_id))
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()
+        return bool(row and row['cancel_requested'])
+
+    def finish(self, job_id:int, status:schema.JobStatus, output:dict) -> None:
+        '''Records the end of a job'''
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, output = ?, finished = ? WHERE id = ?",
+                (status.value, json.dumps(output), time.time(), job_id))
+
+    def cancel(self, job_id:int) -> Optional[dict]:
+        '''A queued job is cancelled at once, a started one at its next progress update.
+        Returns the job, None if there is no such job'''
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                (schema.JobStatus.CANCELLED.value, time.time(), job_id,
+                    schema.JobStatus.QUEUED.value))
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?",
+                (job_id, schema.JobStatus.STARTED.value))
+        return self.get(job_id)
+
+    def requeue_interrupted(self) -> int:
+        '''Puts back in the queue the started jobs whose worker process is gone,
+        as after a restart. Returns how many'''
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, worker_pid FROM jobs WHERE status = ?",
+                (schema.JobStatus.STARTED.value,)).fetchall()
+            orphans = [row['id'] for row in rows
+                        if row['worker_pid'] is None or not pid_alive(row['worker_pid'])]
+            for job_id in orphans:
+                conn.execute("UPDATE jobs SET status = ?, worker_pid = NULL WHERE id = ?",
+                    (schema.JobStatus.QUEUED.value, job_id))
+        return len(orphans)
+
+    def finished_after(self, since:float) -> list:
+        '''(finish time, output) of the jobs that finished successfully after `since`'''
+        with self._connect() as conn:
+            rows = conn.execute("SELECT finished, output FROM jobs WHERE finished > ?"
+                " AND status = ? ORDER BY finished",
+                (since, schema.JobStatus.FINISHED.value)).fetchall()
+        return [(row['finished'], json.loads(row['output'] or "{}")) for row in rows]
+
+    def recent(self, kind:str, limit:int = 20) -> list:
+        '''The latest jobs of the kind that finished or failed, the latest last'''
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id FROM jobs WHERE kind = ? AND status IN (?, ?)"
+                " ORDER BY finished DESC LIMIT ?",
+                (kind, schema.JobStatus.FINISHED.value, schema.JobStatus.FAILED.value, limit)
+                ).fetchall()
+        return [self.get(row['id']) for row in reversed(rows)]
+
+    def get(self, job_id:int) -> Optional[dict]:
+        '''The job in the shape of schema.Job, None if there is no such job'''
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        output = json.loads(row['output']) if row['output'] else {}
+        if row['progress']:
+            output.setdefault('progress', json.loads(row['progress']))
+        if row['cancel_requested'] and row['status'] == schema.JobStatus.STARTED.value:
+            output['cancel_requested'] = True
+        return {"jobId": row['id'], "status": row['status'], "output": output}
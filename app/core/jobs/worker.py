@@ -0,0 +1,181 @@
+'''Worker processes that claim jobs from the JobStore and run them'''
+import os
+import json
+import time
+import atexit
+import tempfile
+import multiprocessing
+from typing import Callable, Dict
+
+import schema
+from core.jobs import JobStore, JobCancelled
+from core.rate_limiter import openai_scheduler
+from log_configs import log
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', "2"))
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', "0.5"))
+PROGRESS_INTERVAL = 1.0 # seconds between progress saves, which also check for cancellation
+POSTGRES_DB_PASSWORD = os.getenv('POSTGRES_DB_PASSWORD', 'secret')
+
+# kind of job: function(params, progress) returning the output to be saved
+HANDLERS:Dict[str, Callable[[dict, Callable[[dict], None]], dict]] = {}
+
+def handler(kind:str):
+    '''Registers the function that runs the jobs of this kind'''
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def build_upload_stack(params:dict):
+    '''The DataUploadPipeline described by the upload job params'''
+    #pylint: disable=import-outside-toplevel
+    from core.pipeline import DataUploadPipeline
+    from core.vectordb.postgres4langchain import Postgres
+    from core.embedding.openai import OpenAIEmbedding
+
+    vectordb_type = schema.DatabaseType(params['vectordb_type'])
+    if params.get('postgres_openai_vectordb'):
+        data_stack = DataUploadPipeline(
+            vectordb=Postgres(
+                embedding=OpenAIEmbedding(
+                    api_key=os.getenv('OPENAI_API_KEY'),
+                    model='text-embedding-ada-002')
+                ),
+        )
+    else:
+        vectordb_args = dict(params.get('vectordb_args', {}))
+        if vectordb_type == schema.DatabaseType.POSTGRES:
+            # not saved with the job, when it is the configured one
+            vectordb_args.setdefault('password', POSTGRES_DB_PASSWORD)
+        data_stack = DataUploadPipeline()
+        data_stack.set_vectordb(vectordb_type, **vectordb_args)
+    if params.get('file_processor_type'):
+        data_stack.set_file_processor(schema.FileProcessorType(params['file_processor_type']))
+    if params.get('embedding_type'):
+        data_stack.set_embedding(schema.EmbeddingType(params['embedding_type']))
+    return data_stack
+
+
+@handler("upload")
+def run_upload(params:dict, progress:Callable[[dict], None]) -> dict:
+    '''Ingests the uploaded file, archive, record stream, or the documents, saved with the job'''
+    #pylint: disable=import-outside-toplevel
+    from core.file_processor.bulk import extract_archive
+    from core.file_processor.records import RecordReader
+    from core.document_batch import DocumentRow
+
+    data_stack = build_upload_stack(params)
+    if params.get('archive'):
+        with tempfile.TemporaryDirectory(prefix="upload-") as directory:
+            extract_archive(params['archive'], directory)
+            return data_stack.run_directory(directory,
+                label=params.get('label'),
+                embed=bool(params.get('embedding_type')),
+                progress=progress,
+                source_prefix=params.get('source_prefix', ""),
+                **params.get('process_args', {}))
+    if params.get('records'):
+        reader = RecordReader(params['records'], params['record_format'],
+            label=params.get('label'))
+        stats = data_stack.run(reader.documents(),
+            embed=bool(params.get('embedding_type')),
+            progress=lambda stats: progress({**stats, **reader.report()}))
+        stats.update(reader.report())
+        return stats
+    if params.get('source'):
+        source = params['source']
+    else:
+        # validated by the API when the job was made
+        source = [DocumentRow.from_dict(doc) for doc in params['documents']]
+    return data_stack.run(source,
+        label=params.get('label'),
+        file_type=schema.FileType(params.get('file_type', schema.FileType.TEXT.value)),
+        embed=bool(params.get('embedding_type')),
+        progress=progress,
+        **params.get('process_args', {}))
+
+
+def run_job(store:JobStore, job) -> None:
+    '''Runs a claimed job and records how it ended. A failed job keeps the stats
+    it last reported, for the ingestion metrics'''
+    last_saved = [0.0]
+    latest = {}
+    def progress(stats:dict) -> None:
+        latest.update(stats)
+        now = time.monotonic()
+        if now - last_saved[0] < PROGRESS_INTERVAL:
+            return
+        last_saved[0] = now
+        if store.update_progress(job['id'], stats):
+            raise JobCancelled(f"Job {job['id']} cancelled")
+
+    log.info("Starting job %s (%s)", job['id'], job['kind'])
+    try:
+        output = HANDLERS[job['kind']](json.loads(job['params']), progress)
+        store.finish(job['id'], schema.JobStatus.FINISHED, output)
+        log.info("Finished job %s", job['id'])
+    except JobCancelled:
+        store.finish(job['id'], schema.JobStatus.CANCELLED, {})
+        log.info("Cancelled job %s", job['id'])
+    except Exception as exe: #pylint: disable=broad-exception-caught
+        log.exception(exe)
+        store.finish(job['id'], schema.JobStatus.FAILED, {**latest,
+            "error": getattr(exe, "name", type(exe).__name__),
+            "details": str(getattr(exe, "detail", exe))})
+
+
+def work(db_path:str, stop) -> None:
+    '''The loop of a worker process: claim the oldest queued job, run it, repeat.
+    Its OpenAI requests draw on the rate budgets kept in the job DB, with the app's.
+    Ends when stopped, or when the app process is gone'''
+    openai_scheduler.set_path(db_path)
+    store = JobStore(db_path)
+    parent = os.getppid()
+    while not stop.is_set() and os.getppid() == parent:
+        job = store.claim()
+        if job is None:
+            stop.wait(JOB_POLL_SECONDS)
+            continue
+        run_job(store, job)
+
+
+class WorkerPool:
+    '''The worker processes of the app. Started and stopped with it'''
+    def __init__(self, db_path:str, workers:int = JOB_WORKERS) -> None:
+        self.db_path = db_path
+        self.workers = workers
+        self.context = multiprocessing.get_context("spawn")
+        self.stop_event = None
+        self.processes = []
+
+    def start(self) -> None:
+        '''Requeues the jobs interrupted by a restart and starts the workers.
+        The app and the workers share the OpenAI rate budgets, kept in the job DB'''
+        requeued = JobStore(self.db_path).requeue_interrupted()
+        if requeued:
+            log.info("Requeued %s interrupted jobs", requeued)
+        openai_scheduler.set_path(self.db_path)
+        self.stop_event = self.context.Event()
+        # not daemons, as archive uploads parse their files in a pool of child processes
+        self.processes = [self.context.Process(target=work,
+                            args=(self.db_path, self.stop_event),
+                            name=f"job-worker-{i}")
+                          for i in range(self.workers)]
+        for process in self.processes:
+            process.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout:float = 10) -> None:
+        '''Waits a while for the running jobs, then stops the workers.
+        A job cut short is requeued on the next start'''
+        if self.stop_event is None:
+            return
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        self.stop_event = None
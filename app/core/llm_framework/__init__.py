@@ -1,6 +1,7 @@
 '''Interface definition and common implemetations for lmm framework classes'''
 import os
-from typing import List, Tuple
+import asyncio
+from typing import List, Tuple, Callable, Awaitable
 from abc import abstractmethod, ABC
 import schema
 
@@ -12,6 +13,7 @@ class LLMFrameworkInterface(ABC):
     model_name: str
     api_object = None
     llm = None
+    answer_cache = None # optional SemanticCache consulted before calling the LLM
 
     def __init__(self, key:str, **kwargs) -> None:
         '''Sets the API key and initializes library objects if any'''
@@ -25,3 +27,39 @@ class LLMFrameworkInterface(ABC):
         **kwargs) -> dict:
         '''Prompt completion for QA or Chat reponse, based on specific documents, if provided'''
         return {}
+
+    async def agenerate_text(self,
+        query:str,
+        chat_history:List[Tuple[str,str]],
+        **kwargs) -> dict:
+        '''Async prompt completion. Implementations should use the async APIs of their
+        library, this default only moves the blocking call off the event loop'''
+        return await asyncio.to_thread(self.generate_text,
+            query=query, chat_history=chat_history, **kwargs)
+
+    async def stream_text(self,
+        query:str,
+        chat_history:List[Tuple[str,str]],
+        token_callback:Callable[[str], Awaitable[None]],
+        **kwargs) -> dict:
+        '''Prompt completion like generate_text, awaiting token_callback with each piece of
+        the answer as it is generated. Returns the complete response at the end.
+        Implementations without token streaming send the whole answer as one piece.'''
+        response = await self.agenerate_text(query=query, chat_history=chat_history, **kwargs)
+        await token_callback(response['answer'])
+        return response
+
+    async def asummarize_history(self,
+        summary:str,
+        chat_history:List[Tuple[str,str]]) -> str:
+        '''Folds the exchanges into the running summary of the conversation.
+        Implementations should use the LLM, this default only abbreviates the exchanges'''
+        lines = [summary] if summary else []
+        lines.extend(f"Asked: {human} Answered: {ai[:200]}" for human, ai in chat_history)
+        return "\n".join(lines)
+
+    def condense_question(self,
+        query:str,
+        chat_history:List[Tuple[str,str]]) -> str:
+        '''Rephrase the query, with the chat history, into a standalone question'''
+        return query
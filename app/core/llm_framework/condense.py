@@ -0,0 +1,110 @@
+'''Strategies for turning a follow up question into a standalone question, with as few
+LLM calls as possible'''
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Tuple
+
+import schema
+
+#pylint: disable=too-few-public-methods
+
+CONDENSE_CACHE_SIZE = int(os.getenv('CONDENSE_CACHE_SIZE', "256"))
+
+# Words that usually point back to something said earlier in the conversation
+REFERRING_WORDS = {"he", "she", "it", "they", "him", "her", "them", "his", "hers", "its",
+    "their", "theirs", "this", "that", "these", "those", "there", "then", "one", "ones",
+    "else", "more", "also", "again", "same", "above", "previous", "earlier", "former",
+    "latter", "other", "another", "why", "how", "so"}
+MIN_SELF_CONTAINED_WORDS = 4
+
+WORD_PATTERN = re.compile(r"[a-z']+")
+
+
+def is_self_contained(query: str) -> bool:
+    '''Cheap check whether a question can be understood without the chat history'''
+    words = WORD_PATTERN.findall(query.lower())
+    if len(words) < MIN_SELF_CONTAINED_WORDS:
+        return False
+    return not any(word in REFERRING_WORDS for word in words)
+
+
+def history_digest(chat_history: List[Tuple[str, str]]) -> str:
+    '''A short stable key for the chat history'''
+    sha = hashlib.sha1()
+    for human, answer in chat_history:
+        sha.update(human.encode("utf-8"))
+        sha.update(b"\x00")
+        sha.update(answer.encode("utf-8"))
+        sha.update(b"\x01")
+    return sha.hexdigest()
+
+
+class QuestionCondenser:
+    '''Decides, per turn, if the condense LLM call is needed and remembers the rewrites.
+    `chain` is an LLMChain taking `question` and `chat_history`, `format_history`
+    converts the chat history to the text the chain's prompt expects'''
+    def __init__(self,
+                chain,
+                format_history,
+                strategy: schema.CondenseStrategy = schema.CondenseStrategy.ALWAYS,
+                cache_size: int = CONDENSE_CACHE_SIZE) -> None:
+        self.chain = chain
+        self.format_history = format_history
+        self.strategy = strategy
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _precheck(self, query: str, chat_history: List[Tuple[str, str]]):
+        '''Returns (standalone question or None, cache key or None)'''
+        if len(chat_history) == 0:
+            return query, None
+        if self.strategy == schema.CondenseStrategy.ALWAYS:
+            return None, None
+        if is_self_contained(query):
+            return query, None
+        if self.strategy == schema.CondenseStrategy.CACHED:
+            key = (history_digest(chat_history), query)
+            with self._lock:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    return self._cache[key], None
+            return None, key
+        return None, None
+
+    def _remember(self, key, question: str) -> None:
+        '''Stores the rewrite of a question for a chat history'''
+        if key is None:
+            return
+        with self._lock:
+            self._cache[key] = question
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def needs_llm(self, query: str, chat_history: List[Tuple[str, str]]) -> bool:
+        '''Whether condensing this question would make an LLM call'''
+        return self._precheck(query, chat_history)[0] is None
+
+    def condense(self, query: str, chat_history: List[Tuple[str, str]]) -> Tuple[str, int]:
+        '''Returns the standalone question and the number of LLM calls made for it'''
+        question, key = self._precheck(query, chat_history)
+        if question is not None:
+            return question, 0
+        question = self.chain.run(question=query,
+            chat_history=self.format_history(chat_history))
+        self._remember(key, question)
+        return question, 1
+
+    async def acondense(self, query: str,
+        chat_history: List[Tuple[str, str]]) -> Tuple[str, int]:
+        '''Async version of condense'''
+        question, key = self._precheck(query, chat_history)
+        if question is not None:
+            return question, 0
+        question = await self.chain.arun(question=query,
+            chat_history=self.format_history(chat_history))
+        self._remember(key, question)
+        return question, 1
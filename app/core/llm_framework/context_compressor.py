@@ -0,0 +1,76 @@
+'''Extractive compression of retrieved documents, keeping only the sentences relevant
+to the query'''
+import os
+import re
+from typing import List
+
+import numpy as np
+
+import schema
+from core.embedding import EmbeddingInterface
+from log_configs import log
+
+#pylint: disable=too-few-public-methods
+
+COMPRESSION_MAX_SENTENCES = int(os.getenv('COMPRESSION_MAX_SENTENCES', "12"))
+COMPRESSION_MIN_SCORE = float(os.getenv('COMPRESSION_MIN_SCORE', "0.2"))
+
+# Sentence ends, or line breaks, as markdown lists and headings have no full stops
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?;])\s+|\s*\n+\s*")
+
+
+def split_sentences(text:str) -> List[str]:
+    '''Splits text into sentences, dropping empty pieces'''
+    return [sent for sent in SENTENCE_BOUNDARY.split(text) if sent and not sent.isspace()]
+
+
+class ContextCompressor:
+    '''Scores every sentence of the retrieved documents against the query in one batch,
+    and keeps the best `max_sentences` of them, in their original order and documents'''
+    def __init__(self,
+                embedding:EmbeddingInterface,
+                max_sentences:int = COMPRESSION_MAX_SENTENCES,
+                min_score:float = COMPRESSION_MIN_SCORE) -> None:
+        self.embedding = embedding
+        self.max_sentences = max_sentences
+        self.min_score = min_score
+
+    def _embed(self, texts:List[str]) -> np.ndarray:
+        '''Row normalized embedding matrix for the texts'''
+        docs = [schema.Document(docId=str(i), text=text) for i, text in enumerate(texts)]
+        self.embedding.get_embeddings(docs)
+        matrix = np.asarray([doc.embedding for doc in docs], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    def compress(self, query:str, docs:list) -> list: #pylint: disable=too-many-locals
+        '''Returns new documents holding only the selected sentences. Metadata, like the source
+        id, is kept. Documents with no selected sentences are dropped'''
+        sentences, owners = [], []
+        for doc_index, doc in enumerate(docs):
+            for sentence in split_sentences(doc.page_content):
+                sentences.append(sentence)
+                owners.append(doc_index)
+        if len(sentences) <= self.max_sentences:
+            return docs
+        vectors = self._embed([query] + sentences)
+        scores = vectors[1:] @ vectors[0]
+        top = np.argpartition(-scores, self.max_sentences - 1)[:self.max_sentences]
+        keep = np.zeros(len(sentences), dtype=bool)
+        keep[top] = True
+        keep &= scores >= self.min_score
+
+        kept = [[] for _ in docs]
+        for index in np.flatnonzero(keep):
+            kept[owners[index]].append(sentences[index])
+        output = []
+        for doc, doc_sentences in zip(docs, kept):
+            if not doc_sentences:
+                continue
+            meta = dict(doc.metadata)
+            meta.pop("token_count", None) # no longer matches the text
+            output.append(doc.__class__(page_content=" ".join(doc_sentences), metadata=meta))
+        log.info("Context compression kept %s of %s sentences from %s of %s documents",
+            int(keep.sum()), len(sentences), len(output), len(docs))
+        return output
@@ -0,0 +1,93 @@
+'''Fits retrieved documents and chat history into a fixed token budget for the prompt'''
+import os
+from functools import lru_cache
+from typing import List, Tuple
+
+from log_configs import log
+
+#pylint: disable=too-few-public-methods
+
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', "2500"))
+# Tokens taken by the fixed instructions in the prompt templates
+PROMPT_TEMPLATE_TOKENS = int(os.getenv('PROMPT_TEMPLATE_TOKENS', "150"))
+TOKENIZER_MODEL = os.getenv('TOKENIZER_MODEL', "gpt-3.5-turbo")
+CHARS_PER_TOKEN = 4 # rough average for English, used when tiktoken is not installed
+
+
+@lru_cache(maxsize=8)
+def get_tokenizer(model_name:str=TOKENIZER_MODEL):
+    '''The tiktoken encoding for the model, loaded once. None if tiktoken is not available'''
+    try:
+        import tiktoken #pylint: disable=import-outside-toplevel
+    except ImportError:
+        log.warning("tiktoken not installed. Token counts will be estimated from text length")
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text:str, model_name:str=TOKENIZER_MODEL) -> int:
+    '''Number of tokens the text takes in a prompt'''
+    tokenizer = get_tokenizer(model_name)
+    if tokenizer is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+def document_tokens(doc, model_name:str=TOKENIZER_MODEL) -> int:
+    '''Token count of a retrieved document, using the count stored at ingestion when present'''
+    token_count = doc.metadata.get("token_count")
+    if token_count is None:
+        return count_tokens(doc.page_content, model_name)
+    return int(token_count)
+
+
+class ContextPacker:
+    '''Greedily selects what goes into the prompt, in the order of relevance:
+    the latest exchange, then documents by their retrieval rank, then older exchanges.
+    Anything that does not fit the remaining budget is skipped'''
+    def __init__(self,
+                budget:int = PROMPT_TOKEN_BUDGET,
+                model_name:str = TOKENIZER_MODEL,
+                template_tokens:int = PROMPT_TEMPLATE_TOKENS) -> None:
+        self.budget = budget
+        self.model_name = model_name
+        self.template_tokens = template_tokens
+
+    def pack(self,
+        query:str,
+        docs:list,
+        chat_history:List[Tuple[str,str]] = None) -> Tuple[list, List[Tuple[str,str]], int]:
+        '''Returns (documents, chat history, prompt tokens) that fit the budget.
+        The selected documents and exchanges keep their original order'''
+        chat_history = chat_history or []
+        used = self.template_tokens + count_tokens(query, self.model_name)
+        candidates = []
+        if chat_history:
+            candidates.append(("history", len(chat_history)-1))
+        candidates.extend(("doc", i) for i in range(len(docs)))
+        candidates.extend(("history", i) for i in range(len(chat_history)-2, -1, -1))
+
+        selected_docs, selected_history = set(), set()
+        for kind, index in candidates:
+            if kind == "doc":
+                tokens = document_tokens(docs[index], self.model_name)
+            else:
+                human, answer = chat_history[index]
+                tokens = count_tokens(human, self.model_name) + \
+                    count_tokens(answer, self.model_name)
+            if used + tokens > self.budget:
+                continue
+            used += tokens
+            if kind == "doc":
+                selected_docs.add(index)
+            else:
+                selected_history.add(index)
+        if len(selected_docs) < len(docs):
+            log.info("Context packing kept %s of %s documents in %s tokens",
+                len(selected_docs), len(docs), used)
+        return ([doc for i, doc in enumerate(docs) if i in selected_docs],
+                [item for i, item in enumerate(chat_history) if i in selected_history],
+                used)
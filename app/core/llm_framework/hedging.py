@@ -0,0 +1,161 @@
+'''Hedged chat completion requests, to cut the tail latency of the LLM API.
+If the first token has not arrived within a delay taken from the recent first token latencies,
+a duplicate request is sent, optionally to a fallback model, and the first to answer is used'''
+import os
+import time
+import asyncio
+from collections import deque
+from typing import AsyncIterator, List, Optional
+
+import numpy as np
+import openai
+
+from core.rate_limiter import openai_scheduler, EndpointType, Priority
+from core.openai_client import OpenAIHttpClient, openai_http
+from core.llm_framework.context_packer import count_tokens
+from log_configs import log
+
+#pylint: disable=too-many-instance-attributes
+
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', "95"))
+HEDGE_INITIAL_DELAY = float(os.getenv('HEDGE_INITIAL_DELAY', "3.0")) # seconds
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', "0.5")) # seconds
+HEDGE_MIN_SAMPLES = 20 # before the percentile is trusted over the initial delay
+HEDGE_FALLBACK_MODEL = os.getenv('HEDGE_FALLBACK_MODEL')
+ANSWER_TOKENS_ESTIMATE = 500 # counted against the token budget along with the prompt
+
+
+async def stream_chat_completion(model:str, messages:List[dict],
+    http_client:OpenAIHttpClient = openai_http, **kwargs) -> AsyncIterator[str]:
+    '''Pieces of content from a streaming chat completion'''
+    tokens = sum(count_tokens(message['content']) for message in messages)
+    http_client.use_async()
+    kwargs = {**http_client.request_args(), **kwargs}
+    response = await openai_scheduler.acall(EndpointType.CHAT, openai.ChatCompletion.acreate,
+        model=model, messages=messages, stream=True,
+        tokens=tokens + ANSWER_TOKENS_ESTIMATE, priority=Priority.INTERACTIVE, **kwargs)
+    async for chunk in response:
+        content = chunk['choices'][0]['delta'].get('content')
+        if content:
+            yield content
+
+
+class _Attempt: #pylint: disable=too-few-public-methods
+    '''One request of a hedged call, with the task waiting for its first token'''
+    def __init__(self, model:str, messages:List[dict], **kwargs) -> None:
+        self.model = model
+        self.stream = stream_chat_completion(model, messages, **kwargs)
+        self.first = asyncio.create_task(self._first_token())
+
+    async def _first_token(self) -> Optional[str]:
+        try:
+            return await self.stream.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def cancel(self) -> None:
+        '''Abandons the request'''
+        self.first.cancel()
+        try:
+            await self.first
+        except BaseException: #pylint: disable=broad-exception-caught
+            pass
+        try:
+            await self.stream.aclose()
+        except Exception: #pylint: disable=broad-exception-caught
+            pass
+
+
+class HedgedChatCompletion:
+    '''Streaming chat completion with hedging. Keeps the recent first token latencies to set
+    the hedge delay, and counts how often a hedge was sent and how often it won'''
+    def __init__(self, #pylint: disable=too-many-arguments
+                model_name:str,
+                fallback_model_name:Optional[str] = HEDGE_FALLBACK_MODEL,
+                percentile:float = HEDGE_PERCENTILE,
+                initial_delay:float = HEDGE_INITIAL_DELAY,
+                min_delay:float = HEDGE_MIN_DELAY,
+                window:int = 200) -> None:
+        self.model_name = model_name
+        self.fallback_model_name = fallback_model_name or model_name
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self) -> float:
+        '''Seconds to wait for the first token before sending the hedge request'''
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return self.initial_delay
+        return max(self.min_delay, float(np.percentile(self.latencies, self.percentile)))
+
+    def stats(self) -> dict:
+        '''Hedge rate and the rate at which the hedge request answered first'''
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "hedge_rate": self.hedged / self.requests if self.requests else 0.0,
+            "win_rate": self.hedge_wins / self.hedged if self.hedged else 0.0,
+            "hedge_delay": self.hedge_delay(),
+        }
+
+    async def _race(self, messages:List[dict], **kwargs) -> _Attempt:
+        '''Returns the attempt that produced the first token, with the other one cancelled'''
+        primary = _Attempt(self.model_name, messages, **kwargs)
+        done, _ = await asyncio.wait({primary.first}, timeout=self.hedge_delay())
+        if done:
+            return primary
+        self.hedged += 1
+        log.info("No first token in %.2fs, hedging with %s",
+            self.hedge_delay(), self.fallback_model_name)
+        hedge = _Attempt(self.fallback_model_name, messages, **kwargs)
+        attempts = {primary.first: primary, hedge.first: hedge}
+        pending = set(attempts)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = attempts[task]
+                    loser = hedge if winner is primary else primary
+                    await loser.cancel()
+                    if winner is hedge:
+                        self.hedge_wins += 1
+                    return winner
+                log.warning("Hedged request to %s failed: %s",
+                    attempts[task].model, task.exception())
+        # Both failed, raise the primary's error
+        return primary
+
+    async def astream(self, messages:List[dict], **kwargs) -> AsyncIterator[str]:
+        '''Pieces of the answer, from whichever request started answering first'''
+        self.requests += 1
+        started = time.monotonic()
+        winner = await self._race(messages, **kwargs)
+        first = await winner.first
+        # from the start of the request, not of the hedge, which is later by the hedge delay
+        self.latencies.append(time.monotonic() - started)
+        if first is None:
+            return
+        yield first
+        async for content in winner.stream:
+            yield content
+
+    async def acreate(self, messages:List[dict], **kwargs) -> str:
+        '''The complete answer, from whichever request started answering first'''
+        return "".join([content async for content in self.astream(messages, **kwargs)])
+
+
+_HEDGED_COMPLETIONS = {}
+
+def get_hedged_completion(model_name:str,
+    fallback_model_name:Optional[str] = HEDGE_FALLBACK_MODEL) -> HedgedChatCompletion:
+    '''A HedgedChatCompletion shared by all sessions using the models,
+    so they learn the hedge delay together'''
+    key = (model_name, fallback_model_name)
+    if key not in _HEDGED_COMPLETIONS:
+        _HEDGED_COMPLETIONS[key] = HedgedChatCompletion(model_name, fallback_model_name)
+    return _HEDGED_COMPLETIONS[key]
@@ -1,22 +1,105 @@
 '''Implemetations for lmm_framework interface using langchain'''
 import os
-from typing import List, Tuple
+import asyncio
+from typing import List, Tuple, Callable, Awaitable, Optional
+import numpy as np
+import openai
 from langchain.chat_models import ChatOpenAI
 # from langchain.llms import OpenAI
-from langchain.chains import ConversationalRetrievalChain
+from langchain.chains import ConversationalRetrievalChain, LLMChain
+from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
+from langchain.chains.question_answering import load_qa_chain
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
+from langchain.prompts import PromptTemplate
 # from langchain.memory import ConversationBufferMemory
 
 from core.llm_framework import LLMFrameworkInterface
 from core.vectordb import VectordbInterface
 from core.vectordb.chroma4langchain import Chroma
+from core.embedding import EmbeddingInterface
+from core.embedding.sentence_transformers import shared_embedding
+
+from core.llm_framework.semantic_cache import SemanticCache
+from core.llm_framework.condense import QuestionCondenser
+from core.llm_framework.context_packer import ContextPacker
+from core.llm_framework.context_compressor import ContextCompressor
+from core.llm_framework.hedging import ANSWER_TOKENS_ESTIMATE
+from core.llm_framework.context_packer import count_tokens
+from core.rate_limiter import openai_scheduler, EndpointType, Priority
+from core.openai_client import OpenAIHttpClient, openai_http
+import schema
 
 from custom_exceptions import AccessException, OpenAIException
 from log_configs import log
 
+SPECULATIVE_RETRIEVAL_THRESHOLD = float(os.getenv('SPECULATIVE_RETRIEVAL_THRESHOLD', "0.9"))
+
+SUMMARIZE_HISTORY_PROMPT = PromptTemplate.from_template(
+    "Progressively summarize the lines of conversation provided, adding onto the previous "
+    "summary and returning a new summary. Keep the names, Bible references and topics "
+    "discussed, in at most 150 words.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New lines of conversation:\n{new_lines}\n\n"
+    "New summary:")
+
+
+def format_chat_history(chat_history:List[Tuple[str,str]]) -> str:
+    '''Chat history as text, the way ConversationalRetrievalChain passes it to its prompts'''
+    buffer = ""
+    for human, answer in chat_history:
+        buffer += "\n" + "\n".join(["Human: " + human, "Assistant: " + answer])
+    return buffer
+
+
+class TokenStreamHandler(AsyncCallbackHandler):
+    '''Forwards the tokens generated by a streaming LLM to an async callback'''
+    def __init__(self, token_callback:Callable[[str], Awaitable[None]]) -> None:
+        self.token_callback = token_callback
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None: #pylint: disable=unused-argument
+        '''Passes the token on as it is generated'''
+        await self.token_callback(token)
+
+
+class RateLimitHandler(BaseCallbackHandler):
+    '''Takes a slot from the shared OpenAI scheduler before each LLM call of the chains,
+    one per request, as ScheduledChatOpenAI does not retry inside a call.
+    Being a sync handler, langchain runs it in an executor for the async calls'''
+    #pylint: disable=unused-argument
+    def __init__(self, priority:Priority = Priority.INTERACTIVE) -> None:
+        self.priority = priority
+
+    def on_llm_start(self, serialized:dict, prompts:List[str], **kwargs) -> None:
+        '''Waits for a slot, budgeting the prompts and an answer'''
+        tokens = sum(count_tokens(prompt) for prompt in prompts)
+        openai_scheduler.acquire(EndpointType.CHAT, tokens + ANSWER_TOKENS_ESTIMATE,
+            self.priority)
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        '''Resets the backoff of the endpoint'''
+        openai_scheduler.success(EndpointType.CHAT)
+
+    def on_llm_error(self, error:BaseException, **kwargs) -> None:
+        '''Pauses the endpoint after a 429'''
+        if isinstance(error, openai.error.RateLimitError):
+            openai_scheduler.backoff(EndpointType.CHAT)
+
+
+class ScheduledChatOpenAI(ChatOpenAI):
+    '''ChatOpenAI retried after 429s by the shared scheduler, each attempt waiting for its
+    own slot and the pause set by RateLimitHandler, instead of by langchain within one slot'''
+    max_retries:int = 0
+
+    def generate(self, *args, **kwargs):
+        return openai_scheduler.retry(super().generate, *args, **kwargs)
+
+    async def agenerate(self, *args, **kwargs):
+        return await openai_scheduler.aretry(super().agenerate, *args, **kwargs)
+
 
 #pylint: disable=too-few-public-methods
 
-class LangchainOpenAI(LLMFrameworkInterface):
+class LangchainOpenAI(LLMFrameworkInterface): #pylint: disable=too-many-instance-attributes
     '''Uses OpenAI APIs to create vectors for text'''
     api_key: str = None
     model_name: str = None
@@ -24,10 +107,18 @@ class LangchainOpenAI(LLMFrameworkInterface):
     llm = None
     chain = None
     vectordb = None
-    def __init__(self, #pylint: disable=super-init-not-called
+    def __init__(self, #pylint: disable=super-init-not-called, too-many-arguments
                 key:str=os.getenv("OPENAI_API_KEY"),
                 model_name:str = 'gpt-3.5-turbo',
-                vectordb:VectordbInterface = Chroma()) -> None:
+                vectordb:VectordbInterface = Chroma(),
+                answer_cache:SemanticCache = None,
+                condense_strategy:schema.CondenseStrategy = schema.CondenseStrategy.ALWAYS,
+                condense_model_name:str = None,
+                speculative_retrieval:bool = True,
+                embedding:EmbeddingInterface = None,
+                context_packer:ContextPacker = None,
+                compress_context:bool = False,
+                http_client:OpenAIHttpClient = openai_http) -> None:
         '''Sets the API key and initializes library objects if any'''
         if key is None:
             raise AccessException("OPENAI_API_KEY needs to be provided."+\
@@ -35,15 +126,56 @@ class LangchainOpenAI(LLMFrameworkInterface):
         self.api_key = key
         self.model_name = model_name
         self.vectordb = vectordb
-        self.api_object = ChatOpenAI
+        self.answer_cache = answer_cache
+        self.speculative_retrieval = speculative_retrieval
+        if context_packer is None:
+            context_packer = ContextPacker(model_name=model_name)
+        self.context_packer = context_packer
+        # To compare the raw and condensed questions, for reusing speculative retrievals
+        if embedding is None:
+            embedding = getattr(vectordb, "embedding", None)
+        if embedding is None and answer_cache is not None:
+            embedding = answer_cache.embedding
+        self.embedding = embedding
+        self.context_compressor = None
+        if compress_context:
+            if embedding is None:
+                embedding = shared_embedding()
+            self.context_compressor = ContextCompressor(embedding)
+        self.api_object = ScheduledChatOpenAI
         self.api_object.api_key = self.api_key
-        self.llm = self.api_object(temperature=0, model_name=self.model_name)
+        # ChatOpenAI calls the openai module, so the pools and base URL are set on that
+        self.http_client = http_client
+        self.http_client.install()
+        llm_args = {"temperature": 0, "request_timeout": http_client.timeout,
+            "callbacks": [RateLimitHandler()]}
+        self.llm = self.api_object(model_name=self.model_name, **llm_args)
+        # Only the answer is streamed, the condensed question is needed as a whole
+        self.streaming_llm = self.api_object(model_name=self.model_name, streaming=True,
+            **llm_args)
+        if condense_model_name and condense_model_name != self.model_name:
+            self.condense_llm = self.api_object(model_name=condense_model_name, **llm_args)
+        else:
+            self.condense_llm = self.llm
         # memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
 
-        self.chain = ConversationalRetrievalChain.from_llm(self.llm,
-			self.vectordb,
-			# memory = memory,
-        	return_source_documents=True)
+        # Same as ConversationalRetrievalChain.from_llm(), but with separate llms for the steps
+        self.chain = ConversationalRetrievalChain(
+            retriever=self.vectordb,
+            combine_docs_chain=load_qa_chain(self.streaming_llm, chain_type="stuff"),
+            question_generator=LLMChain(llm=self.condense_llm, prompt=CONDENSE_QUESTION_PROMPT),
+            # memory = memory,
+            return_source_documents=True)
+        self.condenser = QuestionCondenser(self.chain.question_generator,
+            format_chat_history, strategy=condense_strategy)
+        self.summary_chain = LLMChain(llm=self.condense_llm, prompt=SUMMARIZE_HISTORY_PROMPT)
+
+    def condense_question(self,
+        query:str,
+        chat_history:List[Tuple[str,str]]) -> str:
+        '''Uses the question generator of the chain to make a standalone question,
+        when the condense strategy finds it needed'''
+        return self.condenser.condense(query, chat_history)[0]
 
     def generate_text(self,
     	query:str,
@@ -53,6 +185,136 @@ class LangchainOpenAI(LLMFrameworkInterface):
         if len(kwargs) > 0:
             log.warning("Unused arguments in LangchainOpenAI.generate_text(): ",**kwargs)
         try:
-            return self.chain({"question": query, "chat_history": chat_history})
+            question, llm_calls = self.condenser.condense(query, chat_history)
+            if self.answer_cache is not None:
+                namespace = self.answer_cache.namespace(
+                    getattr(self.vectordb, "labels", None), self.vectordb.collection_name,
+                    self.model_name)
+                cached = self.answer_cache.lookup(question, namespace)
+                if cached is not None:
+                    cached['question'] = query
+                    cached['llm_calls'] = llm_calls
+                    return cached
+            # The question is already standalone, so only the retrieval and answer steps are run
+            docs = self.vectordb.get_relevant_documents(question)
+            if self.context_compressor is not None:
+                docs = self.context_compressor.compress(question, docs)
+            docs, _, prompt_tokens = self.context_packer.pack(question, docs)
+            answer = self.chain.combine_docs_chain.run(input_documents=docs, question=question)
+            response = {"question": question, "answer": answer, "source_documents": docs}
+            if self.answer_cache is not None:
+                self.answer_cache.add(question, namespace, response)
+            response['question'] = query
+            response['llm_calls'] = llm_calls + 1
+            response['prompt_tokens'] = prompt_tokens
+            return response
+        except Exception as exe:
+            raise OpenAIException("While generating answer: "+str(exe)) from exe
+
+    async def acondense_question(self,
+        query:str,
+        chat_history:List[Tuple[str,str]]) -> str:
+        '''Async version of condense_question'''
+        return (await self.condenser.acondense(query, chat_history))[0]
+
+    def _is_similar_question(self, query:str, question:str) -> bool:
+        '''Whether the condensed question means nearly the same as the raw one'''
+        if query.strip() == question.strip():
+            return True
+        if self.embedding is None:
+            return False
+        docs = [schema.Document(docId="query", text=query),
+                schema.Document(docId="question", text=question)]
+        self.embedding.get_embeddings(docs)
+        vectors = np.asarray([doc.embedding for doc in docs], dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return float(vectors[0] @ vectors[1]) >= SPECULATIVE_RETRIEVAL_THRESHOLD
+
+    async def _aretrieve(self,
+        query:str,
+        chat_history:List[Tuple[str,str]]) -> Tuple[str, int, Optional[list], Optional[str]]:
+        '''Condenses the question, with retrieval on the raw question started alongside when
+        the condense step needs an LLM call. Returns (question, llm calls, documents,
+        speculation outcome), with documents None when they are yet to be retrieved'''
+        if not (self.speculative_retrieval and self.condenser.needs_llm(query, chat_history)):
+            question, llm_calls = await self.condenser.acondense(query, chat_history)
+            return question, llm_calls, None, None
+        speculative = asyncio.create_task(self.vectordb.aget_relevant_documents(query))
+        try:
+            question, llm_calls = await self.condenser.acondense(query, chat_history)
+        except Exception:
+            speculative.cancel()
+            raise
+        if await asyncio.to_thread(self._is_similar_question, query, question):
+            return question, llm_calls, await speculative, "reused"
+        speculative.cancel()
+        return question, llm_calls, None, "discarded"
+
+    async def asummarize_history(self,
+        summary:str,
+        chat_history:List[Tuple[str,str]]) -> str:
+        '''Uses the condense llm to fold the exchanges into the running summary'''
+        self.http_client.use_async()
+        return await self.summary_chain.arun(summary=summary,
+            new_lines=format_chat_history(chat_history))
+
+    async def _agenerate(self,
+        query:str,
+        chat_history:List[Tuple[str,str]],
+        callbacks:Optional[list]=None) -> dict:
+        '''Runs the steps of the chain, condense, retrieve and answer, without blocking the loop'''
+        self.http_client.use_async()
+        question, llm_calls, docs, speculation = await self._aretrieve(query, chat_history)
+        if self.answer_cache is not None:
+            namespace = self.answer_cache.namespace(
+                getattr(self.vectordb, "labels", None), self.vectordb.collection_name,
+                self.model_name)
+            cached = await asyncio.to_thread(self.answer_cache.lookup, question, namespace)
+            if cached is not None:
+                if callbacks:
+                    for handler in callbacks:
+                        await handler.on_llm_new_token(cached['answer'])
+                cached['question'] = query
+                cached['llm_calls'] = llm_calls
+                return cached
+        if docs is None:
+            docs = await self.vectordb.aget_relevant_documents(question)
+        if self.context_compressor is not None:
+            docs = await asyncio.to_thread(self.context_compressor.compress, question, docs)
+        docs, _, prompt_tokens = self.context_packer.pack(question, docs)
+        answer = await self.chain.combine_docs_chain.arun(input_documents=docs,
+            question=question, callbacks=callbacks)
+        response = {"question": question, "answer": answer, "source_documents": docs}
+        if self.answer_cache is not None:
+            await asyncio.to_thread(self.answer_cache.add, question, namespace, response)
+        response['question'] = query
+        response['llm_calls'] = llm_calls + 1
+        response['speculative_retrieval'] = speculation
+        response['prompt_tokens'] = prompt_tokens
+        return response
+
+    async def agenerate_text(self,
+        query:str,
+        chat_history:List[Tuple[str,str]],
+        **kwargs) -> dict:
+        '''Prompt completion for QA or Chat reponse, using the async APIs of the chain'''
+        if len(kwargs) > 0:
+            log.warning("Unused arguments in LangchainOpenAI.agenerate_text(): ",**kwargs)
+        try:
+            return await self._agenerate(query, chat_history)
+        except Exception as exe:
+            raise OpenAIException("While generating answer: "+str(exe)) from exe
+
+    async def stream_text(self,
+        query:str,
+        chat_history:List[Tuple[str,str]],
+        token_callback:Callable[[str], Awaitable[None]],
+        **kwargs) -> dict:
+        '''Prompt completion with the answer tokens passed to token_callback as they arrive'''
+        if len(kwargs) > 0:
+            log.warning("Unused arguments in LangchainOpenAI.stream_text(): ",**kwargs)
+        try:
+            return await self._agenerate(query, chat_history,
+                callbacks=[TokenStreamHandler(token_callback)])
         except Exception as exe:
             raise OpenAIException("While generating answer: "+str(exe)) from exe
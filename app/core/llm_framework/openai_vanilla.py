@@ -1,72 +1,97 @@
 '''Implemetations for lmm_framework interface using vanilla'''
 import os
-from typing import List, Tuple
+import asyncio
+from string import Template
+from typing import List, Tuple, Callable, Awaitable, AsyncIterator, Optional
 
 import openai
+from langchain.schema import Document as LangchainDocument
 
 from core.llm_framework import LLMFrameworkInterface
+from core.llm_framework.context_packer import ContextPacker
+from core.llm_framework.context_compressor import ContextCompressor
+from core.llm_framework.hedging import (get_hedged_completion, stream_chat_completion,
+    HEDGE_FALLBACK_MODEL, ANSWER_TOKENS_ESTIMATE)
+from core.llm_framework.condense import is_self_contained
+from core.llm_framework.semantic_cache import SemanticCache
+from core.rate_limiter import openai_scheduler, EndpointType, Priority
+from core.openai_client import OpenAIHttpClient, openai_http
+from core.embedding import EmbeddingInterface
+from core.embedding.sentence_transformers import shared_embedding
 from core.vectordb import VectordbInterface
 
 from custom_exceptions import AccessException, OpenAIException
 from log_configs import log
 
 
-def get_context(results):
-    '''Constructs a context string based on the provided results.'''
-    context = '['
-    # ** This will need to be adjusted, based on what the returned results look like **
-    for i in range(len(results['documents'][0])):
-        context += '{source:' + results['metadatas'][0][i]['citation']
-        context += ', text: ' + results['documents'][0][i] + '}' + ','
-    context += ']' + '\n'
-
-    return context
-
-
-def get_pre_prompt(context):
-    '''Constructs a pre-prompt for the conversation, including the context'''
-    chat_prefix = "The following is a conversation with an AI assistant for "
-    chat_prefix += "Bible translators. The assistant is"
-    chat_prefix += " helpful, creative, clever, and very friendly.\n"
-    prompt = (
-        chat_prefix +
-        'Read the paragraph below and answer the question, using only the information'
-        ' in the context delimited by triple backticks. '
-        'At the end of your answer, include the source of each context text that '
-        'you used. You may use more than one, and include the sources of all those'
-        ' you used. If the question cannot be answered based on the context alone, '
-        'write "Sorry, I had trouble answering this question based on the '
-        'information i found\n'
-        "\n"
-        "Context:\n"
-        f"```{ context }```\n"
-        "\n"
-    )
-
-    return prompt
-
-
-def append_query_to_prompt(prompt, query, chat_history):
-    '''Appends the provided query and chat history to the given prompt.'''
-    if len(chat_history) > 0:
-        if len(chat_history) > 3:
-            chat_history = chat_history[-3:]
-        for exchange in chat_history:
-            prompt += "\nHuman: " + exchange[0] + "\nAI: " + exchange[1]
-    prompt += "\nHuman: " + query + "\nAI: "
-
-    return prompt
-
-
-class VanillaOpenAI(LLMFrameworkInterface): #pylint: disable=too-few-public-methods
+def as_documents(results):
+    '''Retrieved results as a list of documents. Chroma returns its raw query result'''
+    if isinstance(results, dict):
+        return [LangchainDocument(page_content=text, metadata={"source": id_, **(meta or {})})
+                for text, id_, meta in zip(results['documents'][0], results['ids'][0],
+                    results['metadatas'][0])]
+    return results
+
+
+# Compiled once. Values substituted in are not parsed again, so a $ in them is safe
+PROMPT_TEMPLATE = Template(
+    "The following is a conversation with an AI assistant for Bible translators. "
+    "The assistant is helpful, creative, clever, and very friendly.\n"
+    "Read the paragraph below and answer the question, using only the information"
+    " in the context delimited by triple backticks. "
+    "At the end of your answer, include the source of each context text that "
+    "you used. You may use more than one, and include the sources of all those"
+    " you used. If the question cannot be answered based on the context alone, "
+    "write \"Sorry, I had trouble answering this question based on the "
+    "information i found\n"
+    "\n"
+    "Context:\n"
+    "```$context```\n"
+    "\n"
+    "$history\nHuman: $query\nAI: ")
+
+
+def get_context(docs):
+    '''Constructs a context string based on the provided documents.'''
+    return "[" + ",".join(f"{{source:{doc.metadata.get('source', '')}, text: {doc.page_content}}}"
+        for doc in docs) + "]\n"
+
+
+def get_history(chat_history):
+    '''The chat history in the Human/AI format of the prompt'''
+    return "".join(f"\nHuman: {human}\nAI: {ai}" for human, ai in chat_history)
+
+
+def build_prompt(query, docs, chat_history):
+    '''The complete prompt, from the precompiled template'''
+    return PROMPT_TEMPLATE.substitute(context=get_context(docs),
+        history=get_history(chat_history), query=query)
+
+
+def retrieval_query(query, chat_history):
+    '''The text to search the vector store with. A follow up question that refers back
+    is searched along with the previous question, instead of an LLM call to rephrase it'''
+    if chat_history and not is_self_contained(query):
+        return chat_history[-1][0] + "\n" + query
+    return query
+
+
+class VanillaOpenAI(LLMFrameworkInterface): #pylint: disable=too-many-instance-attributes
     '''Uses OpenAI APIs to create vectors for text'''
     api_key: str = None
     model_name: str = None
     vectordb = None
-    def __init__(self, #pylint: disable=super-init-not-called
+    def __init__(self, #pylint: disable=super-init-not-called, too-many-arguments
                 key:str=os.getenv("OPENAI_API_KEY"),
                 model_name:str = 'gpt-3.5-turbo',
-                vectordb:VectordbInterface = None  # What should this be by default?
+                vectordb:VectordbInterface = None,  # What should this be by default?
+                answer_cache:SemanticCache = None,
+                context_packer:ContextPacker = None,
+                compress_context:bool = False,
+                embedding:EmbeddingInterface = None,
+                hedging:bool = True,
+                fallback_model_name:str = HEDGE_FALLBACK_MODEL,
+                http_client:OpenAIHttpClient = openai_http
                 ) -> None:
         '''Sets the API key and initializes library objects if any'''
         if key is None:
@@ -74,9 +99,52 @@ class VanillaOpenAI(LLMFrameworkInterface): #pylint: disable=too-few-public-meth
                 "Visit https://platform.openai.com/account/api-keys")
         self.api_key = key
         openai.api_key = self.api_key
+        self.http_client = http_client
+        self.http_client.install()
         self.model_name = model_name
         self.vectordb = vectordb
-
+        self.answer_cache = answer_cache
+        if context_packer is None:
+            context_packer = ContextPacker(model_name=model_name)
+        self.context_packer = context_packer
+        self.hedged_completion = None
+        if hedging:
+            self.hedged_completion = get_hedged_completion(model_name, fallback_model_name)
+        self.context_compressor = None
+        if compress_context:
+            if embedding is None:
+                embedding = getattr(vectordb, "embedding", None) or shared_embedding()
+            self.context_compressor = ContextCompressor(embedding)
+
+    def _cache_namespace(self, query, chat_history) -> Optional[tuple]:
+        '''Where the answer to the query is cached. None without a cache, or for a follow up
+        question, as its answer depends on the chat history'''
+        if self.answer_cache is None or (chat_history and not is_self_contained(query)):
+            return None
+        return self.answer_cache.namespace(getattr(self.vectordb, "labels", None),
+            getattr(self.vectordb, "collection_name", None), self.model_name)
+
+    def _retrieve(self, query, chat_history):
+        '''Retrieved, compressed and packed documents, with the prompt built from them'''
+        docs = as_documents(
+            self.vectordb.get_relevant_documents(retrieval_query(query, chat_history)))
+        if self.context_compressor is not None:
+            docs = self.context_compressor.compress(query, docs)
+        docs, chat_history, prompt_tokens = self.context_packer.pack(query, docs, chat_history)
+        return docs, build_prompt(query, docs, chat_history), prompt_tokens
+
+    async def _aretrieve(self, query, chat_history):
+        '''Async version of _retrieve'''
+        text = retrieval_query(query, chat_history)
+        if hasattr(self.vectordb, "aget_relevant_documents"):
+            results = await self.vectordb.aget_relevant_documents(text)
+        else:
+            results = await asyncio.to_thread(self.vectordb.get_relevant_documents, text)
+        docs = as_documents(results)
+        if self.context_compressor is not None:
+            docs = await asyncio.to_thread(self.context_compressor.compress, query, docs)
+        docs, chat_history, prompt_tokens = self.context_packer.pack(query, docs, chat_history)
+        return docs, build_prompt(query, docs, chat_history), prompt_tokens
 
     def generate_text(self,
         query:str,
@@ -86,23 +154,78 @@ class VanillaOpenAI(LLMFrameworkInterface): #pylint: disable=too-few-public-meth
             if provided'''
         if len(kwargs) > 0:
             log.warning("Unused arguments in VanillaOpenAI.generate_text(): ",**kwargs)
-
-        # Vectordb results are currently returned based on the whole chat history.
-        # We'll need to figure out if this is optimal or not.
-        query_text = '\n'.join([x[0] + '/n' + x[1][:50] + '\n' for x in chat_history])
-        query_text += '\n' + query
-        results = self.vectordb.get_relevant_documents(query_text)
-        context = get_context(results)
-        pre_prompt = get_pre_prompt(context)
-        prompt = append_query_to_prompt(pre_prompt, query, chat_history)
-
         try:
-            response = openai.ChatCompletion.create(
+            namespace = self._cache_namespace(query, chat_history)
+            if namespace is not None:
+                cached = self.answer_cache.lookup(query, namespace)
+                if cached is not None:
+                    cached['question'] = query
+                    cached['llm_calls'] = 0
+                    return cached
+            docs, prompt, prompt_tokens = self._retrieve(query, chat_history)
+            response = openai_scheduler.call(EndpointType.CHAT, openai.ChatCompletion.create,
                                 model=self.model_name,
                                 temperature=0,
-                    messages=[{"role": "user", "content": prompt}]
+                    messages=[{"role": "user", "content": prompt}],
+                    tokens=prompt_tokens + ANSWER_TOKENS_ESTIMATE,
+                    priority=Priority.INTERACTIVE,
+                    **self.http_client.request_args()
                 )
-            return response['choices'][0]["message"]["content"]
-
+            answer = response['choices'][0]["message"]["content"]
+            response = {"question": query, "answer": answer, "source_documents": docs}
+            if namespace is not None:
+                self.answer_cache.add(query, namespace, response)
         except Exception as exe:
             raise OpenAIException("While generating answer: "+str(exe)) from exe
+        response['llm_calls'] = 1
+        response['prompt_tokens'] = prompt_tokens
+        return response
+
+    def _astream(self, prompt:str) -> AsyncIterator[str]:
+        '''Pieces of the answer, from the hedged completion if enabled'''
+        messages = [{"role": "user", "content": prompt}]
+        if self.hedged_completion is not None:
+            return self.hedged_completion.astream(messages=messages, temperature=0,
+                http_client=self.http_client)
+        return stream_chat_completion(self.model_name, messages, temperature=0,
+            http_client=self.http_client)
+
+    async def stream_text(self,
+        query:str,
+        chat_history:List[Tuple[str,str]],
+        token_callback:Callable[[str], Awaitable[None]],
+        **kwargs) -> dict:
+        '''Prompt completion with the answer pieces passed to token_callback as they arrive'''
+        if len(kwargs) > 0:
+            log.warning("Unused arguments in VanillaOpenAI.stream_text(): ",**kwargs)
+        try:
+            namespace = self._cache_namespace(query, chat_history)
+            if namespace is not None:
+                cached = await asyncio.to_thread(self.answer_cache.lookup, query, namespace)
+                if cached is not None:
+                    await token_callback(cached['answer'])
+                    cached['question'] = query
+                    cached['llm_calls'] = 0
+                    return cached
+            docs, prompt, prompt_tokens = await self._aretrieve(query, chat_history)
+            pieces = []
+            async for content in self._astream(prompt):
+                pieces.append(content)
+                await token_callback(content)
+            response = {"question": query, "answer": "".join(pieces), "source_documents": docs}
+            if namespace is not None:
+                await asyncio.to_thread(self.answer_cache.add, query, namespace, response)
+        except Exception as exe:
+            raise OpenAIException("While generating answer: "+str(exe)) from exe
+        response['llm_calls'] = 1
+        response['prompt_tokens'] = prompt_tokens
+        return response
+
+    async def agenerate_text(self,
+        query:str,
+        chat_history:List[Tuple[str,str]],
+        **kwargs) -> dict:
+        '''Prompt completion using the async OpenAI client'''
+        async def ignore(_):
+            return
+        return await self.stream_text(query, chat_history, ignore, **kwargs)
@@ -0,0 +1,130 @@
+'''Semantic cache of generated answers, to serve near-duplicate questions without an LLM call'''
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+import schema
+from core.embedding import EmbeddingInterface
+from log_configs import log
+
+#pylint: disable=too-few-public-methods
+
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', "0.95"))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', "86400")) # seconds
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', "1000")) # entries, across all label sets
+
+
+class _CacheEntry:
+    '''One answered question and its normalized embedding'''
+    __slots__ = ("question", "vector", "response", "created")
+
+    def __init__(self, question: str, vector: np.ndarray, response: dict) -> None:
+        self.question = question
+        self.vector = vector
+        self.response = response
+        self.created = time.monotonic()
+
+
+class SemanticCache: #pylint: disable=too-many-instance-attributes
+    '''Stores answers per DB collection, LLM model and label set, and looks them up by
+    embedding similarity of the standalone question. Entries expire after `ttl` seconds,
+    the least recently used ones are evicted beyond `max_entries`, and a label set is dropped
+    entirely when any of its labels gets new uploads.'''
+    def __init__(self,
+                embedding: EmbeddingInterface,
+                threshold: float = ANSWER_CACHE_THRESHOLD,
+                ttl: float = ANSWER_CACHE_TTL,
+                max_entries: int = ANSWER_CACHE_SIZE) -> None:
+        self.embedding = embedding
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # namespace -> OrderedDict(question -> _CacheEntry), in LRU order
+        self._store = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def namespace(labels: Optional[List[str]], collection: Optional[str] = None,
+        model: Optional[str] = None) -> tuple:
+        '''The key under which answers for a DB collection, LLM model and label set are kept.
+        The labels come last'''
+        return (collection, model, tuple(sorted(set(labels or []))))
+
+    def _embed(self, question: str) -> np.ndarray:
+        '''Normalized embedding vector for the question'''
+        query_doc = schema.Document(docId="cache-query", text=question)
+        self.embedding.get_embeddings([query_doc])
+        vector = np.asarray(query_doc.embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expire(self, entries: OrderedDict) -> None:
+        '''Drops entries older than the TTL from one namespace'''
+        now = time.monotonic()
+        stale = [key for key, entry in entries.items() if now - entry.created > self.ttl]
+        for key in stale:
+            del entries[key]
+
+    def lookup(self, question: str, namespace: tuple) -> Optional[dict]:
+        '''Returns a copy of the stored response for the most similar question
+        above the threshold, or None'''
+        with self._lock:
+            entries = self._store.get(namespace)
+            if entries:
+                self._expire(entries)
+            if not entries:
+                self.misses += 1
+                return None
+            candidates = list(entries.values())
+        vector = self._embed(question)
+        matrix = np.vstack([entry.vector for entry in candidates])
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            with self._lock:
+                self.misses += 1
+            return None
+        entry = candidates[best]
+        with self._lock:
+            self.hits += 1
+            if entry.question in entries:
+                entries.move_to_end(entry.question)
+        log.info("Answer cache hit (score %.3f) for '%s' with '%s'",
+            scores[best], question, entry.question)
+        response = dict(entry.response)
+        response['cached'] = True
+        return response
+
+    def add(self, question: str, namespace: tuple, response: dict) -> None:
+        '''Stores the response generated for a standalone question'''
+        entry = _CacheEntry(question, self._embed(question), {
+            "answer": response['answer'],
+            "source_documents": response.get('source_documents', [])})
+        with self._lock:
+            entries = self._store.setdefault(namespace, OrderedDict())
+            entries[question] = entry
+            entries.move_to_end(question)
+            while sum(len(items) for items in self._store.values()) > self.max_entries:
+                oldest_ns = min((ns for ns, items in self._store.items() if items),
+                    key=lambda ns: next(iter(self._store[ns].values())).created)
+                self._store[oldest_ns].popitem(last=False)
+
+    def invalidate(self, labels: Optional[List[str]] = None) -> None:
+        '''Forget answers that could have used the given labels.
+        Namespaces without label filtering are always dropped. No labels clears everything'''
+        with self._lock:
+            if not labels:
+                self._store.clear()
+                return
+            labels = set(labels)
+            for namespace in list(self._store):
+                ns_labels = set(namespace[-1])
+                if not ns_labels or ns_labels & labels:
+                    del self._store[namespace]
+        log.info("Answer cache invalidated for labels: %s", labels)
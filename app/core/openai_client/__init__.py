@@ -0,0 +1,99 @@
+'''Shared HTTP connections for the OpenAI API.
+The openai client opens a new session, and so a new TLS handshake, for every async request
+and keeps a thread local session for the sync ones. OpenAIHttpClient holds pooled keep-alive
+sessions instead, one for sync calls and one per event loop for async calls, and applies the
+timeouts and base URL to every OpenAI backed component'''
+import os
+import threading
+import weakref
+import asyncio
+from typing import Optional, Tuple
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+import openai
+
+from log_configs import log
+
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE') # eg: a local stub, http://localhost:8080/v1
+OPENAI_POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', "32"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', "5")) # seconds
+OPENAI_READ_TIMEOUT = float(os.getenv('OPENAI_READ_TIMEOUT', "60")) # seconds
+OPENAI_KEEPALIVE = float(os.getenv('OPENAI_KEEPALIVE', "60")) # seconds an idle connection is kept
+
+
+class OpenAIHttpClient:
+    '''Keep-alive connection pools for the sync and async OpenAI calls.
+    install() points the openai module at them, request_args() gives the per call arguments'''
+    def __init__(self, #pylint: disable=too-many-arguments
+                api_base:Optional[str] = OPENAI_API_BASE,
+                pool_size:int = OPENAI_POOL_SIZE,
+                connect_timeout:float = OPENAI_CONNECT_TIMEOUT,
+                read_timeout:float = OPENAI_READ_TIMEOUT,
+                keepalive:float = OPENAI_KEEPALIVE) -> None:
+        self.api_base = api_base
+        self.pool_size = pool_size
+        self.timeout:Tuple[float,float] = (connect_timeout, read_timeout)
+        self.keepalive = keepalive
+        self._session = None
+        self._aiosessions = weakref.WeakKeyDictionary() # event loop: aiohttp session
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        '''The pooled requests session for the sync calls'''
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size,
+                        pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def aiosession(self) -> aiohttp.ClientSession:
+        '''The pooled aiohttp session for the running event loop'''
+        loop = asyncio.get_running_loop()
+        session = self._aiosessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size,
+                keepalive_timeout=self.keepalive)
+            session = aiohttp.ClientSession(connector=connector)
+            self._aiosessions[loop] = session
+        return session
+
+    def install(self) -> None:
+        '''Makes the openai module use these pools and the base URL for the sync calls'''
+        openai.requestssession = self.session
+        if self.api_base:
+            openai.api_base = self.api_base
+
+    def use_async(self) -> None:
+        '''Makes the async openai calls of the current task, and the tasks it starts, use the
+        pool of the running loop. openai keeps the session in a context variable'''
+        openai.aiosession.set(self.aiosession())
+
+    def request_args(self) -> dict:
+        '''Keyword arguments for the openai create() calls'''
+        args = {"request_timeout": self.timeout}
+        if self.api_base:
+            args["api_base"] = self.api_base
+        return args
+
+    async def aclose(self) -> None:
+        '''Closes the pools'''
+        for session in list(self._aiosessions.values()):
+            if not session.closed:
+                await session.close()
+        self._aiosessions.clear()
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        log.info("Closed the OpenAI connection pools")
+
+
+# The one client for the app process, shared by all the OpenAI backed components
+openai_http = OpenAIHttpClient()
@@ -1,9 +1,10 @@
 '''Pipeline classes'''
 from io import TextIOWrapper
-from typing import List, Tuple, Optional
+from typing import Callable, Iterable, List, Tuple, Optional, Union
 
 import schema
 from custom_exceptions import GenericException
+from core.document_batch import DocumentRow
 from core.file_processor import FileProcessorInterface
 from core.embedding import EmbeddingInterface
 from core.vectordb import VectordbInterface
@@ -12,13 +13,18 @@ from core.audio import AudioTranscriptionInterface
 
 from core.file_processor.langchain_loader import LangchainLoader
 from core.file_processor.vanilla_loader import VanillaLoader
+from core.file_processor.native_loader import NativeLoader
+from core.file_processor.bulk import BulkParse, BULK_PARSE_WORKERS
 from core.embedding.openai import OpenAIEmbedding
 from core.embedding.sentence_transformers import SentenceTransformerEmbedding
 from core.vectordb.chroma import Chroma
 from core.vectordb.chroma4langchain import Chroma as ChromaLC
 from core.vectordb.postgres4langchain import Postgres
 from core.llm_framework.openai_langchain import LangchainOpenAI
+from core.llm_framework.openai_vanilla import VanillaOpenAI
 from core.audio.whisper import WhisperAudioTranscription
+from core.pipeline.chat_history import ChatHistory
+from core.pipeline.ingestion import IngestionRun, INGEST_BATCH_SIZE
 
 #pylint: disable=unused-argument
 
@@ -42,6 +48,8 @@ class DataUploadPipeline:
             self.file_processor = LangchainLoader()
         elif choice == schema.FileProcessorType.VANILLA:
             self.file_processor = VanillaLoader()
+        elif choice == schema.FileProcessorType.NATIVE:
+            self.file_processor = NativeLoader(**kwargs)
         else:
             raise GenericException("This technology type is not supported (yet)!")
 
@@ -96,6 +104,55 @@ class DataUploadPipeline:
         else:
             raise GenericException("This technology type is not supported (yet)!")
 
+    def run(self, #pylint: disable=too-many-arguments
+        source:Union[str, Iterable[Union[DocumentRow, schema.Document]]],
+        label:Optional[str]=None,
+        file_type:schema.FileType=schema.FileType.TEXT,
+        embed:bool=True,
+        batch_size:int=INGEST_BATCH_SIZE,
+        progress:Optional[Callable[[dict], None]]=None,
+        **kwargs) -> dict:
+        '''Ingests a file, processed with the file_processor, or documents into the vectordb.
+        Chunking, embedding and the DB writes run concurrently on batches.
+        embed=False leaves the embedding to the vectordb, for the documents without one.
+        kwargs go to the file processor.
+        progress is called with the stats after each batch is written.
+        Returns the stage throughputs and queue occupancies'''
+        if isinstance(source, str):
+            docs = self.file_processor.iter_documents(source, label=label,
+                file_type=file_type, **kwargs)
+        else:
+            docs = source
+        # documents can come with precomputed embeddings, embed_batch() leaves them
+        embed_step = self.embedding.embed_batch if embed else None
+        return IngestionRun(docs, embed_step,
+            lambda batch: self.vectordb.add_to_collection(docs=batch, finalize=False),
+            batch_size=batch_size, progress=progress, finish=self.vectordb.finalize).run()
+
+    def run_directory(self, #pylint: disable=too-many-arguments
+        directory:str,
+        label:Optional[str]=None,
+        embed:bool=True,
+        workers:int=BULK_PARSE_WORKERS,
+        batch_size:int=INGEST_BATCH_SIZE,
+        progress:Optional[Callable[[dict], None]]=None,
+        source_prefix:str="",
+        **kwargs) -> dict:
+        '''Ingests every supported file under the directory. The files are parsed by the
+        file_processor in a pool of worker processes, feeding one stream of batches to the
+        embedding and the DB. A file that fails is reported, the others still go in.
+        kwargs go to the file processor, for every file.
+        Returns the stats of run(), with the files ingested, failed and skipped'''
+        with BulkParse(directory, self.file_processor, label=label, workers=workers,
+                source_prefix=source_prefix, process_args=kwargs) as parse:
+            report = progress
+            if progress is not None:
+                report = lambda stats: progress({**stats, **parse.report()}) #pylint: disable=unnecessary-lambda-assignment
+            stats = self.run(parse.documents(), embed=embed, batch_size=batch_size,
+                progress=report)
+            stats.update(parse.report())
+        return stats
+
 class ConversationPipeline(DataUploadPipeline):
     '''The tech stack for implementing chat bot'''
     def __init__(self, #pylint: disable=too-many-arguments,dangerous-default-value
@@ -111,7 +168,7 @@ class ConversationPipeline(DataUploadPipeline):
         self.user = user
         if labels is not None:
             self.labels = labels
-        self.chat_history = []
+        self.chat_history = ChatHistory()
         self.embedding = embedding
         self.vectordb = vectordb
         self.llm_framework = llm_framework
@@ -126,11 +183,35 @@ class ConversationPipeline(DataUploadPipeline):
         '''Change the default tech with one of our choice'''
         self.llm_framework.api_key = api_key
         self.llm_framework.model_name = model_name
+        if isinstance(vectordb, Chroma):
+            vectordb = ChromaLC(host=vectordb.db_host, port=vectordb.db_port,
+                path=vectordb.db_path, collection_name=vectordb.collection_name)
+        # the frameworks are built anew, so the key and model go to their constructors
+        common_args = {}
+        if api_key is not None:
+            common_args['key'] = api_key
+        if model_name is not None:
+            common_args['model_name'] = model_name
         if choice == schema.LLMFrameworkType.LANGCHAIN:
-            if isinstance(vectordb, Chroma):
-                vectordb = ChromaLC(host=vectordb.db_host, port=vectordb.db_port,
-                    path=vectordb.db_path, collection_name=vectordb.collection_name)
-            self.llm_framework = LangchainOpenAI(vectordb=vectordb)
+            args = dict(common_args)
+            if kwargs.get('condense_strategy') is not None:
+                args['condense_strategy'] = kwargs.get('condense_strategy')
+            if kwargs.get('condense_model_name') is not None:
+                args['condense_model_name'] = kwargs.get('condense_model_name')
+            if kwargs.get('speculative_retrieval') is not None:
+                args['speculative_retrieval'] = kwargs.get('speculative_retrieval')
+            if kwargs.get('compress_context') is not None:
+                args['compress_context'] = kwargs.get('compress_context')
+            self.llm_framework = LangchainOpenAI(vectordb=vectordb,
+                answer_cache=kwargs.get('answer_cache'), **args)
+        elif choice == schema.LLMFrameworkType.VANILLA:
+            args = dict(common_args)
+            if kwargs.get('compress_context') is not None:
+                args['compress_context'] = kwargs.get('compress_context')
+            self.llm_framework = VanillaOpenAI(vectordb=vectordb,
+                answer_cache=kwargs.get('answer_cache'), **args)
+        else:
+            raise GenericException("This technology type is not supported (yet)!")
 
     def set_transcription_framework(self,
         choice:schema.AudioTranscriptionType,
@@ -0,0 +1,85 @@
+'''Bounded chat history, with older exchanges folded into a rolling summary'''
+import os
+import asyncio
+from collections import deque
+from typing import List, Tuple, Callable, Awaitable
+
+from log_configs import log
+
+CHAT_HISTORY_EXCHANGES = int(os.getenv('CHAT_HISTORY_EXCHANGES', "4"))
+CHAT_SUMMARY_MAX_CHARS = int(os.getenv('CHAT_SUMMARY_MAX_CHARS', "2000"))
+SUMMARY_QUESTION = "What have we talked about so far?"
+
+
+class ChatHistory:
+    '''Keeps the last `max_exchanges` (question, answer) pairs verbatim. Older ones wait in
+    `pending` till they are folded into `summary` by schedule_summary(), which runs after
+    the answer is sent. Reads like a list of exchanges, with the summary as the first one.
+    At most 2*max_exchanges exchanges and max_summary_chars of summary are held'''
+    def __init__(self,
+                max_exchanges:int = CHAT_HISTORY_EXCHANGES,
+                max_summary_chars:int = CHAT_SUMMARY_MAX_CHARS) -> None:
+        self.max_exchanges = max_exchanges
+        self.max_summary_chars = max_summary_chars
+        self.recent = deque()
+        self.pending = deque()
+        self.summary = ""
+        self._task = None
+
+    def append(self, exchange:Tuple[str,str]) -> None:
+        '''Adds the latest exchange, moving the oldest ones out to be summarized'''
+        self.recent.append(exchange)
+        while len(self.recent) > self.max_exchanges:
+            self.pending.append(self.recent.popleft())
+        while len(self.pending) > self.max_exchanges:
+            # Summarization is lagging behind, the oldest are dropped to cap the memory
+            log.warning("Chat history summary lagging. Dropping an exchange")
+            self.pending.popleft()
+
+    def exchanges(self) -> List[Tuple[str,str]]:
+        '''The history to be used in prompts'''
+        items = []
+        if self.summary:
+            items.append((SUMMARY_QUESTION, self.summary))
+        items.extend(self.pending)
+        items.extend(self.recent)
+        return items
+
+    def __iter__(self):
+        return iter(self.exchanges())
+
+    def __len__(self) -> int:
+        return len(self.recent) + len(self.pending) + (1 if self.summary else 0)
+
+    def __getitem__(self, index):
+        return self.exchanges()[index]
+
+    async def summarize(self,
+        summarizer:Callable[[str, List[Tuple[str,str]]], Awaitable[str]]) -> None:
+        '''Folds the pending exchanges into the summary'''
+        folding = list(self.pending)
+        if not folding:
+            return
+        try:
+            summary = await summarizer(self.summary, folding)
+        except Exception as exe: #pylint: disable=broad-exception-caught
+            log.exception(exe)
+            return
+        self.summary = summary[:self.max_summary_chars]
+        # Some of them may have been dropped meanwhile, if the summary was lagging
+        while self.pending and self.pending[0] in folding:
+            self.pending.popleft()
+
+    def schedule_summary(self,
+        summarizer:Callable[[str, List[Tuple[str,str]]], Awaitable[str]]) -> None:
+        '''Starts summarize() in the background, if there is something to fold in
+        and no earlier summarization is still running'''
+        if not self.pending or (self._task is not None and not self._task.done()):
+            return
+        self._task = asyncio.create_task(self.summarize(summarizer))
+
+    def cancel_summary(self) -> None:
+        '''Stops a summarization still running, as when the chat is closed'''
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._task = None
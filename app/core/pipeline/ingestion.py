@@ -0,0 +1,205 @@
+'''Pipelined ingestion: documents flow through chunking, embedding and the vector DB write as
+concurrent stages, in batches, with bounded queues in between. While a batch is embedded the
+next one is being chunked and the previous one written. Batches are DocumentBatches, so
+each stage works on columns, and on a single matrix of embeddings'''
+import os
+import time
+import queue
+import threading
+from itertools import islice
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+import schema
+from core.document_batch import DocumentBatch, DocumentRow
+from log_configs import log
+
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', "64"))
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', "2")) # batches waiting between stages
+
+_DONE = object() # end of stream marker on the queues
+
+
+class StageStats: #pylint: disable=too-few-public-methods
+    '''Batches, documents and busy time of one stage'''
+    def __init__(self, name:str) -> None:
+        self.name = name
+        self.batches = 0
+        self.documents = 0
+        self.busy = 0.0
+
+    def as_dict(self) -> dict:
+        '''For the logs and the metrics endpoint'''
+        return {"batches": self.batches, "documents": self.documents,
+            "busy_seconds": round(self.busy, 3),
+            "docs_per_second": round(self.documents / self.busy, 1) if self.busy else None}
+
+
+class QueueStats:
+    '''Occupancy of a queue, sampled whenever a batch is put on it'''
+    def __init__(self, name:str, maxsize:int) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+
+    def sample(self, size:int) -> None:
+        '''Records the queue length'''
+        self.samples += 1
+        self.total += size
+        self.max = max(self.max, size)
+
+    def as_dict(self) -> dict:
+        '''For the logs and the metrics endpoint'''
+        return {"capacity": self.maxsize, "max": self.max,
+            "mean": round(self.total / self.samples, 2) if self.samples else 0}
+
+
+def batched(docs:Iterable[Union[DocumentRow, schema.Document]],
+    size:int) -> Iterator[DocumentBatch]:
+    '''DocumentBatches of up to size documents'''
+    docs = iter(docs)
+    while True:
+        batch = DocumentBatch.from_rows(islice(docs, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+class IngestionRun: #pylint: disable=too-many-instance-attributes
+    '''One run of documents through the stages. Each stage is a thread, reading batches off
+    the queue before it. An error in any stage stops the others and is raised from run().
+    progress, if given, is called with stats() after each batch is written. It can raise
+    to stop the run. finish, if given, is called once after the stages stop, even when the
+    run failed part way, for the work on the whole store, like indexing what was written'''
+    def __init__(self, #pylint: disable=too-many-arguments
+                docs:Iterable[Union[DocumentRow, schema.Document]],
+                embed:Optional[Callable[[DocumentBatch], None]],
+                write:Callable[[DocumentBatch], None],
+                batch_size:int = INGEST_BATCH_SIZE,
+                queue_size:int = INGEST_QUEUE_SIZE,
+                progress:Optional[Callable[[dict], None]] = None,
+                finish:Optional[Callable[[], None]] = None) -> None:
+        self.docs = docs
+        self.progress = progress
+        self.finish = finish
+        self.batch_size = batch_size
+        self.steps = [("embed", embed)] if embed is not None else []
+        self.steps.append(("write", write))
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in self.steps]
+        self.queue_stats = [QueueStats(f"to_{name}", queue_size) for name, _ in self.steps]
+        self.stages = [StageStats("chunk")] + [StageStats(name) for name, _ in self.steps]
+        self.labels = set()
+        self.error = None
+        self.stopped = threading.Event()
+        self.started = None
+        self.elapsed = 0.0
+
+    def _put(self, index:int, item) -> bool:
+        '''Puts on the queue, unless the run is stopped meanwhile'''
+        while not self.stopped.is_set():
+            try:
+                self.queues[index].put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            if item is not _DONE:
+                self.queue_stats[index].sample(self.queues[index].qsize())
+            return True
+        return False
+
+    def _get(self, index:int):
+        '''Takes from the queue, or _DONE if the run is stopped meanwhile'''
+        while not self.stopped.is_set():
+            try:
+                return self.queues[index].get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, exe:BaseException) -> None:
+        if self.error is None:
+            self.error = exe
+        self.stopped.set()
+
+    def _chunk(self) -> None:
+        stats = self.stages[0]
+        try:
+            batches = batched(self.docs, self.batch_size)
+            while True:
+                start = time.perf_counter()
+                batch = next(batches, None)
+                stats.busy += time.perf_counter() - start
+                if batch is None:
+                    break
+                stats.batches += 1
+                stats.documents += len(batch)
+                if not self._put(0, batch):
+                    return
+            self._put(0, _DONE)
+        except BaseException as exe: #pylint: disable=broad-exception-caught
+            self._fail(exe)
+
+    def _step(self, index:int) -> None:
+        name, func = self.steps[index]
+        stats = self.stages[index + 1]
+        try:
+            while True:
+                batch = self._get(index)
+                if batch is _DONE:
+                    break
+                start = time.perf_counter()
+                func(batch)
+                stats.busy += time.perf_counter() - start
+                stats.batches += 1
+                stats.documents += len(batch)
+                if name == "write":
+                    self.labels.update(batch.labels)
+                    if self.progress is not None:
+                        self.progress(self.stats())
+                if index + 1 < len(self.steps) and not self._put(index + 1, batch):
+                    return
+            if index + 1 < len(self.steps):
+                self._put(index + 1, _DONE)
+        except BaseException as exe: #pylint: disable=broad-exception-caught
+            self._fail(exe)
+
+    def run(self) -> dict:
+        '''Runs the stages to completion and returns the stats'''
+        self.started = time.perf_counter()
+        threads = [threading.Thread(target=self._chunk, name="ingest-chunk", daemon=True)]
+        threads += [threading.Thread(target=self._step, args=(index,),
+                        name=f"ingest-{name}", daemon=True)
+                    for index, (name, _) in enumerate(self.steps)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.finish is not None:
+            try:
+                self.finish()
+            except Exception as exe: #pylint: disable=broad-exception-caught
+                if self.error is None:
+                    self.error = exe
+                else:
+                    log.exception(exe)
+        self.elapsed = time.perf_counter() - self.started
+        stats = self.stats()
+        if self.error is not None:
+            log.error("Ingestion failed after %s documents", self.stages[-1].documents)
+            raise self.error
+        log.info("Ingested %s documents in %.2fs: %s", stats['documents'],
+            self.elapsed, stats['stages'])
+        return stats
+
+    def stats(self) -> dict:
+        '''Throughput per stage and occupancy per queue'''
+        elapsed = self.elapsed or (time.perf_counter() - self.started if self.started else 0)
+        return {
+            "documents": self.stages[-1].documents,
+            "elapsed_seconds": round(elapsed, 3),
+            "docs_per_second": round(self.stages[-1].documents / elapsed, 1) if elapsed else None,
+            "labels": sorted(label for label in self.labels if label),
+            "stages": {stage.name: stage.as_dict() for stage in self.stages},
+            "queues": {stats.name: stats.as_dict() for stats in self.queue_stats},
+            "error": None if self.error is None else str(self.error),
+        }
@@ -0,0 +1,335 @@
+'''Shared scheduler for the rate limited OpenAI APIs.
+Every OpenAI backed component asks it for a slot before making a request. Requests and tokens
+per minute are budgeted per endpoint type, waiting callers are served in priority order
+(interactive chat, then transcription, then bulk embedding) and 429s pause the endpoint.
+The budgets, pauses and waiting callers are kept in the SQLite job DB, so the app process and
+the job workers draw on the same budgets, and a chat waiting in the app goes before the
+uploads waiting in the workers'''
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import Optional
+
+import openai
+
+from core.jobs import JOB_DB_PATH
+from log_configs import log
+
+#pylint: disable=too-few-public-methods
+
+class Priority(IntEnum):
+    '''Lower values are served first'''
+    INTERACTIVE = 0
+    TRANSCRIPTION = 1
+    BULK = 2
+
+class EndpointType:
+    '''The OpenAI endpoints with separate rate limits'''
+    CHAT = "chat"
+    EMBEDDING = "embedding"
+    AUDIO = "audio"
+
+RATE_LIMITS = { # (requests per minute, tokens per minute), None for no token limit
+    EndpointType.CHAT: (int(os.getenv('OPENAI_CHAT_RPM', "3500")),
+                        int(os.getenv('OPENAI_CHAT_TPM', "90000"))),
+    EndpointType.EMBEDDING: (int(os.getenv('OPENAI_EMBEDDING_RPM', "3000")),
+                        int(os.getenv('OPENAI_EMBEDDING_TPM', "1000000"))),
+    EndpointType.AUDIO: (int(os.getenv('OPENAI_AUDIO_RPM', "50")), None),
+}
+MAX_BACKOFF = 60.0 # seconds
+RATE_LIMIT_RETRIES = int(os.getenv('OPENAI_RATE_LIMIT_RETRIES', "5"))
+POLL_SECONDS = 1.0 # longest wait between checks of a caller in line
+NEXT_IN_LINE_SECONDS = 0.05 # wait between checks of a caller behind others
+# A caller that has not checked for this long is gone, as with a killed process
+WAITER_TIMEOUT = 10.0
+
+SCHEMA = ('''CREATE TABLE IF NOT EXISTS rate_budgets (
+    endpoint TEXT PRIMARY KEY,
+    requests REAL NOT NULL,
+    tokens REAL,
+    updated REAL NOT NULL,
+    paused_until REAL NOT NULL DEFAULT 0,
+    backoff REAL NOT NULL DEFAULT 0,
+    rate_limited INTEGER NOT NULL DEFAULT 0)''',
+    '''CREATE TABLE IF NOT EXISTS rate_waiters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    endpoint TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    seen REAL NOT NULL)''')
+
+
+class TokenBucket:
+    '''Holds up to `capacity` units, refilled continuously over a minute.
+    `available` is as of `updated`, a unix time, so it can be saved and read back'''
+    def __init__(self, per_minute:int, available:Optional[float] = None,
+        updated:Optional[float] = None) -> None:
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.available = self.capacity if available is None else available
+        self.updated = time.time() if updated is None else updated
+
+    def _refill(self) -> None:
+        now = time.time()
+        self.available = min(self.capacity,
+            self.available + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def level(self) -> float:
+        '''Units available now'''
+        self._refill()
+        return self.available
+
+    def wait_time(self, amount:float) -> float:
+        '''Seconds till `amount` units are available'''
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.rate
+
+    def consume(self, amount:float) -> None:
+        '''Takes the units out. Check wait_time() first'''
+        self.available -= min(amount, self.capacity)
+
+
+class _EndpointState:
+    '''Buckets and backoff of one endpoint type, from its row in rate_budgets.
+    Full buckets when there is no row yet'''
+    def __init__(self, limits:tuple, row:Optional[sqlite3.Row] = None) -> None:
+        requests_per_minute, tokens_per_minute = limits
+        self.requests = TokenBucket(requests_per_minute,
+            *((row['requests'], row['updated']) if row else ()))
+        self.tokens = None
+        if tokens_per_minute:
+            self.tokens = TokenBucket(tokens_per_minute,
+                *((row['tokens'], row['updated']) if row else ()))
+        self.paused_until = row['paused_until'] if row else 0.0
+        self.backoff = row['backoff'] if row else 0.0
+        self.rate_limited = row['rate_limited'] if row else 0
+
+    def wait_time(self, tokens:int) -> float:
+        '''Seconds till a request with these many tokens can be sent'''
+        wait = max(0.0, self.paused_until - time.time(), self.requests.wait_time(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def consume(self, tokens:int) -> None:
+        '''Accounts for a request being sent'''
+        self.requests.consume(1)
+        if self.tokens is not None:
+            self.tokens.consume(tokens)
+
+    def save(self, conn:sqlite3.Connection, endpoint:str) -> None:
+        '''Writes the state back to rate_budgets'''
+        conn.execute("INSERT OR REPLACE INTO rate_budgets (endpoint, requests, tokens, updated,"
+            " paused_until, backoff, rate_limited) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (endpoint, self.requests.available,
+                None if self.tokens is None else self.tokens.available,
+                self.requests.updated, self.paused_until, self.backoff, self.rate_limited))
+
+
+class RateScheduler:
+    '''Grants request slots per endpoint, in priority order, within the rate budgets.
+    acquire() blocks the calling thread, aacquire() is for the event loop.
+    The state is in the SQLite file at `path`, shared by all the processes using it.
+    Every thread has its own connection, made on first use'''
+    def __init__(self, rate_limits:dict = None, path:str = JOB_DB_PATH) -> None:
+        self.rate_limits = rate_limits or RATE_LIMITS
+        self.path = path
+        self._local = threading.local()
+
+    def set_path(self, path:str) -> None:
+        '''Moves to the state in the SQLite file at path. Call before the scheduler is in use'''
+        self.path = path
+        self._local = threading.local()
+
+    @contextmanager
+    def _transaction(self):
+        '''The connection of this thread, in a write transaction'''
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._local.conn = conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _state(self, conn:sqlite3.Connection, endpoint:str) -> _EndpointState:
+        '''The state of the endpoint. Call in a transaction'''
+        row = conn.execute("SELECT * FROM rate_budgets WHERE endpoint = ?",
+            (endpoint,)).fetchone()
+        return _EndpointState(self.rate_limits[endpoint], row)
+
+    def _enter(self, endpoint:str, priority:Priority) -> int:
+        '''Puts a caller in line for the endpoint. Returns its ticket'''
+        if endpoint not in self.rate_limits:
+            raise KeyError(endpoint)
+        with self._transaction() as conn:
+            return conn.execute("INSERT INTO rate_waiters (endpoint, priority, seen)"
+                " VALUES (?, ?, ?)", (endpoint, int(priority), time.time())).lastrowid
+
+    def _try_grant(self, endpoint:str, ticket:int, priority:Priority, tokens:int) -> float:
+        '''Grants the slot if the ticket is first in line, in any process, and the budget
+        allows. Returns 0 when granted, else the seconds worth waiting'''
+        with self._transaction() as conn:
+            now = time.time()
+            conn.execute("DELETE FROM rate_waiters WHERE seen < ?", (now - WAITER_TIMEOUT,))
+            # Back in its place, if it was taken for gone
+            conn.execute("INSERT OR REPLACE INTO rate_waiters (id, endpoint, priority, seen)"
+                " VALUES (?, ?, ?, ?)", (ticket, endpoint, int(priority), now))
+            first = conn.execute("SELECT id FROM rate_waiters WHERE endpoint = ?"
+                " ORDER BY priority, id LIMIT 1", (endpoint,)).fetchone()
+            if first['id'] != ticket:
+                return NEXT_IN_LINE_SECONDS
+            state = self._state(conn, endpoint)
+            wait = state.wait_time(tokens)
+            if wait > 0:
+                return wait
+            state.consume(tokens)
+            state.save(conn, endpoint)
+            conn.execute("DELETE FROM rate_waiters WHERE id = ?", (ticket,))
+            return 0.0
+
+    def _leave(self, ticket:int) -> None:
+        '''Removes a ticket that gave up waiting'''
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM rate_waiters WHERE id = ?", (ticket,))
+
+    def acquire(self, endpoint:str, tokens:int = 0, priority:Priority = Priority.BULK) -> None:
+        '''Blocks till a request to the endpoint may be sent'''
+        ticket = self._enter(endpoint, priority)
+        try:
+            while True:
+                wait = self._try_grant(endpoint, ticket, priority, tokens)
+                if wait == 0:
+                    return
+                time.sleep(min(wait, POLL_SECONDS))
+        except BaseException:
+            self._leave(ticket)
+            raise
+
+    async def aacquire(self, endpoint:str, tokens:int = 0,
+        priority:Priority = Priority.INTERACTIVE) -> None:
+        '''Waits, without blocking the event loop, till a request to the endpoint may be sent'''
+        ticket = await asyncio.to_thread(self._enter, endpoint, priority)
+        try:
+            while True:
+                wait = await asyncio.to_thread(self._try_grant, endpoint, ticket, priority,
+                    tokens)
+                if wait == 0:
+                    return
+                await asyncio.sleep(min(wait, POLL_SECONDS))
+        except BaseException:
+            await asyncio.to_thread(self._leave, ticket)
+            raise
+
+    def backoff(self, endpoint:str, retry_after:Optional[float] = None) -> float:
+        '''Pauses the endpoint after a 429, exponentially on repeated ones.
+        Returns the pause in seconds'''
+        with self._transaction() as conn:
+            state = self._state(conn, endpoint)
+            state.rate_limited += 1
+            state.backoff = min(MAX_BACKOFF, state.backoff * 2 if state.backoff else 1.0)
+            pause = retry_after if retry_after else state.backoff
+            state.paused_until = max(state.paused_until, time.time() + pause)
+            state.save(conn, endpoint)
+        log.warning("OpenAI %s endpoint rate limited, pausing for %.1fs", endpoint, pause)
+        return pause
+
+    def success(self, endpoint:str) -> None:
+        '''Resets the backoff after a request went through'''
+        with self._transaction() as conn:
+            conn.execute("UPDATE rate_budgets SET backoff = 0 WHERE endpoint = ? AND backoff > 0",
+                (endpoint,))
+
+    def metrics(self) -> dict:
+        '''Queue depth per priority and remaining budget, per endpoint, over all processes'''
+        output = {}
+        with self._transaction() as conn:
+            now = time.time()
+            for endpoint in self.rate_limits:
+                state = self._state(conn, endpoint)
+                depth = {priority.name.lower(): 0 for priority in Priority}
+                for row in conn.execute("SELECT priority, COUNT(*) AS waiting FROM rate_waiters"
+                        " WHERE endpoint = ? AND seen >= ? GROUP BY priority",
+                        (endpoint, now - WAITER_TIMEOUT)):
+                    depth[Priority(row['priority']).name.lower()] = row['waiting']
+                output[endpoint] = {
+                    "queue_depth": depth,
+                    "requests_available": int(state.requests.level()),
+                    "tokens_available": None if state.tokens is None \
+                                            else int(state.tokens.level()),
+                    "paused_for": max(0.0, state.paused_until - now),
+                    "rate_limited": state.rate_limited,
+                }
+        return output
+
+    def retry(self, func, *args, **kwargs):
+        '''Calls func again after a 429, up to RATE_LIMIT_RETRIES times. For a func that
+        takes its slot and reports the 429 itself, as a langchain LLM with RateLimitHandler'''
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except openai.error.RateLimitError:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+        return None
+
+    async def aretry(self, func, *args, **kwargs):
+        '''Async version of retry'''
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                return await func(*args, **kwargs)
+            except openai.error.RateLimitError:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+        return None
+
+    def call(self, endpoint:str, func, *args, tokens:int = 0,
+        priority:Priority = Priority.BULK, **kwargs):
+        '''Calls func when the scheduler allows, retrying it after 429s'''
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            self.acquire(endpoint, tokens, priority)
+            try:
+                result = func(*args, **kwargs)
+            except openai.error.RateLimitError:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                self.backoff(endpoint)
+                continue
+            self.success(endpoint)
+            return result
+        return None
+
+    async def acall(self, endpoint:str, func, *args, tokens:int = 0,
+        priority:Priority = Priority.INTERACTIVE, **kwargs):
+        '''Awaits the coroutine function when the scheduler allows, retrying it after 429s'''
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            await self.aacquire(endpoint, tokens, priority)
+            try:
+                result = await func(*args, **kwargs)
+            except openai.error.RateLimitError:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                self.backoff(endpoint)
+                continue
+            self.success(endpoint)
+            return result
+        return None
+
+
+# The scheduler of this process. Its state is in the job DB, shared with the other processes
+openai_scheduler = RateScheduler()
@@ -1,9 +1,10 @@
 '''Interface definition and common implemetations for vectordb classes'''
 import os
-from typing import List
+from typing import List, Union
 from abc import abstractmethod, ABC
 
 import schema
+from core.document_batch import DocumentBatch
 
 #pylint: disable=too-few-public-methods, unused-argument
 
@@ -19,8 +20,15 @@ class VectordbInterface(ABC):
         return
 
     @abstractmethod
-    def add_to_collection(self, docs: List[schema.Document], **kwargs) -> None:
-        '''Add objects in document format to DB'''
+    def add_to_collection(self, docs: Union[DocumentBatch, List[schema.Document]],
+        finalize: bool = True, **kwargs) -> None:
+        '''Add objects in document format to DB. The ingestion pipeline passes DocumentBatches,
+        with finalize=False, and calls finalize() once all of them are written'''
+        return
+
+    def finalize(self) -> None:
+        '''Work over the whole store, like persisting it or building its index,
+        done once after an upload rather than for every batch written'''
         return
 
     @abstractmethod
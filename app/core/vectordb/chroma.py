@@ -1,9 +1,11 @@
 '''Implemetations for vectordb interface for chroma'''
 import os
-from typing import List
+from typing import List, Union
 
 from core.vectordb import VectordbInterface
 from core.embedding.sentence_transformers import SentenceTransformerEmbedding
+from core.llm_framework.context_packer import count_tokens
+from core.document_batch import DocumentBatch, as_batch
 import schema
 from custom_exceptions import ChromaException
 
@@ -72,30 +74,44 @@ class Chroma(VectordbInterface):
         except Exception as exe:
             raise ChromaException("While initializing collection: "+str(exe)) from exe
 
-    def add_to_collection(self, docs: List[schema.Document], **kwargs) -> None:
-        '''Loads the document object as per chroma DB formats into the collection'''
+    def add_to_collection(self, docs: Union[DocumentBatch, List[schema.Document]],
+        finalize: bool = True, **kwargs) -> None:
+        '''Loads the document object as per chroma DB formats into the collection.
+        The documents without an embedding get theirs from chroma's embedding function'''
+        batch = as_batch(docs)
         metas = []
-        for doc in docs:
+        for text, label, links, media, metadata in zip(batch.texts, batch.labels,
+                batch.links, batch.media, batch.metadata):
             meta = {}
-            meta.update(doc.metadata)
-            meta.update({'label':doc.label,
-                         "media": ",".join(doc.media),
-                         'links':",".join(doc.links)})
+            meta.update(metadata)
+            meta.update({'label':label,
+                         "media": ",".join(media),
+                         'links':",".join(links),
+                         'token_count': metadata.get('token_count') or count_tokens(text)})
             metas.append(meta)
-        if docs[0].embedding is None:
-            embeddings = None
-        else:
-            embeddings=[doc.embedding for doc in docs]
+        # the embedded rows and the rest are added apart, so the given embeddings are kept
+        for indices, embeddings in ((batch.given_embeddings(), batch.embeddings),
+                                    (batch.missing_embeddings(), None)):
+            if not indices:
+                continue
+            try:
+                self.db_conn.add(
+                    embeddings=None if embeddings is None else embeddings[indices].tolist(),
+                    documents=[batch.texts[i] for i in indices],
+                    metadatas=[metas[i] for i in indices],
+                    ids=[batch.ids[i] for i in indices]
+                )
+            except Exception as exe:
+                raise ChromaException("While adding data: "+str(exe)) from exe
+        if finalize:
+            self.finalize()
+
+    def finalize(self) -> None:
+        '''Persists the DB. It rewrites the whole store, so it is done once per upload'''
         try:
-            self.db_conn.add(
-                embeddings=embeddings,
-                documents=[doc.text for doc in docs],
-                metadatas=metas,
-                ids=[doc.docId for doc in docs]
-            )
             self.db_client.persist()
         except Exception as exe:
-            raise ChromaException("While adding data: "+str(exe)) from exe
+            raise ChromaException("While persisting data: "+str(exe)) from exe
 
     def get_relevant_documents(self, query: str, **kwargs) -> List:
         '''Similarity search on the vector store'''
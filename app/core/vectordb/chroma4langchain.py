@@ -1,10 +1,15 @@
 '''Implemetations for vectordb interface for chroma'''
 import os
-from typing import List
+import asyncio
+from typing import List, Union
 from langchain.schema import Document as LangchainDocument
 from langchain.schema import BaseRetriever
 from core.vectordb import VectordbInterface
 from core.embedding.sentence_transformers import SentenceTransformerEmbedding
+from core.llm_framework.context_packer import count_tokens
+from core.vectordb.mmr import (maximal_marginal_relevance,
+    MMR_LAMBDA, MMR_DUPLICATE_THRESHOLD, MMR_FETCH_FACTOR)
+from core.document_batch import DocumentBatch, as_batch
 import schema
 from custom_exceptions import ChromaException
 
@@ -22,8 +27,13 @@ class Chroma(VectordbInterface, BaseRetriever):
     db_conn=None
     db_client=None
     embedding_function=None
-    def __init__(self, host=None, port=None, path="chromadb_store", collection_name=None) -> None: #pylint: disable=super-init-not-called
+    def __init__(self, host=None, port=None, path="chromadb_store", collection_name=None, #pylint: disable=super-init-not-called, too-many-arguments
+                 use_mmr=True, mmr_lambda=MMR_LAMBDA,
+                 duplicate_threshold=MMR_DUPLICATE_THRESHOLD) -> None:
         '''Instanciate a chroma client'''
+        self.use_mmr = use_mmr
+        self.mmr_lambda = mmr_lambda
+        self.duplicate_threshold = duplicate_threshold
         if host:
             self.db_host = host
         if port:
@@ -72,52 +82,72 @@ class Chroma(VectordbInterface, BaseRetriever):
         except Exception as exe:
             raise ChromaException("While initializing collection: "+str(exe)) from exe
 
-    def add_to_collection(self, docs: List[schema.Document], **kwargs) -> None:
-        '''Loads the document object as per chroma DB formats into the collection'''
+    def add_to_collection(self, docs: Union[DocumentBatch, List[schema.Document]],
+        finalize: bool = True, **kwargs) -> None:
+        '''Loads the document object as per chroma DB formats into the collection.
+        The documents without an embedding get theirs from chroma's embedding function'''
+        batch = as_batch(docs)
         metas = []
-        for doc in docs:
+        for text, label, links, media, metadata in zip(batch.texts, batch.labels,
+                batch.links, batch.media, batch.metadata):
             meta = {}
-            meta.update(doc.metadata)
-            meta.update({'label':doc.label,
-                         "media": ",".join(doc.media),
-                         'links':",".join(doc.links)})
+            meta.update(metadata)
+            meta.update({'label':label,
+                         "media": ",".join(media),
+                         'links':",".join(links),
+                         'token_count': metadata.get('token_count') or count_tokens(text)})
             metas.append(meta)
-        if docs[0].embedding is None:
-            embeddings = None
-        else:
-            embeddings=[doc.embedding for doc in docs]
+        # the embedded rows and the rest are added apart, so the given embeddings are kept
+        for indices, embeddings in ((batch.given_embeddings(), batch.embeddings),
+                                    (batch.missing_embeddings(), None)):
+            if not indices:
+                continue
+            try:
+                self.db_conn.add(
+                    embeddings=None if embeddings is None else embeddings[indices].tolist(),
+                    documents=[batch.texts[i] for i in indices],
+                    metadatas=[metas[i] for i in indices],
+                    ids=[batch.ids[i] for i in indices]
+                )
+            except Exception as exe:
+                raise ChromaException("While adding data: "+str(exe)) from exe
+        if finalize:
+            self.finalize()
+
+    def finalize(self) -> None:
+        '''Persists the DB. It rewrites the whole store, so it is done once per upload'''
         try:
-            self.db_conn.add(
-                embeddings=embeddings,
-                documents=[doc.text for doc in docs],
-                metadatas=metas,
-                ids=[doc.docId for doc in docs]
-            )
             self.db_client.persist()
         except Exception as exe:
-            raise ChromaException("While adding data: "+str(exe)) from exe
+            raise ChromaException("While persisting data: "+str(exe)) from exe
 
     def get_relevant_documents(self, query: str, **kwargs) -> List[LangchainDocument]:
-        '''Similarity search on the vector store'''
+        '''Similarity search on the vector store. With use_mmr, more candidates are fetched
+        and near duplicates among them are dropped by maximal marginal relevance'''
+        limit = int(QUERY_LIMIT)
+        include = ["documents", "metadatas", "distances"]
+        if self.use_mmr:
+            include.append("embeddings")
         results = self.db_conn.query(
             query_texts=[query],
-            n_results=QUERY_LIMIT,
+            n_results=limit * MMR_FETCH_FACTOR if self.use_mmr else limit,
+            include=include,
             # where={"metadata_field": "is_equal_to_this"},
             # where_document={"$contains":"search_string"}
         )
-        return [ LangchainDocument(page_content= doc, metadata={ "source": id_ } )
-                                for doc, id_ in zip(results['documents'][0], results['ids'][0])]
+        indices = range(min(limit, len(results['ids'][0])))
+        if self.use_mmr and results['ids'][0]:
+            indices = maximal_marginal_relevance(results['embeddings'][0],
+                [-dist for dist in results['distances'][0]], limit,
+                self.mmr_lambda, self.duplicate_threshold)
+        return [ LangchainDocument(page_content= results['documents'][0][i], metadata={
+                                    "source": results['ids'][0][i],
+                                    "token_count": (results['metadatas'][0][i] or {}).get("token_count")})
+                                for i in indices]
 
     async def aget_relevant_documents(self, query: str, **kwargs) -> List[LangchainDocument]:
-        '''Similarity search on the vector store'''
-        results = self.db_conn.query(
-            query_texts=[query],
-            n_results=QUERY_LIMIT,
-            # where={"metadata_field": "is_equal_to_this"},
-            # where_document={"$contains":"search_string"}
-        )
-        return [ LangchainDocument(page_content= doc, metadata={ "source": id_ } )
-                                for doc, id_ in zip(results['documents'][0], results['ids'][0])]
+        '''Similarity search on the vector store, run in a thread to not block the event loop'''
+        return await asyncio.to_thread(self.get_relevant_documents, query, **kwargs)
 
     def get_available_labels(self) -> List[str]:
         '''Query DB and find out the list of labels available in metadata,
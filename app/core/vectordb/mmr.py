@@ -0,0 +1,49 @@
+'''Maximal marginal relevance selection, to drop near duplicate chunks from retrieved results'''
+import os
+from typing import List
+
+import numpy as np
+
+MMR_LAMBDA = float(os.getenv('MMR_LAMBDA', "0.7")) # 1 is pure relevance, 0 is pure diversity
+MMR_DUPLICATE_THRESHOLD = float(os.getenv('MMR_DUPLICATE_THRESHOLD', "0.95"))
+MMR_FETCH_FACTOR = int(os.getenv('MMR_FETCH_FACTOR', "3")) # candidates fetched per result
+
+
+def normalize_rows(matrix) -> np.ndarray:
+    '''Row vectors scaled to unit length, so dot products are cosine similarities'''
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def maximal_marginal_relevance(embeddings,
+    relevance,
+    k:int,
+    lambda_mult:float = MMR_LAMBDA,
+    duplicate_threshold:float = MMR_DUPLICATE_THRESHOLD) -> List[int]:
+    '''Indices of up to k candidates, picked one at a time by
+    lambda * relevance - (1 - lambda) * (max similarity to those already picked).
+    Candidates with cosine similarity of duplicate_threshold or more to a picked one are
+    dropped. relevance is min-max scaled, so distances (negated) or similarities both work'''
+    num = len(relevance)
+    if num == 0:
+        return []
+    vectors = normalize_rows(embeddings)
+    similarity = vectors @ vectors.T
+    relevance = np.asarray(relevance, dtype=np.float32)
+    spread = relevance.max() - relevance.min()
+    relevance = (relevance - relevance.min()) / spread if spread > 0 else np.ones(num)
+
+    selected = []
+    max_similarity = np.zeros(num, dtype=np.float32)
+    available = np.ones(num, dtype=bool)
+    while len(selected) < k and available.any():
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        available &= similarity[best] < duplicate_threshold
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return selected
@@ -1,23 +1,32 @@
 '''Implemetations for vectordb interface for postgres with vector store'''
 import math
 import os
-from typing import List, Optional
+import asyncio
+from typing import List, Optional, Union
 from langchain.schema import Document as LangchainDocument
 from langchain.schema import BaseRetriever
 from pydantic import Field
 from core.vectordb import VectordbInterface
 from core.embedding import EmbeddingInterface
+from core.rate_limiter import Priority
+from core.llm_framework.context_packer import count_tokens
+from core.vectordb.mmr import (maximal_marginal_relevance,
+    MMR_LAMBDA, MMR_DUPLICATE_THRESHOLD, MMR_FETCH_FACTOR)
 import schema
+from core.document_batch import DocumentBatch, as_batch
 from custom_exceptions import PostgresException, GenericException
 import numpy as np
 
 import psycopg2
-from psycopg2.extras import execute_values
+from psycopg2.extras import execute_values, Json
 from pgvector.psycopg2 import register_vector
 from log_configs import log
 
 #pylint: disable=too-few-public-methods, unused-argument
 QUERY_LIMIT = os.getenv('POSTGRES_DB_QUERY_LIMIT', "10")
+INDEX_NAME = "embeddings_embedding_idx"
+# the ivfflat index is rebuilt when the table needs this many times the lists it was built with
+INDEX_REBUILD_FACTOR = float(os.getenv('POSTGRES_INDEX_REBUILD_FACTOR', "2"))
 
 class Postgres(VectordbInterface, BaseRetriever): #pylint: disable=too-many-instance-attributes
     '''Interface for vector database technology, its connection, configs and operations'''
@@ -43,7 +52,10 @@ class Postgres(VectordbInterface, BaseRetriever): #pylint: disable=too-many-inst
             raise ValueError("You MUST set embedding with PGVector, since with this DB type the embedding dimension size always hard-coded on init")
         self.embedding = embedding
         self.labels = kwargs.get("labels",["tyndale_open"])
-        self.query_limit = kwargs.get("query_limit", QUERY_LIMIT)
+        self.query_limit = int(kwargs.get("query_limit", QUERY_LIMIT))
+        self.use_mmr = kwargs.get("use_mmr", True)
+        self.mmr_lambda = kwargs.get("mmr_lambda", MMR_LAMBDA)
+        self.duplicate_threshold = kwargs.get("duplicate_threshold", MMR_DUPLICATE_THRESHOLD)
         if host:
             self.db_host = host
         if port:
@@ -98,84 +110,105 @@ class Postgres(VectordbInterface, BaseRetriever): #pylint: disable=too-many-inst
         except Exception as exe:
             raise PostgresException("While initializing client: "+str(exe)) from exe
 
-    def add_to_collection(self, docs: List[schema.Document], **kwargs) -> None:
-        '''Loads the document object as per chroma DB formats into the collection'''
+    def add_to_collection(self, docs: Union[DocumentBatch, List[schema.Document]],
+        finalize: bool = True, **kwargs) -> None:
+        '''Loads the document object as per chroma DB formats into the collection.
+        Embeddings go to pgvector as rows of the batch's float32 matrix'''
         data_list = []
-        for doc in docs:
+        for doc in as_batch(docs).rows():
+            meta = dict(doc.metadata)
+            if not meta.get('token_count'):
+                meta['token_count'] = count_tokens(doc.text)
+            media, links = list(doc.media), list(doc.links)
             cur = self.db_conn.cursor()
             cur.execute("SELECT 1 FROM embeddings WHERE source_id = %s", (doc.docId,))
             doc_id_already_exists = cur.fetchone()
             if not doc_id_already_exists:
-                data_list.append([doc.docId, doc.text, doc.label, doc.media, doc.links, doc.embedding])
+                data_list.append([doc.docId, doc.text, doc.label, media, links,
+                    doc.embedding, Json(meta)])
             else:
                 # Update instead of add
-                cur.execute("UPDATE embeddings SET document = %s, label = %s, media = %s, links = %s, embedding = %s WHERE source_id = %s",
-                    (doc.text, doc.label, doc.media, doc.links, doc.embedding, doc.docId))
+                cur.execute("UPDATE embeddings SET document = %s, label = %s, media = %s, links = %s, embedding = %s, metadata = %s WHERE source_id = %s",
+                    (doc.text, doc.label, media, links, doc.embedding, Json(meta), doc.docId))
             cur.close()
         try:
             cur = self.db_conn.cursor()
             execute_values(cur,
-                "INSERT INTO embeddings (source_id, document, label, media, links, embedding"\
-                 ") VALUES %s", data_list)
+                "INSERT INTO embeddings (source_id, document, label, media, links, embedding,"\
+                 " metadata) VALUES %s", data_list)
             self.db_conn.commit()
+            cur.close()
+        except Exception as exe:
+            raise PostgresException("While adding data: "+str(exe)) from exe
+        if finalize:
+            self.finalize()
 
-            # create index
+    def finalize(self) -> None:
+        '''Builds the ivfflat index, under one name so there is never more than one.
+        It is rebuilt only when the table has grown to need INDEX_REBUILD_FACTOR times the
+        lists it was built with, so repeated uploads do not rebuild it every time'''
+        try:
+            cur = self.db_conn.cursor()
             cur.execute("SELECT COUNT(*) as cnt FROM embeddings;")
             num_records = cur.fetchone()[0]
-            num_lists = num_records / 1000
-            num_lists = max(10, num_lists, math.sqrt(num_records))
+            num_lists = int(max(10, num_records / 1000, math.sqrt(num_records)))
+            cur.execute("SELECT reloptions FROM pg_class WHERE relname = %s", (INDEX_NAME,))
+            row = cur.fetchone()
+            if row is not None:
+                options = dict(option.split("=", 1) for option in row[0] or [])
+                if num_lists < int(options.get("lists", 0)) * INDEX_REBUILD_FACTOR:
+                    cur.close()
+                    return
+            # unnamed indexes, one per upload, were made before the index had a name
+            cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'embeddings'"
+                " AND indexdef LIKE '%%ivfflat%%'")
+            for (index,) in cur.fetchall():
+                cur.execute(f'DROP INDEX IF EXISTS "{index}"')
             #use the cosine distance measure, which is what we'll later use for querying
-            cur.execute("CREATE INDEX ON embeddings USING ivfflat (embedding vector_cosine_ops) "+\
-                f"WITH (lists = {num_lists});")
+            cur.execute(f"CREATE INDEX {INDEX_NAME} ON embeddings USING ivfflat "
+                f"(embedding vector_cosine_ops) WITH (lists = {num_lists});")
             self.db_conn.commit()
-
             cur.close()
+            log.info("Built the embeddings index with %s lists, for %s rows",
+                num_lists, num_records)
         except Exception as exe:
-            raise PostgresException("While adding data: "+str(exe)) from exe
+            raise PostgresException("While indexing: "+str(exe)) from exe
 
     def get_relevant_documents(self, query: list, **kwargs) -> List[LangchainDocument]:
-        '''Similarity search on the vector store'''
+        '''Similarity search on the vector store. With use_mmr, more candidates are fetched
+        and near duplicates among them are dropped by maximal marginal relevance'''
         query_doc = schema.Document(docId="xxx", text=query)
         try:
-            self.embedding.get_embeddings(doc_list=[query_doc])
+            self.embedding.get_embeddings(doc_list=[query_doc], priority=Priority.INTERACTIVE)
             query_vector = query_doc.embedding
         except Exception as exe:
             raise GenericException("While vectorising the query: "+str(exe)) from exe
         try:
+            query_vector = np.array(query_vector)
             cur = self.db_conn.cursor()
             cur.execute(
-                "SELECT source_id, document FROM embeddings "+\
-                "where label = ANY(%s) ORDER BY embedding <=> %s LIMIT %s;",
-                (self.labels, np.array(query_vector), self.query_limit))
+                "SELECT source_id, document, metadata->>'token_count', "+\
+                "embedding <=> %s AS distance, embedding FROM embeddings "+\
+                "where label = ANY(%s) ORDER BY distance LIMIT %s;",
+                (query_vector, self.labels,
+                 self.query_limit * MMR_FETCH_FACTOR if self.use_mmr else self.query_limit))
             records = cur.fetchall()
             cur.close()
         except Exception as exe:
             log.exception(exe)
             raise PostgresException("While querying with embedding: "+ str(exe)) from exe
-        return [ LangchainDocument(page_content= doc[1], metadata={ "source": doc[0] } )
+        if self.use_mmr and records:
+            indices = maximal_marginal_relevance([row[4] for row in records],
+                [-row[3] for row in records], self.query_limit,
+                self.mmr_lambda, self.duplicate_threshold)
+            records = [records[i] for i in indices]
+        return [ LangchainDocument(page_content= doc[1],
+                                    metadata={ "source": doc[0], "token_count": doc[2] } )
                                 for doc in records]
 
     async def aget_relevant_documents(self, query: list, **kwargs) -> List[LangchainDocument]:
-        '''Similarity search on the vector store'''
-        query_doc = schema.Document(docId="xxx", text=query)
-        try:
-            self.embedding.get_embeddings(doc_list=[query_doc])
-            query_vector = query_doc.embedding
-        except Exception as exe:
-            raise GenericException("While vectorising the query: "+str(exe)) from exe
-        try:
-            cur = self.db_conn.cursor()
-            cur.execute(
-                "SELECT source_id, document FROM embeddings "+\
-                "where label = ANY(%s) ORDER BY embedding <=> %s LIMIT %s;",
-                (self.labels, np.array(query_vector), self.query_limit))
-            records = cur.fetchall()
-            cur.close()
-        except Exception as exe:
-            log.exception(exe)
-            raise PostgresException("While querying with embedding: "+ str(exe)) from exe
-        return [ LangchainDocument(page_content= doc[1], metadata={ "source": doc[0] } )
-                                for doc in records]
+        '''Similarity search on the vector store, run in a thread to not block the event loop'''
+        return await asyncio.to_thread(self.get_relevant_documents, query, **kwargs)
 
     def get_available_labels(self) -> List[str]:
         '''Query DB and find out the list of labels available in metadata,
@@ -8,6 +8,30 @@ class UnprocessableException(Exception):
         self.detail = detail
         self.status_code = 422
 
+class PayloadTooLargeException(Exception):
+    """Format for uploads over the size limit"""
+    def __init__(self, detail: str):
+        super().__init__()
+        self.name = "Payload Too Large"
+        self.detail = detail
+        self.status_code = 413
+
+class NotFoundException(Exception):
+    """Format for requests for things that do not exist"""
+    def __init__(self, detail: str):
+        super().__init__()
+        self.name = "Not Found"
+        self.detail = detail
+        self.status_code = 404
+
+class UnsupportedMediaException(Exception):
+    """Format for request bodies of a type not handled"""
+    def __init__(self, detail: str):
+        super().__init__()
+        self.name = "Unsupported Media Type"
+        self.detail = detail
+        self.status_code = 415
+
 class PermissionException(Exception):
     '''Format for permission error'''
     def __init__(self, detail: str):
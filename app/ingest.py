@@ -0,0 +1,82 @@
+'''Command line ingestion of a directory, or a zip/tar archive, of text, markdown, CSV/TSV,
+USFM and USX files into the vector DB, without going through the API. Run from the app folder:
+
+    python ingest.py ../recipes/data/translationwords --label translationwords
+'''
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+import schema
+from core.file_processor.bulk import BULK_PARSE_WORKERS, extract_archive, is_archive
+
+
+def parse_args(argv=None):
+    '''The command line options'''
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("path", help="Directory, or zip/tar archive, of files to ingest")
+    parser.add_argument("--label", default=None,
+        help="Label for the documents of the text and markdown files")
+    parser.add_argument("--file-processor", default=schema.FileProcessorType.LANGCHAIN.value,
+        choices=[choice.value for choice in schema.FileProcessorType])
+    parser.add_argument("--vectordb", default=schema.DatabaseType.CHROMA.value,
+        choices=[choice.value for choice in schema.DatabaseType])
+    parser.add_argument("--host-n-port", default=None, help="Of the DB server, host:port")
+    parser.add_argument("--db-path", default=os.getenv("CHROMA_DB_PATH", "chromadb_store"),
+        help="Chroma DB folder")
+    parser.add_argument("--collection", default=None, help="Collection or table name")
+    parser.add_argument("--user", default=os.getenv('POSTGRES_DB_USER', 'admin'))
+    parser.add_argument("--embedding", default=None,
+        choices=[choice.value for choice in schema.EmbeddingType],
+        help="Embed before the write. Otherwise the DB's own embedding is used")
+    parser.add_argument("--bible-unit", default=schema.BibleDocumentUnit.VERSE.value,
+        choices=[choice.value for choice in schema.BibleDocumentUnit],
+        help="For USFM and USX files, a document per verse or per pericope")
+    parser.add_argument("--workers", type=int, default=BULK_PARSE_WORKERS,
+        help="Processes parsing the files")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    '''Ingests the files and prints the stats. Exits with 1 if any file failed'''
+    # here, as the parsing processes re-import this module and have no use for the stack
+    from core.pipeline import DataUploadPipeline #pylint: disable=import-outside-toplevel
+
+    args = parse_args(argv)
+    data_stack = DataUploadPipeline()
+    data_stack.set_file_processor(schema.FileProcessorType(args.file_processor))
+    data_stack.set_vectordb(schema.DatabaseType(args.vectordb),
+        host_n_port=args.host_n_port,
+        path=args.db_path,
+        collection_name=args.collection,
+        user=args.user,
+        password=os.getenv('POSTGRES_DB_PASSWORD', 'secret'))
+    if args.embedding:
+        data_stack.set_embedding(schema.EmbeddingType(args.embedding))
+
+    run_args = {"label": args.label, "embed": bool(args.embedding), "workers": args.workers,
+        "bible_unit": args.bible_unit}
+    if os.path.isdir(args.path):
+        stats = data_stack.run_directory(args.path, **run_args)
+    elif os.path.isfile(args.path) and is_archive(args.path):
+        with tempfile.TemporaryDirectory(prefix="ingest-") as directory:
+            extract_archive(args.path, directory)
+            stats = data_stack.run_directory(directory,
+                source_prefix=f"{args.path.rstrip('/')}/", **run_args)
+    else:
+        print(f"{args.path} is neither a directory nor a zip/tar archive", file=sys.stderr)
+        return 2
+
+    for failed in stats['failed_files']:
+        print(f"FAILED {failed['file']}: {failed['error']}", file=sys.stderr)
+    print(json.dumps(stats, indent=2))
+    print(f"Ingested {stats['documents']} documents from "
+        f"{stats['files_parsed'] - len(stats['failed_files'])} of {stats['files']} files "
+        f"in {stats['elapsed_seconds']}s, {stats['docs_per_second']} docs/sec", file=sys.stderr)
+    return 1 if stats['failed_files'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,11 +2,14 @@
 import string
 import random
 import time
+import asyncio
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from core.embedding.sentence_transformers import SentenceTransformerEmbedding
+from core.openai_client import openai_http
+from core.jobs.worker import WorkerPool
 
 from log_configs import log
 import routers
@@ -25,12 +28,27 @@ app.add_middleware(
 
 
 DB_COLLECTION = None
+JOB_WORKERS = WorkerPool(routers.JOB_STORE.path)
+BACKGROUND_TASKS = []
 
 @app.on_event("startup")
 async def startup_event():
     '''Any setup we need on start up'''
     log.info("App is starting...")
     SentenceTransformerEmbedding() # instantiate once to download the model
+    routers.answer_cache()
+    openai_http.install()
+    JOB_WORKERS.start()
+    BACKGROUND_TASKS.append(asyncio.create_task(routers.watch_finished_jobs()))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    '''Stops the job workers and releases the pooled connections'''
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    BACKGROUND_TASKS.clear()
+    await asyncio.to_thread(JOB_WORKERS.stop)
+    await openai_http.aclose()
 
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
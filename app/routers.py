@@ -1,6 +1,9 @@
 '''API endpoint definitions'''
 import os
-from typing import List
+import json
+import time
+import asyncio
+from typing import List, Optional, Tuple
 from fastapi import (
                     APIRouter,
                     Request,
@@ -19,12 +22,21 @@ import schema
 from log_configs import log
 from core.auth import (admin_auth_check_decorator,
     chatbot_auth_check_decorator, chatbot_get_labels_decorator)
-from core.pipeline import ConversationPipeline, DataUploadPipeline
+from core.pipeline import ConversationPipeline
 from core.vectordb.chroma import Chroma
 from core.vectordb.postgres4langchain import Postgres
 from core.embedding.openai import OpenAIEmbedding
-from core.embedding.sentence_transformers import SentenceTransformerEmbedding
-from custom_exceptions import PermissionException, GenericException
+from core.embedding.sentence_transformers import SentenceTransformerEmbedding, shared_embedding
+from core.llm_framework.semantic_cache import SemanticCache
+from core.rate_limiter import openai_scheduler
+from core.audio.streaming import IncrementalTranscriber
+from core.file_processor.storage import save_upload, save_stream, UPLOAD_PATH
+from core.file_processor.records import CONTENT_TYPES as RECORD_CONTENT_TYPES
+from core.file_processor.bulk import is_archive
+from core.jobs import JobStore
+from core.jobs.worker import JOB_POLL_SECONDS
+from custom_exceptions import (PermissionException, GenericException, NotFoundException,
+    UnprocessableException, UnsupportedMediaException)
 from core.auth.supabase import supa
 
 router = APIRouter()
@@ -41,7 +53,19 @@ CHROMA_DB_PATH = os.environ.get("CHROMA_DB_PATH", "chromadb_store")
 CHROMA_DB_COLLECTION = os.environ.get("CHROMA_DB_COLLECTION", "adotbcollection")
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
-UPLOAD_PATH = "./uploaded-files/"
+
+# Shared across all chat connections, so paraphrased questions are answered from here.
+# Made on first use, so importing the routers does not load the embedding model
+ANSWER_CACHE:Optional[SemanticCache] = None
+# Uploads are run as jobs by the worker processes started with the app
+JOB_STORE = JobStore()
+
+def answer_cache() -> SemanticCache:
+    '''The answer cache of the app, made on first use'''
+    global ANSWER_CACHE #pylint: disable=global-statement
+    if ANSWER_CACHE is None:
+        ANSWER_CACHE = SemanticCache(embedding=shared_embedding())
+    return ANSWER_CACHE
 
 @router.get("/",
     response_class=HTMLResponse,
@@ -111,6 +135,33 @@ async def get_login(request: Request):
         {"request": request, "ws_url": WS_URL, "demo_url":f"http://{DOMAIN}/ui",
         "demo_url2":f"http://{DOMAIN}/ui2"})
 
+def split_frame(data:bytes) -> Tuple[Optional[schema.FrameType], memoryview]:
+    '''The type and payload of a chat frame. Type is None for the older clients that
+    send the text or the recorded audio file as is'''
+    if data:
+        try:
+            return schema.FrameType(data[0]), memoryview(data)[1:]
+        except ValueError:
+            pass
+    return None, memoryview(data)
+
+AUDIO_START_LIMITS = {"sample_rate": (8000, 48000), "channels": (1, 2)}
+
+def audio_start_args(payload) -> dict:
+    '''The recording settings in an audio start frame, checked against AUDIO_START_LIMITS'''
+    audio_args = json.loads(bytes(payload) or b"{}")
+    if not isinstance(audio_args, dict):
+        raise ValueError("Audio start settings should be a JSON object")
+    args = {}
+    for key, (low, high) in AUDIO_START_LIMITS.items():
+        if key not in audio_args:
+            continue
+        value = audio_args[key]
+        if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+            raise ValueError(f"Audio {key} should be a whole number from {low} to {high}")
+        args[key] = value
+    return args
+
 def compose_vector_db_args(db_type, settings):
     '''Convert the API params or default values, to args to initializing the DB'''
     vectordb_args = {}
@@ -143,10 +194,44 @@ def compose_vector_db_args(db_type, settings):
         vectordb_args['collection_name']=POSTGRES_DB_NAME
     return vectordb_args
 
+def enqueue_upload(vectordb_type, vectordb_args, reuse_job=False, **params):
+    '''Saves an upload job for the workers and returns it in the shape of schema.Job.
+    With reuse_job, an earlier job with the same params (the stored file is named by its
+    sha256), that has not failed, is returned instead, so the same contents are not parsed
+    and embedded again. The configured Postgres password is left for the worker to read
+    from its environment, rather than stored with the job'''
+    vectordb_args = {key: value for key, value in vectordb_args.items()
+                        if not (key == 'password' and value == POSTGRES_DB_PASSWORD)}
+    params = {"vectordb_type": vectordb_type.value, "vectordb_args": vectordb_args, **params}
+    if reuse_job:
+        job = JOB_STORE.find_same("upload", params)
+        if job is not None:
+            log.info("Same upload as job %s, not ingesting it again", job['jobId'])
+            return job
+    job_id = JOB_STORE.enqueue("upload", params)
+    log.info("Queued upload job %s", job_id)
+    return JOB_STORE.get(job_id)
+
+async def watch_finished_jobs(interval:float = JOB_POLL_SECONDS):
+    '''Clears the cached answers for the labels of each upload job, as it finishes.
+    Runs for the life of the app'''
+    since = time.time()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            finished = await asyncio.to_thread(JOB_STORE.finished_after, since)
+        except Exception as exe: #pylint: disable=broad-exception-caught
+            log.exception(exe)
+            continue
+        for finished_at, output in finished:
+            if ANSWER_CACHE is not None:
+                ANSWER_CACHE.invalidate(labels=output.get('labels'))
+            since = finished_at
+
 @router.websocket("/chat")
 @chatbot_auth_check_decorator
 @chatbot_get_labels_decorator
-async def websocket_chat_endpoint(websocket: WebSocket,
+async def websocket_chat_endpoint(websocket: WebSocket, #pylint: disable=too-many-branches, too-many-locals, too-many-statements
     # jwt_bearer: JWTBearer=Depends(JWTBearer()),
     settings=Depends(schema.ChatPipelineSelector),
     # user:str=Query(..., desc= "user id of the end user accessing the chat bot"),
@@ -178,70 +263,140 @@ async def websocket_chat_endpoint(websocket: WebSocket,
     if settings.llmApiKey:
         llm_args['api_key']=settings.llmApiKey
     if settings.llmModelName:
-        llm_args['model']=settings.llmModelName
+        llm_args['model_name']=settings.llmModelName
+    llm_args['condense_strategy'] = settings.condenseStrategy
+    llm_args['speculative_retrieval'] = settings.speculativeRetrieval
+    llm_args['compress_context'] = settings.compressContext
+    if settings.condenseModelName:
+        llm_args['condense_model_name'] = settings.condenseModelName
     chat_stack.set_llm_framework(settings.llmFrameworkType,
-        vectordb=chat_stack.vectordb, **llm_args)
+        vectordb=chat_stack.vectordb, answer_cache=answer_cache(), **llm_args)
     chat_stack.set_transcription_framework(settings.transcriptionFrameworkType)
 
     ### Not implemented using custom embeddings
 
-    while True:
-        try:
-            # Receive and send back the client message
-            received_bytes = await websocket.receive_bytes()
-            try:  # Try treating the bytes as text
-                received_question = received_bytes.decode('utf-8')
-                log.info("Text received")
-                question = received_question
-            except UnicodeDecodeError:  # If that fails, treat it as audio
-                log.info("Audio file received")
-                question = chat_stack.transcription_framework.transcribe_audio(received_bytes)
-                start_human_q = schema.BotResponse(sender=schema.SenderType.USER,
-                    message=question, type=schema.ChatResponseType.QUESTION,
-                    sources=[],
-                    media=[])
-                await websocket.send_json(start_human_q.dict())
-
-            # # send back the response
-            # resp = schema.BotResponse(sender=schema.SenderType.USER,
-            #     message=question, type=schema.ChatResponseType.QUESTION)
-            # await websocket.send_json(resp.dict())
-
-            bot_response = chat_stack.llm_framework.generate_text(
-                            query=question, chat_history=chat_stack.chat_history)
-            log.debug(f"Human: {question}\nBot:{bot_response['answer']}\n"+\
-                "Sources:"+\
-                f"{[item.metadata['source'] for item in bot_response['source_documents']]}\n\n")
-            chat_stack.chat_history.append((bot_response['question'], bot_response['answer']))
-
-            # Construct a response
-            start_resp = schema.BotResponse(sender=schema.SenderType.BOT,
-                    message=bot_response['answer'], type=schema.ChatResponseType.ANSWER,
-                    sources=[item.metadata['source'] for item in bot_response['source_documents']],
-                    media=[])
-            await websocket.send_json(start_resp.dict())
-
-        except WebSocketDisconnect:
-            if isinstance(chat_stack.vectordb, Chroma):
-                chat_stack.vectordb.db_client.persist()
-            log.info("websocket disconnect")
-            break
-        except Exception as exe: #pylint: disable=broad-exception-caught
-            log.exception(exe)
-            resp = schema.BotResponse(
-                sender=schema.SenderType.BOT,
-                message="Sorry, something went wrong. Try again.",
-                type=schema.ChatResponseType.ERROR,
-            )
-            await websocket.send_json(resp.dict())
+    async def send_transcript(text):
+        transcript_resp = schema.BotResponse(sender=schema.SenderType.USER,
+            message=text, type=schema.ChatResponseType.QUESTION,
+            sources=[],
+            media=[])
+        await websocket.send_json(transcript_resp.dict())
+
+    audio_stream = None
+    try:
+        while True:
+            try:
+                # Receive and send back the client message
+                received_bytes = await websocket.receive_bytes()
+                frame_type, payload = split_frame(received_bytes)
+                if frame_type == schema.FrameType.AUDIO_START:
+                    if audio_stream is not None:
+                        audio_stream.cancel()
+                        audio_stream = None
+                    try:
+                        audio_args = audio_start_args(payload)
+                    except ValueError as exe:
+                        resp = schema.BotResponse(sender=schema.SenderType.BOT,
+                            message=str(exe), type=schema.ChatResponseType.ERROR)
+                        await websocket.send_json(resp.dict())
+                        continue
+                    audio_stream = IncrementalTranscriber(chat_stack.transcription_framework,
+                        on_partial=send_transcript, **audio_args)
+                    continue
+                if frame_type == schema.FrameType.AUDIO_CHUNK:
+                    if audio_stream is None:
+                        raise GenericException("Audio chunk received without an audio start frame")
+                    audio_stream.feed(payload)
+                    continue
+                if frame_type == schema.FrameType.AUDIO_END:
+                    if audio_stream is None:
+                        raise GenericException("Audio end received without an audio start frame")
+                    question = await audio_stream.finish()
+                    audio_stream = None
+                    log.info("Streamed audio transcribed")
+                    if not question:
+                        raise GenericException("Could not make out a question in the recording")
+                    await send_transcript(question)
+                elif frame_type == schema.FrameType.TEXT:
+                    question = payload.tobytes().decode('utf-8')
+                    log.info("Text received")
+                else:
+                    try:  # Try treating the bytes as text
+                        received_question = received_bytes.decode('utf-8')
+                        log.info("Text received")
+                        question = received_question
+                    except UnicodeDecodeError as exe:  # If that fails, treat it as audio
+                        log.info("Audio file received")
+                        question = await chat_stack.transcription_framework.atranscribe_audio(
+                            received_bytes)
+                        if not question:
+                            raise GenericException(
+                                "Could not make out a question in the recording") from exe
+                        await send_transcript(question)
+
+                # # send back the response
+                # resp = schema.BotResponse(sender=schema.SenderType.USER,
+                #     message=question, type=schema.ChatResponseType.QUESTION)
+                # await websocket.send_json(resp.dict())
+
+                if settings.streaming:
+                    async def send_answer_chunk(token):
+                        chunk_resp = schema.BotResponse(sender=schema.SenderType.BOT,
+                            message=token, type=schema.ChatResponseType.ANSWER_CHUNK,
+                            sources=[],
+                            media=[])
+                        await websocket.send_json(chunk_resp.dict())
+                    bot_response = await chat_stack.llm_framework.stream_text(
+                                query=question, chat_history=chat_stack.chat_history,
+                                token_callback=send_answer_chunk)
+                else:
+                    bot_response = await chat_stack.llm_framework.agenerate_text(
+                                query=question, chat_history=chat_stack.chat_history)
+                log.debug(f"Human: {question}\nBot:{bot_response['answer']}\n"+\
+                    f"LLM calls:{bot_response.get('llm_calls')}\n"+\
+                    "Sources:"+\
+                    f"{[item.metadata['source'] for item in bot_response['source_documents']]}\n\n")
+                chat_stack.chat_history.append((bot_response['question'], bot_response['answer']))
+
+                # Construct a response
+                start_resp = schema.BotResponse(sender=schema.SenderType.BOT,
+                        message=bot_response['answer'], type=schema.ChatResponseType.ANSWER,
+                        sources=[item.metadata['source']
+                            for item in bot_response['source_documents']],
+                        media=[])
+                await websocket.send_json(start_resp.dict())
+                # Off the critical path, after the answer is sent
+                chat_stack.chat_history.schedule_summary(
+                    chat_stack.llm_framework.asummarize_history)
+
+            except WebSocketDisconnect:
+                if audio_stream is not None:
+                    audio_stream.cancel()
+                chat_stack.chat_history.cancel_summary()
+                if isinstance(chat_stack.vectordb, Chroma):
+                    chat_stack.vectordb.db_client.persist()
+                log.info("websocket disconnect")
+                break
+            except Exception as exe: #pylint: disable=broad-exception-caught
+                log.exception(exe)
+                resp = schema.BotResponse(
+                    sender=schema.SenderType.BOT,
+                    message="Sorry, something went wrong. Try again.",
+                    type=schema.ChatResponseType.ERROR,
+                )
+                await websocket.send_json(resp.dict())
+    finally:
+        # not to spend the rate budget and an LLM call on a closed chat
+        chat_stack.chat_history.cancel_summary()
+
 
 @router.post("/upload/sentences",
-    response_model=schema.APIInfoResponse,
+    response_model=schema.Job,
     responses={
         422: {"model": schema.APIErrorResponse},
         403: {"model": schema.APIErrorResponse},
         500: {"model": schema.APIErrorResponse}},
-    status_code=201, tags=["Data Management"])
+    status_code=202, tags=["Data Management"])
 @admin_auth_check_decorator
 async def upload_sentences(
     document_objs:List[schema.Document]=Body(...,
@@ -254,29 +409,76 @@ async def upload_sentences(
     '''* Upload of any kind of data that has been pre-processed as list of sentences.
     * Vectorises the text using OpenAI embdedding (or the one set in chroma DB settings).
     * Keeps other details, sourceTag, link, and media as metadata in vector store
-    * embedding_type: optional for ChromaDB. For Postgres, if none, will use OpenAIEmbedding'''
+    * embedding_type: optional for ChromaDB. For Postgres, if none, will use OpenAIEmbedding
+    * Runs as a background job. Its progress can be checked at /job/{jobId}'''
+    log.info("Access token used:%s", token)
+    vectordb_args = compose_vector_db_args(vectordb_type, vectordb_config)
+    if not embedding_type and vectordb_type==schema.DatabaseType.POSTGRES:
+        embedding_type=schema.EmbeddingType.OPENAI
+    return enqueue_upload(vectordb_type, vectordb_args,
+        embedding_type=embedding_type.value if embedding_type else None,
+        documents=[doc.dict() for doc in document_objs])
+
+@router.post("/upload/sentences/stream",
+    response_model=schema.Job,
+    responses={
+        413: {"model": schema.APIErrorResponse},
+        415: {"model": schema.APIErrorResponse},
+        422: {"model": schema.APIErrorResponse},
+        403: {"model": schema.APIErrorResponse},
+        500: {"model": schema.APIErrorResponse}},
+    status_code=202, tags=["Data Management"])
+@admin_auth_check_decorator
+async def upload_sentences_stream( #pylint: disable=too-many-arguments
+    request:Request,
+    label:str=Query(None, desc="Label for the documents that do not have one"),
+    vectordb_type:schema.DatabaseType=Query(schema.DatabaseType.CHROMA),
+    vectordb_config:schema.DBSelector = Depends(schema.DBSelector),
+    embedding_type:schema.EmbeddingType=Query(None),
+    reingest:bool=Query(False, desc="Ingest again, even if the same contents were "+\
+        "uploaded with the same settings before"),
+    token:SecretStr=Query(None,
+        desc="Optional access token to be used if user accounts not present")):
+    '''* Streaming variant of /upload/sentences, for large loads.
+    * The body is NDJSON (Content-Type application/x-ndjson), a document object per line,
+    or an Arrow IPC stream (application/vnd.apache.arrow.stream) with a column per field
+    * Precomputed embeddings can be a list of floats, or packed little endian float32:
+    base64 in NDJSON, binary or fixed size list of float32 in Arrow
+    * The body is spooled to disk as it arrives, then validated and added batch by batch.
+    Invalid records are skipped and listed in the job output
+    * embedding_type: for documents without an embedding. For Postgres, if none,
+    will use OpenAIEmbedding
+    * The same contents uploaded again with the same settings return the earlier job,
+    unless reingest is set
+    * Runs as a background job. Its progress can be checked at /job/{jobId}'''
     log.info("Access token used:%s", token)
-    data_stack = DataUploadPipeline()
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in RECORD_CONTENT_TYPES:
+        raise UnsupportedMediaException(
+            f"Content-Type should be one of {', '.join(RECORD_CONTENT_TYPES)}")
+    record_format = RECORD_CONTENT_TYPES[content_type]
     vectordb_args = compose_vector_db_args(vectordb_type, vectordb_config)
-    data_stack.set_vectordb(vectordb_type,**vectordb_args)
     if not embedding_type and vectordb_type==schema.DatabaseType.POSTGRES:
         embedding_type=schema.EmbeddingType.OPENAI
-    if embedding_type:
-        data_stack.set_embedding(embedding_type)
-        # FIXME: This may have to be a background job!!!
-        data_stack.embedding.get_embeddings(doc_list=document_objs)
 
-    # FIXME: This may have to be a background job!!!
-    data_stack.vectordb.add_to_collection(docs=document_objs)
-    return {"message": "Documents added to DB"}
+    stored = await save_stream(request.stream(), f".{record_format.value}", UPLOAD_PATH,
+        text=record_format == schema.RecordFormat.NDJSON)
+
+    return enqueue_upload(vectordb_type, vectordb_args,
+        reuse_job=stored.duplicate and not reingest,
+        embedding_type=embedding_type.value if embedding_type else None,
+        records=stored.path,
+        record_format=record_format.value,
+        label=label)
 
 @router.post("/upload/text-file",
-    response_model=schema.APIInfoResponse,
+    response_model=schema.Job,
     responses={
+        413: {"model": schema.APIErrorResponse},
         422: {"model": schema.APIErrorResponse},
         403: {"model": schema.APIErrorResponse},
         500: {"model": schema.APIErrorResponse}},
-    status_code=201, tags=["Data Management"])
+    status_code=202, tags=["Data Management"])
 @admin_auth_check_decorator
 async def upload_text_file( #pylint: disable=too-many-arguments
     file_obj: UploadFile,
@@ -285,59 +487,48 @@ async def upload_text_file( #pylint: disable=too-many-arguments
     vectordb_type:schema.DatabaseType=Query(schema.DatabaseType.CHROMA),
     vectordb_config:schema.DBSelector = Depends(schema.DBSelector),
     embedding_type:schema.EmbeddingType=Query(None),
+    reingest:bool=Query(False, desc="Ingest again, even if the same contents were "+\
+        "uploaded with the same settings before"),
     token:SecretStr=Query(None,
         desc="Optional access token to be used if user accounts not present")):
     '''* Upload of any kind text files like .md, .txt etc.
     * Splits the whole document into smaller chunks using the selected file_processor
     * Vectorises the text using OpenAI embdedding (or the one set in chroma DB settings).
     * Keeps other details, sourceTag, link, and media as metadata in vector store
-    * embedding_type: optional for ChromaDB. For Postgres, if none, will use OpenAIEmbedding'''
+    * embedding_type: optional for ChromaDB. For Postgres, if none, will use OpenAIEmbedding
+    * The same contents uploaded again with the same settings return the earlier job,
+    unless reingest is set
+    * Runs as a background job. Its progress can be checked at /job/{jobId}'''
     log.info("Access token used: %s", token)
     if not embedding_type and vectordb_type==schema.DatabaseType.POSTGRES:
         embedding_type=schema.EmbeddingType.HUGGINGFACE_DEFAULT
     vectordb_args = compose_vector_db_args(vectordb_type, vectordb_config)
     if vectordb_type == schema.DatabaseType.POSTGRES:
         log.info("Because the db is Postgres, and embedding dimension size must be hard-coded, setting embedding type to %s", embedding_type)
-        vectordb_args['embedding'] = SentenceTransformerEmbedding()
-        data_stack = DataUploadPipeline(
-            vectordb=Postgres(
-                embedding=OpenAIEmbedding(
-                    api_key=os.getenv('OPENAI_API_KEY'),
-                    model='text-embedding-ada-002')
-                ),
-        )
-    else:
-        data_stack = DataUploadPipeline()
-        data_stack.set_vectordb(vectordb_type,**vectordb_args)
-        
-    data_stack.set_file_processor(file_processor_type)
 
-    if not os.path.exists(UPLOAD_PATH):
-        os.mkdir(UPLOAD_PATH)
-    with open(f"{UPLOAD_PATH}{file_obj.filename}", 'w', encoding='utf-8') as tfp:
-        tfp.write(file_obj.file.read().decode("utf-8"))
+    stored = await save_upload(file_obj, UPLOAD_PATH)
 
-    # FIXME: This may have to be a background job!!!
-    docs = data_stack.file_processor.process_file(
-        file=f"{UPLOAD_PATH}{file_obj.filename}",
-        file_type=schema.FileType.TEXT,
+    return enqueue_upload(vectordb_type, vectordb_args,
+        reuse_job=stored.duplicate and not reingest,
+        postgres_openai_vectordb=vectordb_type == schema.DatabaseType.POSTGRES,
+        file_processor_type=file_processor_type.value,
+        embedding_type=embedding_type.value if embedding_type else None,
+        source=stored.path,
+        file_type=schema.FileType.TEXT.value,
         label=label,
-        name="".join(file_obj.filename.split(".")[:-1])
-        )
-    if embedding_type:
-        data_stack.set_embedding(embedding_type)
-        # FIXME: This may have to be a background job!!!
-        data_stack.embedding.get_embeddings(doc_list=docs)
-    data_stack.vectordb.add_to_collection(docs=docs)
-    return {"message": "Documents added to DB"}
+        process_args={
+            "name": "".join(file_obj.filename.split(".")[:-1]),
+            # the stored file is named by its hash, sources keep showing the uploaded name
+            "metadata": {"source": f"{UPLOAD_PATH}{file_obj.filename}"}})
 
 @router.post("/upload/csv-file",
-    response_model=schema.APIInfoResponse,
+    response_model=schema.Job,
     responses={
+        413: {"model": schema.APIErrorResponse},
         422: {"model": schema.APIErrorResponse},
         403: {"model": schema.APIErrorResponse},
         500: {"model": schema.APIErrorResponse}},
-    status_code=201, tags=["Data Management"])
+    status_code=202, tags=["Data Management"])
 @admin_auth_check_decorator
 async def upload_csv_file( #pylint: disable=too-many-arguments
     file_obj: UploadFile,
@@ -346,51 +537,136 @@ async def upload_csv_file( #pylint: disable=too-many-arguments
     vectordb_type:schema.DatabaseType=Query(schema.DatabaseType.CHROMA),
     vectordb_config:schema.DBSelector = Depends(schema.DBSelector),
     embedding_type:schema.EmbeddingType=Query(None),
+    reingest:bool=Query(False, desc="Ingest again, even if the same contents were "+\
+        "uploaded with the same settings before"),
     token:SecretStr=Query(None,
         desc="Optional access token to be used if user accounts not present"),
     ):
     '''* Upload CSV with fields (id, text, label, links, medialinks).
     * Vectorises the text using OpenAI embdedding (or the one set in chroma DB settings).
     * Keeps other details, sourceTag, link, and media as metadata in vector store
-    * embedding_type: optional for ChromaDB. For Postgres, if none, will use OpenAIEmbedding'''
+    * embedding_type: optional for ChromaDB. For Postgres, if none, will use OpenAIEmbedding
+    * The same contents uploaded again with the same settings return the earlier job,
+    unless reingest is set
+    * Runs as a background job. Its progress can be checked at /job/{jobId}'''
     log.info("Access token used: %s", token)
     if not embedding_type and vectordb_type==schema.DatabaseType.POSTGRES:
         embedding_type=schema.EmbeddingType.HUGGINGFACE_DEFAULT
     vectordb_args = compose_vector_db_args(vectordb_type, vectordb_config)
     if vectordb_type == schema.DatabaseType.POSTGRES:
         log.info("Because the db is Postgres, and embedding dimension size must be hard-coded, setting embedding type to %s", embedding_type)
-        vectordb_args['embedding'] = SentenceTransformerEmbedding()
-        data_stack = DataUploadPipeline(
-            vectordb=Postgres(
-                embedding=OpenAIEmbedding(
-                    api_key=os.getenv('OPENAI_API_KEY'),
-                    model='text-embedding-ada-002')
-                ),
-        )
-    else:
-        data_stack = DataUploadPipeline()
-        data_stack.set_vectordb(vectordb_type,**vectordb_args)
-    if not os.path.exists(UPLOAD_PATH):
-        os.mkdir(UPLOAD_PATH)
-    with open(f"{UPLOAD_PATH}{file_obj.filename}", 'w', encoding='utf-8') as tfp:
-        tfp.write(file_obj.file.read().decode("utf-8"))
-
-    # FIXME: This may have to be a background job!!!
+    stored = await save_upload(file_obj, UPLOAD_PATH)
+
     if col_delimiter==schema.CsvColDelimiter.COMMA:
         col_delimiter=","
     elif col_delimiter==schema.CsvColDelimiter.TAB:
         col_delimiter="\t"
-    docs = data_stack.file_processor.process_file(
-        file=f"{UPLOAD_PATH}{file_obj.filename}",
-        file_type=schema.FileType.CSV,
-        col_delimiter=col_delimiter
-        )
-    if embedding_type:
-        data_stack.set_embedding(embedding_type)
-        # FIXME: This may have to be a background job!!!
-        data_stack.embedding.get_embeddings(doc_list=docs)
-    data_stack.vectordb.add_to_collection(docs=docs)
-    return {"message": "Documents added to DB"}
+    return enqueue_upload(vectordb_type, vectordb_args,
+        reuse_job=stored.duplicate and not reingest,
+        postgres_openai_vectordb=vectordb_type == schema.DatabaseType.POSTGRES,
+        embedding_type=embedding_type.value if embedding_type else None,
+        source=stored.path,
+        file_type=schema.FileType.CSV.value,
+        process_args={"col_delimiter": col_delimiter})
+
+@router.post("/upload/bible-file",
+    response_model=schema.Job,
+    responses={
+        413: {"model": schema.APIErrorResponse},
+        422: {"model": schema.APIErrorResponse},
+        403: {"model": schema.APIErrorResponse},
+        500: {"model": schema.APIErrorResponse}},
+    status_code=202, tags=["Data Management"])
+@admin_auth_check_decorator
+async def upload_bible_file( #pylint: disable=too-many-arguments
+    file_obj: UploadFile,
+    label:str=Query(..., desc="The label for the set of documents for access based filtering"),
+    file_type:schema.FileType=Query(schema.FileType.USFM, desc="USFM or USX"),
+    unit:schema.BibleDocumentUnit=Query(schema.BibleDocumentUnit.VERSE,
+        desc="A document per verse, or per pericope"),
+    vectordb_type:schema.DatabaseType=Query(schema.DatabaseType.CHROMA),
+    vectordb_config:schema.DBSelector = Depends(schema.DBSelector),
+    embedding_type:schema.EmbeddingType=Query(None),
+    reingest:bool=Query(False, desc="Ingest again, even if the same contents were "+\
+        "uploaded with the same settings before"),
+    token:SecretStr=Query(None,
+        desc="Optional access token to be used if user accounts not present")):
+    '''* Upload of a Bible book in USFM or USX format.
+    * Makes a document per verse or per pericope, with book, chapter and verse as metadata
+    * docIds are the label and the reference, like "ESV-Bible GEN 1:1"
+    * For many books at once, upload an archive of them to /upload/archive
+    * embedding_type: optional for ChromaDB. For Postgres, if none, will use OpenAIEmbedding
+    * The same contents uploaded again with the same settings return the earlier job,
+    unless reingest is set
+    * Runs as a background job. Its progress can be checked at /job/{jobId}'''
+    log.info("Access token used: %s", token)
+    if file_type not in [schema.FileType.USFM, schema.FileType.USX]:
+        raise UnprocessableException("file_type should be USFM or USX")
+    if not embedding_type and vectordb_type==schema.DatabaseType.POSTGRES:
+        embedding_type=schema.EmbeddingType.HUGGINGFACE_DEFAULT
+    vectordb_args = compose_vector_db_args(vectordb_type, vectordb_config)
+
+    stored = await save_upload(file_obj, UPLOAD_PATH)
+
+    return enqueue_upload(vectordb_type, vectordb_args,
+        reuse_job=stored.duplicate and not reingest,
+        postgres_openai_vectordb=vectordb_type == schema.DatabaseType.POSTGRES,
+        embedding_type=embedding_type.value if embedding_type else None,
+        source=stored.path,
+        file_type=file_type.value,
+        label=label,
+        process_args={
+            "bible_unit": unit.value,
+            "metadata": {"source": f"{UPLOAD_PATH}{file_obj.filename}"}})
+
+@router.post("/upload/archive",
+    response_model=schema.Job,
+    responses={
+        413: {"model": schema.APIErrorResponse},
+        422: {"model": schema.APIErrorResponse},
+        403: {"model": schema.APIErrorResponse},
+        500: {"model": schema.APIErrorResponse}},
+    status_code=202, tags=["Data Management"])
+@admin_auth_check_decorator
+async def upload_archive( #pylint: disable=too-many-arguments
+    file_obj: UploadFile,
+    label:str=Query(..., desc="The label for the set of documents for access based filtering"),
+    file_processor_type: schema.FileProcessorType=Query(schema.FileProcessorType.LANGCHAIN),
+    bible_unit:schema.BibleDocumentUnit=Query(schema.BibleDocumentUnit.VERSE,
+        desc="For USFM and USX files, a document per verse, or per pericope"),
+    vectordb_type:schema.DatabaseType=Query(schema.DatabaseType.CHROMA),
+    vectordb_config:schema.DBSelector = Depends(schema.DBSelector),
+    embedding_type:schema.EmbeddingType=Query(None),
+    reingest:bool=Query(False, desc="Ingest again, even if the same contents were "+\
+        "uploaded with the same settings before"),
+    token:SecretStr=Query(None,
+        desc="Optional access token to be used if user accounts not present")):
+    '''* Upload of a zip or tar archive of text, markdown, CSV/TSV, USFM and USX files.
+    * The files are parsed in parallel and their documents added together, in batches
+    * Text and markdown files get the label. CSV files carry their own labels
+    * A file that fails is listed in the job output with its error, the others still go in
+    * embedding_type: optional for ChromaDB. For Postgres, if none, will use OpenAIEmbedding
+    * The same contents uploaded again with the same settings return the earlier job,
+    unless reingest is set
+    * Runs as a background job. Its progress can be checked at /job/{jobId}'''
+    log.info("Access token used: %s", token)
+    if not embedding_type and vectordb_type==schema.DatabaseType.POSTGRES:
+        embedding_type=schema.EmbeddingType.HUGGINGFACE_DEFAULT
+    vectordb_args = compose_vector_db_args(vectordb_type, vectordb_config)
+
+    stored = await save_upload(file_obj, UPLOAD_PATH, text=False)
+    if not await asyncio.to_thread(is_archive, stored.path):
+        raise UnprocessableException("Upload is not a zip or tar archive")
+
+    return enqueue_upload(vectordb_type, vectordb_args,
+        reuse_job=stored.duplicate and not reingest,
+        postgres_openai_vectordb=vectordb_type == schema.DatabaseType.POSTGRES,
+        file_processor_type=file_processor_type.value,
+        embedding_type=embedding_type.value if embedding_type else None,
+        archive=stored.path,
+        label=label,
+        source_prefix=f"{UPLOAD_PATH}{file_obj.filename}/",
+        process_args={"bible_unit": bible_unit.value})
 
 @router.get("/job/{job_id}",
     response_model=schema.Job,
@@ -404,10 +680,64 @@ async def upload_csv_file( #pylint: disable=too-many-arguments
 async def check_job_status(job_id:int = Path(...),
     token:SecretStr=Query(None,
         desc="Optional access token to be used if user accounts not present")):
-    '''Returns the status of background jobs like upload-documemts'''
+    '''Returns the status of background jobs like upload-documemts.
+    A running job reports its progress in output, a finished one its stats'''
     log.info("Access token used:%s", token)
-    print(job_id)
-    return {"jobId":"10001", "status":schema.JobStatus.QUEUED}
+    job = await asyncio.to_thread(JOB_STORE.get, job_id)
+    if job is None:
+        raise NotFoundException(f"No job with id {job_id}")
+    return job
+
+@router.delete("/job/{job_id}",
+    response_model=schema.Job,
+    responses={
+        404: {"model": schema.APIErrorResponse},
+        422: {"model": schema.APIErrorResponse},
+        403: {"model": schema.APIErrorResponse},
+        500: {"model": schema.APIErrorResponse}},
+    status_code=200, tags=["Data Management"])
+@admin_auth_check_decorator
+async def cancel_job(job_id:int = Path(...),
+    token:SecretStr=Query(None,
+        desc="Optional access token to be used if user accounts not present")):
+    '''Cancels a background job. A queued job is cancelled right away, a running one
+    stops after the batch it is on, and what it wrote till then stays in the DB'''
+    log.info("Access token used:%s", token)
+    job = await asyncio.to_thread(JOB_STORE.cancel, job_id)
+    if job is None:
+        raise NotFoundException(f"No job with id {job_id}")
+    return job
+
+@router.get("/metrics/openai-queue",
+    responses={
+        403: {"model": schema.APIErrorResponse},
+        500: {"model": schema.APIErrorResponse}},
+    status_code=200, tags=["Data Management"])
+@admin_auth_check_decorator
+async def get_openai_queue_metrics(
+    token:SecretStr=Query(None,
+        desc="Optional access token to be used if user accounts not present")):
+    '''Returns the queue depth per priority and the remaining rate budget,
+    for each OpenAI endpoint type'''
+    log.info("Access token used: %s", token)
+    return await asyncio.to_thread(openai_scheduler.metrics)
+
+@router.get("/metrics/ingestion",
+    responses={
+        403: {"model": schema.APIErrorResponse},
+        500: {"model": schema.APIErrorResponse}},
+    status_code=200, tags=["Data Management"])
+@admin_auth_check_decorator
+async def get_ingestion_metrics(
+    token:SecretStr=Query(None,
+        desc="Optional access token to be used if user accounts not present")):
+    '''Returns the stage throughputs and queue occupancies of the latest upload runs,
+    as saved with their jobs by the workers'''
+    log.info("Access token used: %s", token)
+    jobs = await asyncio.to_thread(JOB_STORE.recent, "upload")
+    return [{"jobId": job['jobId'], "status": job['status'],
+            **{key: value for key, value in job['output'].items() if key != 'progress'}}
+        for job in jobs]
 
 @router.get("/source-labels",
     response_model=List[str],
@@ -17,6 +17,7 @@ class FileProcessorType(str, Enum):
     '''Available file processor technology choices'''
     LANGCHAIN = "Langchain-loaders"
     VANILLA = "Vanilla-Python-loaders"
+    NATIVE = "Native-token-splitter"
 
 class EmbeddingType(str, Enum):
     '''Available text embedding technology choices'''
@@ -35,6 +36,13 @@ class DatabaseType(str, Enum):
 class LLMFrameworkType(str, Enum):
     '''Available framework types'''
     LANGCHAIN = "openai-langchain"
+    VANILLA = "openai-vanilla"
+
+class CondenseStrategy(str, Enum):
+    '''When a follow up question is rephrased, by the LLM, into a standalone question'''
+    ALWAYS = "always"
+    HEURISTIC = "skip-self-contained"
+    CACHED = "skip-self-contained-and-cache"
 
 class AudioTranscriptionType(str, Enum):
     '''The type fo text-to-speech audio transcription'''
@@ -45,8 +53,18 @@ class FileType(str, Enum):
     TEXT = "Continuous text"
     MD = "Generic markdown"
     CSV = "CSV with fields (id, text, label, links, medialinks)"
-    # USFM = "Bible book in USFM format"
-    # USX = "Bible book in USFM format"
+    USFM = "Bible book in USFM format"
+    USX = "Bible book in USX format"
+
+class BibleDocumentUnit(str, Enum):
+    '''How much of a Bible book goes in a document'''
+    VERSE = "verse"
+    PERICOPE = "pericope"
+
+class RecordFormat(str, Enum):
+    '''Formats of the streamed uploads of pre-processed documents'''
+    NDJSON = "ndjson"
+    ARROW = "arrow"
 
 class CsvColDelimiter(str, Enum):
     '''Delimiter for the uploaded CSV file'''
@@ -87,6 +105,15 @@ class ChatPipelineSelector(BaseModel):
                     desc="The framework through which LLM access is handled")
     llmApiKey: str = Field(None, desc="If using a cloud service, like OpenAI, the key from them")
     llmModelName: str = Field(None, desc="The model to be used for chat completion")
+    condenseStrategy: CondenseStrategy = Field(CondenseStrategy.ALWAYS,
+                    desc="When to make the extra LLM call that rephrases follow up questions")
+    condenseModelName: str = Field(None,
+                    desc="A cheaper model for rephrasing questions. Defaults to llmModelName")
+    speculativeRetrieval: bool = Field(True,
+                    desc="Retrieve documents for the raw question while it is being rephrased")
+    compressContext: bool = Field(False,
+                    desc="Send only the sentences of retrieved documents most similar to the "+\
+                        "question")
     vectordbType: DatabaseType = Field(DatabaseType.POSTGRES,
                     desc="The Database to be connected to. Same one used for dataupload")
     dbHostnPort: HostnPortPattern = Field(None,
@@ -107,6 +134,9 @@ class ChatPipelineSelector(BaseModel):
                     desc="If there is a model we can choose to use from the available")
     transcriptionFrameworkType: AudioTranscriptionType = Field(AudioTranscriptionType.WHISPER,
                     desc="The framework through which audio transcription is handled")
+    streaming: bool = Field(False,
+                    desc="Send the answer as answer_chunk messages while it is generated, "+\
+                    "followed by the complete answer with sources")
 
 # class UserPrompt(BaseModel): # not using this as we recieve string from websocket
 #     '''Input chat text from the user'''
@@ -121,9 +151,20 @@ class ChatResponseType(str, Enum):
     '''The type field values for a botResponse'''
     QUESTION = "question"
     ANSWER = "answer"
+    ANSWER_CHUNK = "answer_chunk"
     ERROR = "error"
 
 
+class FrameType(int, Enum):
+    '''First byte of the binary frames a client sends to the chat websocket.
+    AUDIO_START carries a JSON object with sample_rate and channels, AUDIO_CHUNKs carry 16 bit
+    little endian PCM and AUDIO_END asks for the answer to the transcribed question'''
+    TEXT = 1
+    AUDIO_START = 2
+    AUDIO_CHUNK = 3
+    AUDIO_END = 4
+
+
 class BotResponse(BaseModel):
     '''Chat response from server to UI or user app'''
     message: str = Field(...,example="Good Morning to you too!")
@@ -142,6 +183,7 @@ class JobStatus(str, Enum):
     STARTED = 'started'
     FINISHED = 'finished'
     FAILED = 'failed'
+    CANCELLED = 'cancelled'
 
 class Job(BaseModel):
     '''Response object of Background Job status check'''
@@ -1,15 +1,25 @@
 ''' Test fixtures and stuff'''
 
 import os
+import uuid
 import shutil
 import pytest
 
+from . import client
+
+@pytest.fixture(scope="session", autouse=True)
+def app_lifespan():
+    '''Runs the startup and shutdown events, which start and stop the job workers'''
+    with client:
+        yield
 
 @pytest.fixture
 def fresh_db():
     '''Deletes the chroma db folder if one existed and 
-    returns the DB_config to be used in all APIs'''
-    chroma_db_path = "chromadb_store_test"
+    returns the DB_config to be used in all APIs.
+    The folder is new for each test, so uploads are not taken for repeats of the
+    same upload to the same DB, by an earlier test'''
+    chroma_db_path = f"chromadb_store_test_{uuid.uuid4().hex[:8]}"
     chroma_db_collection = "adotdcollection_test"
     if os.path.exists(chroma_db_path):
         shutil.rmtree(chroma_db_path)
@@ -0,0 +1,70 @@
+'''Test the streaming USFM and USX parsers and the grouping into pericopes'''
+import io
+
+from core.file_processor.bible import (Verse, iter_usfm_verses, iter_usx_verses,
+    group_pericopes, pericope_reference)
+
+USFM = r'''\id GEN Test Bible
+\h Genesis
+\mt1 Genesis
+\c 1
+\s1 The Creation
+\p
+\v 1 In the beginning God created\f + \fr 1:1 \ft Or \fq began\f* the heavens
+\w and|lemma="ve"\w* the earth.
+\v 2 The earth was formless\x - \xo 1:2 \xt Jer 4:23\x* and void.
+\q1 And darkness was
+\q2 over the deep.
+\s1 The First Day
+\p \v 3 God said, “Let there be light.”
+\c 2
+\p
+\v 1 Thus the heavens were finished.
+'''
+
+USX = '''<?xml version="1.0" encoding="utf-8"?>
+<usx version="3.0">
+  <book code="GEN" style="id">Test Bible</book>
+  <para style="h">Genesis</para>
+  <chapter number="1" style="c" sid="GEN 1"/>
+  <para style="s1">The Creation<note caller="+" style="f">A note</note></para>
+  <para style="p"><verse number="1" style="v" sid="GEN 1:1"/>In the beginning
+    <char style="w" lemma="bereshit">God</char> created<note caller="+" style="f"><char
+    style="ft">Or began</char></note> the heavens.<verse eid="GEN 1:1"/>
+    <verse number="2" style="v" sid="GEN 1:2"/>The earth was formless</para>
+  <para style="q1">and void.<verse eid="GEN 1:2"/></para>
+  <para style="p">Text outside any verse.</para>
+  <chapter eid="GEN 1"/>
+</usx>
+'''
+
+def test_usfm_verses():
+    '''Notes, cross references, word attributes and markers are dropped, headings kept,
+    and a verse goes on across poetry lines'''
+    verses = list(iter_usfm_verses(io.StringIO(USFM)))
+    assert verses == [
+        Verse("GEN", 1, "1", "In the beginning God created the heavens and the earth.",
+            "The Creation"),
+        Verse("GEN", 1, "2", "The earth was formless and void. And darkness was over the deep.",
+            None),
+        Verse("GEN", 1, "3", "God said, “Let there be light.”", "The First Day"),
+        Verse("GEN", 2, "1", "Thus the heavens were finished.", None),
+    ]
+
+def test_usx_verses():
+    '''Verses end at their eid milestones, across paragraphs, without notes or
+    the text after them'''
+    verses = list(iter_usx_verses(io.BytesIO(USX.encode("utf-8"))))
+    assert verses == [
+        Verse("GEN", 1, "1", "In the beginning God created the heavens.", "The Creation"),
+        Verse("GEN", 1, "2", "The earth was formless and void.", None),
+    ]
+
+def test_pericopes():
+    '''Sections start at headings and are no longer than max_verses,
+    with references spanning chapters'''
+    groups = list(group_pericopes(iter_usfm_verses(io.StringIO(USFM))))
+    assert [pericope_reference(group) for group in groups] == ["GEN 1:1-2", "GEN 1:3-2:1"]
+    groups = list(group_pericopes(iter_usfm_verses(io.StringIO(USFM)), max_verses=1))
+    assert [pericope_reference(group) for group in groups] == \
+        ["GEN 1:1", "GEN 1:2", "GEN 1:3", "GEN 2:1"]
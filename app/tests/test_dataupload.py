@@ -1,5 +1,9 @@
 '''Test connecting to test DB and uploading different types of documents'''
+import io
 import os
+import json
+import time
+import zipfile
 from . import client
 
 admin_token = os.getenv('ADMIN_ACCESS_TOKEN', "chatchatchat")
@@ -41,14 +45,58 @@ MD_FILES = [
 
 CSV_FILE = "../recipes/data/dataupload.tsv"
 
+USFM_BOOK = r'''\id GEN Test Bible
+\h Genesis
+\c 1
+\s1 The Creation
+\p
+\v 1 In the beginning, \w God|strong="H430"\w* created the heavens and the earth.\f + \ft A note\f*
+\v 2 Now the earth was formless and empty.
+\q1 Darkness was over the surface of the deep.
+\v 3 And God said, “Let there be light,” and there was light.
+'''
+
+def wait_for_job(response, timeout=120):
+    '''Polls the job of an upload response, till it is no longer queued or running'''
+    assert response.status_code == 202
+    job = response.json()
+    assert job['status'] in ["queued", "started"]
+    deadline = time.time() + timeout
+    while job['status'] in ["queued", "started"] and time.time() < deadline:
+        time.sleep(0.2)
+        response = client.get(f"/job/{job['jobId']}", params={"token":admin_token})
+        assert response.status_code == 200
+        job = response.json()
+    return job
+
 def test_data_upload_processed_sentences(fresh_db):
     '''Test uploading documents to the vector DB'''
     response = client.post("/upload/sentences",
                     params={"vectordb_type": "chroma-db", "token":admin_token},
                     json={"document_objs":SENT_DATA, "vectordb_config": fresh_db}
                     )
-    assert response.status_code == 201
-    assert response.json() == {"message": "Documents added to DB"}
+    job = wait_for_job(response)
+    assert job['status'] == "finished"
+    assert job['output']['documents'] == len(SENT_DATA)
+
+def test_data_upload_sentences_ndjson(fresh_db):
+    '''Test streaming documents as NDJSON, with a line that is not a valid document'''
+    body = "\n".join([json.dumps(doc) for doc in SENT_DATA] + ['{"text": "no docId"}'])
+    response = client.post("/upload/sentences/stream",
+                    params={
+                        "vectordb_type": "chroma-db",
+                        "dbPath":fresh_db["dbPath"],
+                        "collectionName":fresh_db["collectionName"],
+                        "token":admin_token
+                        },
+                    content=body.encode("utf-8"),
+                    headers={"Content-Type": "application/x-ndjson"}
+                    )
+    job = wait_for_job(response)
+    assert job['status'] == "finished"
+    assert job['output']['documents'] == len(SENT_DATA)
+    assert job['output']['invalid_records'] == 1
+    assert job['output']['invalid_record_errors'][0]['record'] == len(SENT_DATA) + 1
 
 def test_data_upload_markdown(fresh_db):
     '''Test uploading documents to the vector DB'''
@@ -68,8 +116,70 @@ def test_data_upload_markdown(fresh_db):
                             }
                         # json={"vectordb_config": fresh_db}
                         )
-            assert response.status_code == 201
-            assert response.json() == {"message": "Documents added to DB"}
+            job = wait_for_job(response)
+            assert job['status'] == "finished"
+
+def test_data_upload_same_file_again(fresh_db):
+    '''The same file, with the same settings, gets the earlier job unless reingest is set'''
+    params = {
+        "label":"translationwords",
+        "vectordb_type": "chroma-db",
+        "dbPath":fresh_db["dbPath"],
+        "collectionName":fresh_db["collectionName"],
+        "token":admin_token
+        }
+    with open(MD_FILES[0], 'rb') as input_file:
+        contents = input_file.read()
+    file_obj = {"file_obj": ("amen.md", contents, "text/markdown")}
+    first = wait_for_job(client.post("/upload/text-file", files=file_obj, params=params))
+    assert first['status'] == "finished"
+
+    response = client.post("/upload/text-file", files=file_obj, params=params)
+    assert response.status_code == 202
+    assert response.json()['jobId'] == first['jobId']
+
+    response = client.post("/upload/text-file", files=file_obj,
+        params={**params, "reingest": True})
+    job = wait_for_job(response)
+    assert job['jobId'] != first['jobId']
+    assert job['status'] == "finished"
+
+def test_data_upload_markdown_native_splitter(fresh_db):
+    '''Test uploading a markdown file, split by the native token-aware splitter'''
+    with open(MD_FILES[1], 'rb') as input_file:
+        response = client.post("/upload/text-file",
+                    files={"file_obj": (MD_FILES[1].rsplit('/', maxsplit=1)[-1],
+                                                input_file, "text/markdown")},
+                    params={
+                        "label":"translationwords",
+                        "file_processor_type": "Native-token-splitter",
+                        "vectordb_type": "chroma-db",
+                        "dbPath":fresh_db["dbPath"],
+                        "collectionName":fresh_db["collectionName"],
+                        "token":admin_token
+                        }
+                    )
+        job = wait_for_job(response)
+        assert job['status'] == "finished"
+        assert job['output']['documents'] > 1
+
+def test_data_upload_usfm(fresh_db):
+    '''Test uploading a USFM book, as a document per verse'''
+    response = client.post("/upload/bible-file",
+                files={"file_obj": ("GEN.usfm", USFM_BOOK.encode("utf-8"), "text/plain")},
+                params={
+                    "label":"Test-Bible",
+                    "file_type": "Bible book in USFM format",
+                    "unit": "verse",
+                    "vectordb_type": "chroma-db",
+                    "dbPath":fresh_db["dbPath"],
+                    "collectionName":fresh_db["collectionName"],
+                    "token":admin_token
+                    }
+                )
+    job = wait_for_job(response)
+    assert job['status'] == "finished"
+    assert job['output']['documents'] == 3
 
 def test_data_upload_csv(fresh_db):
     '''Test uploading documents to the vector DB'''
@@ -86,8 +196,53 @@ def test_data_upload_csv(fresh_db):
                         },
                     json={"vectordb_config": fresh_db}
                     )
-        assert response.status_code == 201
-        assert response.json() == {"message": "Documents added to DB"}
+        job = wait_for_job(response)
+        assert job['status'] == "finished"
+
+def test_data_upload_archive(fresh_db):
+    '''Test uploading a zip of markdown files, with a file that is not UTF-8'''
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zipped:
+        for md_file in MD_FILES:
+            zipped.write(md_file, f"translationwords/{md_file.rsplit('/', maxsplit=1)[-1]}")
+        zipped.writestr("translationwords/broken.md", b"\xff\xfe not text")
+    response = client.post("/upload/archive",
+                files={"file_obj": ("translationwords.zip", archive.getvalue(),
+                                    "application/zip")},
+                params={
+                    "label":"translationwords",
+                    "vectordb_type": "chroma-db",
+                    "dbPath":fresh_db["dbPath"],
+                    "collectionName":fresh_db["collectionName"],
+                    "token":admin_token
+                    }
+                )
+    job = wait_for_job(response)
+    assert job['status'] == "finished"
+    assert job['output']['files'] == len(MD_FILES) + 1
+    assert job['output']['documents'] > 0
+    assert [failed['file'] for failed in job['output']['failed_files']] == \
+        ["translationwords/broken.md"]
+
+def test_ingestion_metrics(fresh_db):
+    '''The stats of an upload run by a worker are in the ingestion metrics'''
+    with open(MD_FILES[0], 'rb') as input_file:
+        response = client.post("/upload/text-file",
+                    files={"file_obj": ("amen.md", input_file, "text/markdown")},
+                    params={
+                        "label":"translationwords",
+                        "vectordb_type": "chroma-db",
+                        "dbPath":fresh_db["dbPath"],
+                        "collectionName":fresh_db["collectionName"],
+                        "token":admin_token
+                        })
+    job = wait_for_job(response)
+    assert job['status'] == "finished"
+    response = client.get("/metrics/ingestion", params={"token":admin_token})
+    assert response.status_code == 200
+    runs = {run['jobId']: run for run in response.json()}
+    assert runs[job['jobId']]['documents'] > 0
+    assert runs[job['jobId']]['stages']
 
 def test_get_lables(fresh_db):
     '''Check available labels in the vector db, before and after data upload'''
@@ -0,0 +1,75 @@
+'''Test hedged chat completions against a local OpenAI compatible stub server'''
+import json
+import time
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from core.llm_framework.hedging import HedgedChatCompletion
+
+# Seconds each stub model waits before sending its first token
+MODEL_DELAYS = {"slow-model": 2.0, "fast-model": 0.0}
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    '''Streams "<model> answer" for /v1/chat/completions, after the model's delay'''
+    def do_POST(self): #pylint: disable=invalid-name
+        '''Chat completion with stream=True'''
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length))
+        model = body['model']
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        time.sleep(MODEL_DELAYS.get(model, 0))
+        try:
+            for piece in [model, " answer"]:
+                chunk = {"id": "stub", "object": "chat.completion.chunk", "created": 0,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": piece},
+                    "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client cancelled this request
+
+    def log_message(self, *args): #pylint: disable=arguments-differ
+        '''Keep the test output clean'''
+
+@pytest.fixture(name="stub_api_base")
+def fixture_stub_api_base():
+    '''Runs the stub server in a thread and returns its base URL'''
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOpenAIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    finally:
+        server.shutdown()
+
+MESSAGES = [{"role": "user", "content": "Who created the earth?"}]
+
+def test_no_hedge_when_fast(stub_api_base):
+    '''A quick first token does not send a hedge request'''
+    hedger = HedgedChatCompletion("fast-model", "slow-model", initial_delay=1.0)
+    answer = asyncio.run(hedger.acreate(MESSAGES, api_base=stub_api_base, api_key="stub"))
+    assert answer == "fast-model answer"
+    assert hedger.stats()['hedged'] == 0
+
+def test_hedge_with_fallback_wins(stub_api_base):
+    '''A slow first token sends a hedge to the fallback model, which answers first'''
+    hedger = HedgedChatCompletion("slow-model", "fast-model", initial_delay=0.3)
+    start = time.monotonic()
+    answer = asyncio.run(hedger.acreate(MESSAGES, api_base=stub_api_base, api_key="stub"))
+    assert time.monotonic() - start < MODEL_DELAYS["slow-model"]
+    assert answer == "fast-model answer"
+    stats = hedger.stats()
+    assert stats['hedged'] == 1
+    assert stats['hedge_wins'] == 1
+    assert stats['hedge_rate'] == 1.0
+    # the latency the client saw, hedge delay included
+    assert hedger.latencies[-1] >= 0.3
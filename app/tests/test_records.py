@@ -0,0 +1,25 @@
+'''Test reading uploaded records as documents'''
+import json
+import base64
+
+import numpy as np
+
+from core.file_processor.records import RecordReader
+
+def test_embedding_dimensions(tmp_path):
+    '''Records with embeddings of other dimensions than the first are reported, not added'''
+    records = [
+        {"docId": "a", "text": "first", "embedding": [0.1, 0.2, 0.3]},
+        {"docId": "b", "text": "packed",
+            "embedding": base64.b64encode(np.ones(3, dtype="<f4").tobytes()).decode()},
+        {"docId": "c", "text": "too short", "embedding": [0.1, 0.2]},
+        {"docId": "d", "text": "no embedding"},
+    ]
+    path = tmp_path / "records.ndjson"
+    path.write_text("\n".join(json.dumps(record) for record in records), encoding="utf-8")
+    reader = RecordReader(str(path), "ndjson", label="test")
+    docs = list(reader.documents())
+    assert [doc.docId for doc in docs] == ["a", "b", "d"]
+    assert docs[1].embedding.tolist() == [1.0, 1.0, 1.0]
+    assert reader.report()['invalid_records'] == 1
+    assert reader.report()['invalid_record_errors'][0]['record'] == 3
@@ -0,0 +1,97 @@
+'''Test the semantic answer cache with a stub embedding'''
+import asyncio
+
+import numpy as np
+
+import schema
+import routers
+from core.embedding import EmbeddingInterface
+from core.jobs import JobStore
+from core.llm_framework.semantic_cache import SemanticCache
+
+# Questions and their embeddings. Cosine similarity to "who made the earth" is 0.95 for
+# the rephrased question and 0.85 for the other one
+VECTORS = {
+    "who made the earth": [1.0, 0.0],
+    "who created the earth": [0.95, np.sqrt(1 - 0.95 ** 2)],
+    "who made the sea": [0.85, np.sqrt(1 - 0.85 ** 2)],
+}
+RESPONSE = {"answer": "God made the earth", "source_documents": []}
+
+class StubEmbedding(EmbeddingInterface):
+    '''Looks the questions up in VECTORS'''
+    def __init__(self) -> None: #pylint: disable=super-init-not-called
+        self.calls = 0
+
+    def get_embeddings(self, doc_list, **kwargs) -> None:
+        self.calls += 1
+        for doc in doc_list:
+            doc.embedding = VECTORS[doc.text]
+
+def new_cache() -> SemanticCache:
+    '''A cache with the stub embedding, hitting at a similarity of 0.9'''
+    return SemanticCache(embedding=StubEmbedding(), threshold=0.9)
+
+def test_hit_above_threshold():
+    '''A close enough rephrasing gets the stored answer, marked as cached'''
+    cache = new_cache()
+    namespace = cache.namespace(["ESV-Bible"], "collection", "gpt-3.5-turbo")
+    assert cache.lookup("who made the earth", namespace) is None
+    cache.add("who made the earth", namespace, RESPONSE)
+    cached = cache.lookup("who created the earth", namespace)
+    assert cached['answer'] == RESPONSE['answer']
+    assert cached['cached'] is True
+    assert cache.hits == 1
+
+def test_miss_below_threshold():
+    '''A different question is not served the stored answer'''
+    cache = new_cache()
+    namespace = cache.namespace(["ESV-Bible"], "collection", "gpt-3.5-turbo")
+    cache.add("who made the earth", namespace, RESPONSE)
+    assert cache.lookup("who made the sea", namespace) is None
+    assert cache.misses == 1
+
+def test_namespaces_are_isolated():
+    '''Answers are not shared across label sets, collections or LLM models'''
+    cache = new_cache()
+    namespace = cache.namespace(["ESV-Bible"], "collection", "gpt-3.5-turbo")
+    cache.add("who made the earth", namespace, RESPONSE)
+    assert cache.namespace(["ESV-Bible", "ESV-Bible"], "collection", "gpt-3.5-turbo") \
+        == namespace
+    for other in [cache.namespace(["NIV-Bible"], "collection", "gpt-3.5-turbo"),
+                  cache.namespace(["ESV-Bible"], "other-collection", "gpt-3.5-turbo"),
+                  cache.namespace(["ESV-Bible"], "collection", "gpt-4")]:
+        assert cache.lookup("who made the earth", other) is None
+
+def test_invalidate_by_labels():
+    '''An upload to a label drops the answers that could have used it, and the unfiltered ones'''
+    cache = new_cache()
+    esv = cache.namespace(["ESV-Bible", "tw"], "collection", "gpt-3.5-turbo")
+    niv = cache.namespace(["NIV-Bible"], "collection", "gpt-3.5-turbo")
+    unfiltered = cache.namespace([], "collection", "gpt-3.5-turbo")
+    for namespace in [esv, niv, unfiltered]:
+        cache.add("who made the earth", namespace, RESPONSE)
+    cache.invalidate(labels=["tw"])
+    assert cache.lookup("who made the earth", esv) is None
+    assert cache.lookup("who made the earth", unfiltered) is None
+    assert cache.lookup("who made the earth", niv) is not None
+
+def test_invalidate_on_finished_upload(tmp_path, monkeypatch):
+    '''The answers for a label are dropped when an upload job to it finishes'''
+    cache = new_cache()
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(routers, "ANSWER_CACHE", cache)
+    monkeypatch.setattr(routers, "JOB_STORE", store)
+    namespace = cache.namespace(["tw"], "collection", "gpt-3.5-turbo")
+    cache.add("who made the earth", namespace, RESPONSE)
+
+    async def finish_upload():
+        watcher = asyncio.create_task(routers.watch_finished_jobs(interval=0.05))
+        await asyncio.sleep(0.1)
+        job_id = store.enqueue("upload", {})
+        store.finish(job_id, schema.JobStatus.FINISHED, {"labels": ["tw"]})
+        await asyncio.sleep(0.3)
+        watcher.cancel()
+
+    asyncio.run(finish_upload())
+    assert cache.lookup("who made the earth", namespace) is None
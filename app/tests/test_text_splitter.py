@@ -0,0 +1,40 @@
+'''Test the chunking of the native TextSplitter'''
+from core.file_processor.native_loader import TextSplitter
+
+TEXT = "The word grace refers to help or blessing given freely. " * 20
+
+def test_cut_before_heading():
+    '''A chunk ends before a heading, not after it, even if that leaves it short'''
+    chunks = TextSplitter(40, 5, "chars").split_text(
+        "Short intro here.\n\n# Heading here\nA sentence that is rather long here, ok.\n")
+    assert chunks[0] == "Short intro here."
+    assert chunks[1].startswith("# Heading here\nA sentence")
+    for chunk in chunks:
+        assert not chunk.splitlines()[-1].startswith("#")
+
+def test_cut_at_paragraph():
+    '''A chunk ends at the last paragraph end, when that keeps at least half of it'''
+    chunks = TextSplitter(60, 0, "chars").split_text(
+        "First paragraph is here. It has two sentences.\n\nSecond one. Short.\n")
+    assert chunks == ["First paragraph is here. It has two sentences.", "Second one. Short."]
+
+def test_overlap():
+    '''The sentences before a cut that fit in the overlap start the next chunk'''
+    chunks = TextSplitter(30, 13, "chars").split_text(
+        "Alpha beta. Gamma delta. Epsilon zeta. Eta theta.")
+    assert chunks == ["Alpha beta. Gamma delta.", "Gamma delta. Epsilon zeta.", "Eta theta."]
+
+def test_over_long_word():
+    '''A word longer than a chunk is cut into chunk sized parts'''
+    chunks = TextSplitter(10, 2, "chars").split_text("abc https://example.org/a/very/long/url ok")
+    assert chunks == ["abc", "https://ex", "ample.org/", "a/very/lon", "g/url ok"]
+
+def test_chars_and_tokens():
+    '''Chunks are sized in the unit asked for, a token being a few characters'''
+    by_chars = list(TextSplitter(50, 0, "chars").split_lines([TEXT]))
+    by_tokens = list(TextSplitter(50, 0, "tokens").split_lines([TEXT]))
+    for chunk, size in by_chars:
+        assert len(chunk) <= size <= 50
+    for _, size in by_tokens:
+        assert size <= 50
+    assert len(by_tokens) < len(by_chars)
@@ -0,0 +1,18 @@
+'''Test the audio sent for transcription, without calling the API'''
+import openai
+
+from core.audio.whisper import WhisperAudioTranscription
+
+def test_memoryview_not_copied(monkeypatch):
+    '''The file uploaded reads from the memory of a memoryview given, not a copy'''
+    recording = bytearray(b"webm audio, not a wav to preprocess")
+    uploaded = {}
+    def transcribe(model, audio_file, **_):
+        recording[:4] = b"WEBM" # seen in the upload only if the memory is shared
+        uploaded['data'] = audio_file.read()
+        uploaded['name'] = audio_file.name
+        return {"text": model}
+    monkeypatch.setattr(openai.Audio, "transcribe", transcribe)
+    transcriber = WhisperAudioTranscription(key="test-key")
+    assert transcriber.transcribe_audio(memoryview(recording)[:-14]) == "whisper-1"
+    assert uploaded == {"data": b"WEBM audio, not a wav", "name": "recorded_audio.wav"}
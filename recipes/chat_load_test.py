@@ -0,0 +1,74 @@
+'''Load test for the /chat websocket
+Opens a number of concurrent chat sessions against one running app worker,
+asks each a few questions and reports the answers per second that worker served.
+
+Start a single worker first, eg:
+    cd app; uvicorn main:app --workers 1 --port 8000
+then:
+    python chat_load_test.py --sessions 1 10 20 --token <access-token>
+'''
+
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlencode
+
+import websockets
+
+QUESTIONS = [
+    "Who created the earth?",
+    "What is an angel?",
+    "What does amen mean?",
+    "Who is the antichrist?",
+]
+
+async def chat_session(url, num_questions, latencies):
+    '''One user asking questions one after the other, like in the UI'''
+    async with websockets.connect(url, open_timeout=60, close_timeout=5) as websocket:
+        for i in range(num_questions):
+            start = time.perf_counter()
+            await websocket.send(QUESTIONS[i % len(QUESTIONS)].encode("utf-8"))
+            while True:
+                resp = json.loads(await websocket.recv())
+                if resp['type'] in ("answer", "error"):
+                    break
+            latencies.append(time.perf_counter() - start)
+
+async def run_load(url, sessions, num_questions):
+    '''Runs the sessions concurrently and returns (wall time, latencies)'''
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[chat_session(url, num_questions, latencies)
+                           for _ in range(sessions)])
+    return time.perf_counter() - start, latencies
+
+def main():
+    '''Parse args and print throughput for each concurrency level'''
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="ws://localhost:8000/chat")
+    parser.add_argument("--token", default="chatchatchat")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 5, 10, 20])
+    parser.add_argument("--questions", type=int, default=3,
+        help="Questions asked in each session")
+    parser.add_argument("--vectordb", default="chroma-db")
+    parser.add_argument("--labels", nargs="+", default=["ESV-Bible", "translationwords"])
+    args = parser.parse_args()
+
+    params = [("llmFrameworkType", "openai-langchain"), ("vectordbType", args.vectordb),
+              ("token", args.token)] + [("labels", label) for label in args.labels]
+    url = f"{args.url}?{urlencode(params)}"
+
+    print(f"{'sessions':>8} {'answers':>8} {'wall(s)':>8} {'answers/s':>10} "+\
+        f"{'p50(s)':>7} {'p95(s)':>7}")
+    for sessions in args.sessions:
+        wall, latencies = asyncio.run(run_load(url, sessions, args.questions))
+        latencies.sort()
+        p50 = latencies[len(latencies)//2]
+        p95 = latencies[min(len(latencies)-1, int(len(latencies)*0.95))]
+        print(f"{sessions:>8} {len(latencies):>8} {wall:>8.2f} {len(latencies)/wall:>10.2f} "+\
+            f"{p50:>7.2f} {p95:>7.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+'''Memory and build time of the documents on the ingestion path: schema.Document objects,
+as the pipeline used to carry them, against the DocumentRows and DocumentBatch it carries now.
+Reports MB per 100k documents, with embeddings of the dimensions asked for.
+The texts are made before measuring and shared, the embeddings are made inside each
+measured build, as the pipeline gets them, so what is compared is the overhead per
+document and the embeddings.
+
+    python document_memory_benchmark.py --docs 100000 --dims 384 1536
+'''
+
+import sys
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+
+# setting path
+sys.path.append('../app')
+
+import schema #pylint: disable=wrong-import-position
+from core.document_batch import DocumentBatch, DocumentRow #pylint: disable=wrong-import-position
+
+
+def sample(i:int) -> dict:
+    '''The fields of one document, like a chunk of a markdown file, without its embedding'''
+    return {
+        "docId": f"translationwords/kt/grace-{i}",
+        "text": f"Grace {i}. " + "The word grace refers to help or blessing given freely. " * 8,
+        "label": "translationwords",
+        "links": [f"https://example.org/tw/{i}"],
+        "media": [],
+        "metadata": {"source": "translationwords/kt/grace.md", "token_count": 120},
+    }
+
+
+def cases(fields:list, dim:int) -> list:
+    '''(name, build) of each representation. The embeddings are made in the build,
+    so they are measured with it'''
+    rng = np.random.default_rng(0)
+    return [
+        ("schema.Document, list of floats", lambda: [schema.Document(
+            **doc, embedding=rng.random(dim, dtype=np.float32).tolist()) for doc in fields]),
+        ("DocumentRow, float32 vector", lambda: [DocumentRow(
+            **doc, embedding=rng.random(dim, dtype=np.float32)) for doc in fields]),
+        ("DocumentBatch, float32 matrix", lambda: DocumentBatch.from_rows(DocumentRow(
+            **doc, embedding=rng.random(dim, dtype=np.float32)) for doc in fields)),
+    ]
+
+
+def measure(build) -> tuple:
+    '''Traced memory held by what build() returns, in MB, and the seconds it took.
+    Tracing slows the build down, so the seconds only compare the cases'''
+    tracemalloc.start()
+    start = time.perf_counter()
+    built = build()
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del built
+    return size / 1024 / 1024, elapsed
+
+
+def main():
+    '''Builds the documents each way and prints the numbers'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=100000)
+    parser.add_argument("--dims", type=int, nargs="+", default=[384, 1536])
+    args = parser.parse_args()
+    scale = 100000 / args.docs
+
+    print(f"{'representation':42} {'dim':>5} {'MB/100k':>9} {'build s':>8}")
+    fields = [sample(i) for i in range(args.docs)]
+    for dim in args.dims:
+        for name, build in cases(fields, dim):
+            size, elapsed = measure(build)
+            print(f"{name:42} {dim:5d} {size * scale:9.1f} {elapsed * scale:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+'''Per turn overhead of the vanilla framework against ConversationalRetrievalChain
+Both answer the same questions from the same fixed documents, with the OpenAI API replaced by
+a local stub that answers at once, so the time measured is what the framework adds.
+The chain makes two LLM calls per follow up turn (condense + answer), vanilla makes one.
+
+    python llm_framework_overhead_benchmark.py --turns 200
+'''
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+STUB_PORT = 8765
+# Read at import by the app modules, so set before those imports
+os.environ.setdefault('OPENAI_API_KEY', "stub")
+os.environ['OPENAI_API_BASE'] = f"http://127.0.0.1:{STUB_PORT}/v1"
+os.environ['OPENAI_CHAT_TPM'] = "100000000"
+os.environ['OPENAI_CHAT_RPM'] = "1000000"
+
+# setting path
+sys.path.append('../app')
+
+from langchain.schema import BaseRetriever #pylint: disable=wrong-import-position
+from langchain.schema import Document as LangchainDocument #pylint: disable=wrong-import-position
+
+from core.vectordb import VectordbInterface #pylint: disable=wrong-import-position
+from core.llm_framework.openai_langchain import LangchainOpenAI #pylint: disable=wrong-import-position
+from core.llm_framework.openai_vanilla import VanillaOpenAI #pylint: disable=wrong-import-position
+
+ANSWER = "In the beginning God created the heaven and the earth (GEN 1:1)."
+QUESTIONS = [
+    "Who created the earth?",
+    "When did he do that?",
+    "What is an angel?",
+    "Are they like humans?",
+]
+DOCS = [LangchainDocument(page_content=f"Passage {i}. " + "Some verse text. " * 40,
+    metadata={"source": f"GEN 1:{i}"}) for i in range(4)]
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    '''Answers /v1/chat/completions at once, streaming or not'''
+    def do_POST(self): #pylint: disable=invalid-name
+        '''Chat completion'''
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        if body.get('stream'):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for piece in ANSWER.split(" "):
+                chunk = {"id": "stub", "object": "chat.completion.chunk", "created": 0,
+                    "model": body['model'], "choices": [{"index": 0,
+                    "delta": {"content": piece + " "}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+        data = json.dumps({"id": "stub", "object": "chat.completion", "created": 0,
+            "model": body['model'], "choices": [{"index": 0,
+            "message": {"role": "assistant", "content": ANSWER}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data.encode("utf-8"))
+
+    def log_message(self, *args): #pylint: disable=arguments-differ
+        '''Quiet'''
+
+
+def serve_stub():
+    '''Runs the stub, in its own process so its CPU time is not counted'''
+    ThreadingHTTPServer(("127.0.0.1", STUB_PORT), StubOpenAIHandler).serve_forever()
+
+
+class FixedRetriever(VectordbInterface, BaseRetriever):
+    '''Returns the same documents for every query'''
+    collection_name = "benchmark"
+    labels = None
+    embedding = None
+    def __init__(self): #pylint: disable=super-init-not-called
+        return
+
+    def add_to_collection(self, docs, **kwargs):
+        return
+
+    def get_relevant_documents(self, query, **kwargs):
+        return list(DOCS)
+
+    async def aget_relevant_documents(self, query, **kwargs):
+        return list(DOCS)
+
+    def get_available_labels(self):
+        return []
+
+
+async def run_turns(ask, turns):
+    '''Latencies and CPU time per turn, for a conversation of `turns` questions'''
+    chat_history = []
+    latencies = []
+    cpu_start = time.process_time()
+    for i in range(turns):
+        question = QUESTIONS[i % len(QUESTIONS)]
+        start = time.perf_counter()
+        answer = await ask(question, chat_history)
+        latencies.append(time.perf_counter() - start)
+        chat_history = (chat_history + [(question, answer)])[-4:]
+    return latencies, (time.process_time() - cpu_start) / turns
+
+
+def report(name, latencies, cpu_per_turn):
+    '''Prints one row of the results'''
+    latencies = sorted(latencies)
+    print(f"{name:<32} mean {statistics.mean(latencies)*1000:7.2f}ms"
+        f"  p50 {latencies[len(latencies)//2]*1000:7.2f}ms"
+        f"  p95 {latencies[int(len(latencies)*0.95)]*1000:7.2f}ms"
+        f"  cpu/turn {cpu_per_turn*1000:7.2f}ms")
+
+
+async def main(turns):
+    '''Runs both frameworks against the stub'''
+    retriever = FixedRetriever()
+    langchain_framework = LangchainOpenAI(vectordb=retriever)
+    chain = langchain_framework.chain
+    async def ask_chain(question, chat_history):
+        result = await chain.acall({"question": question, "chat_history": chat_history})
+        return result['answer']
+
+    vanilla = VanillaOpenAI(vectordb=retriever, hedging=False)
+    async def ask_vanilla(question, chat_history):
+        return (await vanilla.agenerate_text(question, chat_history))['answer']
+
+    # warm up the connections and caches
+    await run_turns(ask_chain, 4)
+    await run_turns(ask_vanilla, 4)
+    report("ConversationalRetrievalChain", *await run_turns(ask_chain, turns))
+    report("VanillaOpenAI", *await run_turns(ask_vanilla, turns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=100)
+    args = parser.parse_args()
+    stub = multiprocessing.Process(target=serve_stub, daemon=True)
+    stub.start()
+    time.sleep(0.5)
+    try:
+        asyncio.run(main(args.turns))
+    finally:
+        stub.terminate()
@@ -0,0 +1,85 @@
+'''Throughput of the file processors' text splitting, on a large markdown corpus.
+The corpus is the translationWords in data/, repeated to the size asked for, as one file.
+For each processor it reports MB/s, the number of chunks and their sizes in tokens.
+
+    python text_splitter_benchmark.py --megabytes 50
+'''
+
+import os
+import sys
+import glob
+import time
+import argparse
+import tempfile
+import statistics
+
+# setting path
+sys.path.append('../app')
+
+import schema #pylint: disable=wrong-import-position
+from core.file_processor.native_loader import NativeLoader #pylint: disable=wrong-import-position
+from core.file_processor.vanilla_loader import VanillaLoader #pylint: disable=wrong-import-position
+from core.llm_framework.context_packer import count_tokens #pylint: disable=wrong-import-position
+
+
+def build_corpus(path:str, megabytes:float) -> int:
+    '''Writes the markdown files to path over and over, up to the size. Returns the bytes'''
+    texts = []
+    for md_file in sorted(glob.glob("./data/translationwords/*.md")):
+        with open(md_file, 'r', encoding='utf-8') as infile:
+            texts.append(infile.read().rstrip() + "\n\n")
+    target = int(megabytes * 1024 * 1024)
+    written = 0
+    with open(path, 'w', encoding='utf-8') as outfile:
+        while written < target:
+            for text in texts:
+                outfile.write(text)
+                written += len(text.encode('utf-8'))
+    return written
+
+
+def processors():
+    '''(name, file processor) pairs to compare. Langchain's only when it is installed'''
+    found = [
+        ("native, 256 tokens, 32 overlap", NativeLoader(256, 32, "tokens")),
+        ("native, 1000 chars, 100 overlap", NativeLoader(1000, 100, "chars")),
+        ("vanilla, 1000 lines", VanillaLoader()),
+    ]
+    try:
+        from core.file_processor.langchain_loader import LangchainLoader #pylint: disable=import-outside-toplevel
+        found.append(("langchain, 1000 chars", LangchainLoader()))
+    except ImportError:
+        print("langchain not installed, skipping LangchainLoader")
+    return found
+
+
+def main():
+    '''Splits the corpus with each processor and prints the numbers'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=float, default=20)
+    parser.add_argument("--sample", type=int, default=2000,
+        help="Chunks whose token counts are measured, to keep the stats quick")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = os.path.join(tmp, "corpus.md")
+        size = build_corpus(corpus, args.megabytes)
+        print(f"Corpus: {size / 1024 / 1024:.1f} MB\n")
+        print(f"{'processor':34} {'MB/s':>8} {'chunks':>9} {'mean tok':>9} {'max tok':>8}")
+        for name, processor in processors():
+            start = time.perf_counter()
+            samples = []
+            chunks = 0
+            for doc in processor.iter_documents(corpus, label="benchmark",
+                    file_type=schema.FileType.MD):
+                chunks += 1
+                if len(samples) < args.sample:
+                    samples.append(doc.text)
+            elapsed = time.perf_counter() - start
+            tokens = [count_tokens(text) for text in samples]
+            print(f"{name:34} {size / 1024 / 1024 / elapsed:8.2f} {chunks:9d} "
+                f"{statistics.mean(tokens):9.0f} {max(tokens):8d}")
+
+
+if __name__ == "__main__":
+    main()